@@ -8,7 +8,7 @@ import sys
 from string import Template
 from shared import constants
 from shared.helper import printReturnOutput
-from shared.helper import produceHashForfile
+from shared.helper import produceHashesForFiles
 
 HASH = "SHA512"
 def getChocoVersion(version):
@@ -40,27 +40,32 @@ def preparePackage():
         "CHOCOVERSION": getChocoVersion(constants.VERSION)
     }
 
-    tools = os.path.join(constants.BUILDFOLDER, "tools")
+    buildFolder = os.path.join(constants.DRIVERROOTDIR, constants.BUILDFOLDER)
+    tools = os.path.join(buildFolder, "tools")
     os.makedirs(tools)
 
+    filePaths = {}
     for arch in archList:
         fileName = f"Azure.Functions.Cli.win-{arch.lower()}.{constants.VERSION}.zip"
         url = f'https://cdn.functions.azure.com/public/4.0.{constants.CONSOLIDATED_BUILD_ID}/{fileName}'
         substitutionMapping[f"ZIPURL_{arch}"] = url
 
         # download the zip
-        # output to local folder
-        if not os.path.exists(fileName):
+        # output to the driver folder, as the linux zips are
+        filePath = os.path.join(constants.DRIVERROOTDIR, fileName)
+        if not os.path.exists(filePath):
             print(f"downloading from {url}")
             with requests.get(url, stream=True, timeout=600) as r:
                 r.raise_for_status()
-                with open(fileName, 'wb') as dl:
+                with open(filePath, 'wb') as dl:
                     for chunk in r.iter_content(chunk_size=8 * 1024 * 1024):
                         dl.write(chunk)
+        filePaths[arch] = filePath
 
-        # get the checksums
-        fileHash = produceHashForfile(fileName, HASH)
-        substitutionMapping[f"CHECKSUM_{arch}"] = fileHash
+    # get the checksums, the zips are hashed in parallel
+    hashes = produceHashesForFiles(filePaths.values(), [HASH])
+    for arch, filePath in filePaths.items():
+        substitutionMapping[f"CHECKSUM_{arch}"] = hashes[filePath][HASH.lower()].upper()
 
     # write install powershell script
     scriptDir = os.path.abspath(os.path.dirname(__file__))
@@ -81,14 +86,15 @@ def preparePackage():
         stringData = f.read()
 
     t = Template(stringData)
-    nuspecFile = os.path.join(constants.BUILDFOLDER, constants.PACKAGENAME+".nuspec")
+    nuspecFile = os.path.join(buildFolder, constants.PACKAGENAME+".nuspec")
 
     with open(nuspecFile, 'w') as f:
         print("writing nuspec")
         f.write(t.safe_substitute(substitutionMapping))
 
     # run choco pack, stdout is merged into python interpreter stdout
-    output = printReturnOutput(["choco", "pack", nuspecFile, "--outputdirectory", constants.ARTIFACTFOLDER])
+    artifactFolder = os.path.join(constants.DRIVERROOTDIR, constants.ARTIFACTFOLDER)
+    output = printReturnOutput(["choco", "pack", nuspecFile, "--outputdirectory", artifactFolder])
     assert("Successfully created package" in output)
 
 # FIXME why does this line not work when import module from sibling package
@@ -40,8 +40,8 @@ def main(*args):
         return
 
     # at root
-    initWorkingDir(constants.BUILDFOLDER, True)
-    initWorkingDir(constants.ARTIFACTFOLDER)
+    initWorkingDir(os.path.join(constants.DRIVERROOTDIR, constants.BUILDFOLDER), True)
+    initWorkingDir(os.path.join(constants.DRIVERROOTDIR, constants.ARTIFACTFOLDER))
 
     # build package
     print("Building package...")
@@ -2,17 +2,11 @@
 import os
 import sys
 import hashlib
+import threading
 import subprocess
+import concurrent.futures
 from . import constants
 
-def restoreDirectory(f):
-    def inner(*args, **kwargs):
-        currentDir = os.getcwd()
-        returnV = f(*args, **kwargs)
-        os.chdir(currentDir)
-        return returnV
-    return inner
-
 # for some commands, returnCode means success
 # for others you need to verify the output string yourself
 def printReturnOutput(args, shell=False, confirm=False):
@@ -38,87 +32,90 @@ def printReturnOutput(args, shell=False, confirm=False):
         subprocess.call(args)
         raise
 
-BUFFERSIZE = 1024
+# hashlib releases the GIL while hashing large buffers, so reading 1MB at a
+# time lets a thread pool hash several files on separate cores.
+BUFFERSIZE = 1024 * 1024
+
+# {path: [size, mtime_ns, ctime_ns, inode, {hashType: hexdigest}]}, kept for
+# the lifetime of the process only
+_hashCache = {}
+_hashCacheLock = threading.Lock()
+
+def _statKey(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+
+def _hashFile(filePath, hashTypes):
+    # all digests are computed in a single pass over the file
+    hashobjs = [hashlib.new(hashType) for hashType in hashTypes]
+    buf = bytearray(BUFFERSIZE)
+    view = memoryview(buf)
+    with open(filePath, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            for hashobj in hashobjs:
+                hashobj.update(view[:n])
+    return {hashType: hashobj.hexdigest() for hashType, hashobj in zip(hashTypes, hashobjs)}
+
+def produceHashesForFile(filePath, hashTypes):
+    """
+    Return {hashType: lowercase hexdigest} of a file, computing all the
+    digests in one pass. Digests are cached by path and stat, and only
+    computed again once the file changed.
+    """
+    hashTypes = [hashType.lower() for hashType in hashTypes]
+    path = os.path.abspath(filePath)
+    key = _statKey(os.stat(path))
+    with _hashCacheLock:
+        entry = _hashCache.get(path)
+        if entry is not None and entry[:-1] == key:
+            digests = entry[-1]
+        else:
+            digests = {}
+    missing = [hashType for hashType in hashTypes if hashType not in digests]
+    if missing:
+        digests = {**digests, **_hashFile(path, missing)}
+        # stat again, a file changed while being hashed is not cached
+        if _statKey(os.stat(path)) == key:
+            with _hashCacheLock:
+                _hashCache[path] = key + [digests]
+    return {hashType: digests[hashType] for hashType in hashTypes}
+
+def produceHashesForFiles(filePaths, hashTypes, workers=None):
+    """
+    Hash many files on a thread pool, return {filePath: {hashType: digest}}
+    with the same keys as filePaths, see produceHashesForFile.
+    """
+    filePaths = list(filePaths)
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda p: produceHashesForFile(p, hashTypes), filePaths)
+        return dict(zip(filePaths, results))
+
 def produceHashForfile(filePath, hashType, Upper = True):
     # hashType is string name iof
-    hashobj = hashlib.new(hashType)
-    with open(filePath,'rb') as f:
-       buf = f.read(BUFFERSIZE)
-       while len(buf) > 0:
-           hashobj.update(buf)
-           buf = f.read(BUFFERSIZE)
+    digest = produceHashesForFile(filePath, [hashType])[hashType.lower()]
     if Upper:
-        return hashobj.hexdigest().upper()
+        return digest.upper()
     else:
-        return hashobj.hexdigest().lower()
-
-@restoreDirectory
-def linuxOutput(buildFolder, arch):
-    os.chdir(constants.DRIVERROOTDIR)
+        return digest.lower()
 
+def downloadLinuxZip(arch):
     # ubuntu dropped 64, fedora supports both
     fileName = f"Azure.Functions.Cli.linux-{arch}.{constants.VERSION}.zip"
     url = f'https://cdn.functions.azure.com/public/4.0.{constants.CONSOLIDATED_BUILD_ID}/{fileName}'
 
     # download the zip
-    # output to local folder
+    # output to the driver folder, no progress bar as output goes to a log
     import wget
-    if not os.path.exists(fileName):
+    filePath = os.path.join(constants.DRIVERROOTDIR, fileName)
+    if not os.path.exists(filePath):
         print(f"downloading from {url}")
         try:
-            wget.download(url)
+            wget.download(url, out=filePath, bar=None)
         except Exception as e:
             print(f"\nERROR: unexpected error downloading {url}: {e}")
             sys.exit(1)
-
-    usr = os.path.join(buildFolder, "usr")
-    usrlib = os.path.join(usr, "lib")
-    usrlibFunc = os.path.join(usrlib, constants.PACKAGENAME)
-    os.makedirs(usrlibFunc)
-    # unzip here
-    import zipfile
-    with zipfile.ZipFile(fileName) as f:
-        print(f"extracting to {usrlibFunc}")
-        f.extractall(usrlibFunc)
-
-    # create relative symbolic link under bin directory, change mode to executable
-    usrbin = os.path.join(usr, "bin")
-    os.makedirs(usrbin)
-    # cd into usr/bin, create relative symlink
-    os.chdir(usrbin)
-    print("create symlink for func")
-    os.symlink(f"../lib/{constants.PACKAGENAME}/func", "func")
-    # executable to be returned
-    exeFullPath = os.path.abspath("func")
-
-    os.chdir(buildFolder)
-
-    # strip sharedobjects
-    import glob
-
-    stripBinary = "strip"
-    if arch == "arm64":
-        stripBinary = "aarch64-linux-gnu-strip"
-
-    # obj files inside the workers should not be removed as workers like "python"
-    # come with objects necessary for the worker to work.
-    sharedObjects = glob.glob("**/*.so", recursive=True)
-    sharedObjects = [obj for obj in sharedObjects if "workers" not in obj]
-
-    printReturnOutput([stripBinary, "--strip-unneeded"] + sharedObjects)
-
-    print(f"change bin/func permission to 755")
-    chmodFolderAndFiles(os.path.join(buildFolder, "usr"))
-    # octal
-    os.chmod(exeFullPath, 0o755)
-
-def chmodFolderAndFiles(folder):
-    print(f"change permission of files in {folder}")
-    os.chmod(folder, 0o755)
-    for r, ds, fs in os.walk(folder):
-        for d in ds:
-            # folder permission to 755
-            os.chmod(os.path.join(r, d), 0o755)
-        for f in fs:
-            # file permission to 644
-            os.chmod(os.path.join(r, f), 0o644)
+    return filePath
@@ -1,12 +1,17 @@
 #! /usr/bin/env python3
 import os
+import sys
+import gzip
 import wget
 import zipfile
 import shutil
 import datetime
+import contextlib
+import concurrent.futures
 from string import Template
 from shared import constants
 from shared import helper
+from ubuntu import debWriter
 
 # version used in url is provided from user input
 # version used for packaging .deb package needs a slight modification
@@ -25,99 +30,186 @@ def returnDebVersion(version):
     else:
         raise NotImplementedError
 
-# depends on gzip, dpkg-deb, strip
-@helper.restoreDirectory
+ARCHITECTURES = ["x64", "arm64"]
+# xz or zstd, zstd packages need dpkg 1.21.18 or later to install
+COMPRESSION = "xz"
+
+# depends on strip, and xz or zstd to compress on all cores
 def preparePackage():
     """
     Prepares and builds a Debian package for each supported architecture.
+    The architectures share nothing, so each one is built in its own
+    worker process. Their output goes to build/linux-<arch>.log and is
+    printed once the build is over, one architecture after the other.
     """
-    os.chdir(constants.DRIVERROOTDIR)
-
     debianVersion = returnDebVersion(constants.VERSION)
     print(f"debianVersion: {debianVersion}")
 
-    for arch in ["x64", "arm64"]:
-        print(f"\nBuilding package for linux-{arch}...\n")
-        preparePackageForArch(arch, debianVersion)
+    # constants are set by driver.py at runtime, hand them to the workers
+    # explicitly rather than relying on the processes being forked.
+    settings = {name: getattr(constants, name) for name in dir(constants) if name.isupper()}
+    buildFolder = os.path.join(constants.DRIVERROOTDIR, constants.BUILDFOLDER)
+    logs = {arch: os.path.join(buildFolder, f"linux-{arch}.log") for arch in ARCHITECTURES}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(ARCHITECTURES)) as executor:
+        futures = {arch: executor.submit(_buildArch, arch, debianVersion, settings, logs[arch])
+                   for arch in ARCHITECTURES}
+        failed = []
+        for arch in ARCHITECTURES:
+            error = futures[arch].exception()
+            print(f"\n{'=' * 38} linux-{arch} {'=' * 38}\n")
+            if os.path.exists(logs[arch]):
+                with open(logs[arch], errors="replace") as f:
+                    sys.stdout.write(f.read())
+            if error is not None:
+                print(f"\nERROR: building package for linux-{arch} failed: {error!r}")
+                failed.append(arch)
+
+    if failed:
+        sys.exit(1)
+
+def _buildArch(arch, debianVersion, settings, logPath):
+    """
+    Worker process entry point: builds the package for one architecture
+    with its stdout and stderr, including the one of subprocesses,
+    redirected to logPath.
+    """
+    for name, value in settings.items():
+        setattr(constants, name, value)
+
+    with _redirectOutput(logPath):
+        try:
+            print(f"\nBuilding package for linux-{arch}...\n")
+            preparePackageForArch(arch, debianVersion)
+        except SystemExit as e:
+            # downloadLinuxZip exits on download errors, report it as a failure
+            # of this architecture instead of killing the worker.
+            raise RuntimeError(f"exited with status {e.code}") from None
+
+@contextlib.contextmanager
+def _redirectOutput(logPath):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(logPath, "w") as log:
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
 
 def preparePackageForArch(arch, debianVersion):
     """
     Prepares and builds a Debian package.
-    This includes setting up directories, copying necessary files,
-    generating SHA256 hashes, and building the final .deb package.
+    The files of the release zip are streamed straight into the package by
+    debWriter, which sets their ownership and modes and computes the md5
+    and sha256 sums on the way; only the shared objects to strip are
+    extracted. All paths are absolute, the working directory is never changed.
     """
     packageFolderName = f"{constants.PACKAGENAME}_{debianVersion}_{arch}"
-    buildFolder = os.path.join(os.getcwd(), constants.BUILDFOLDER, packageFolderName)
-    helper.linuxOutput(buildFolder, arch)
-
-    os.chdir(buildFolder)
-    document = os.path.join("usr", "share", "doc", constants.PACKAGENAME)
-    os.makedirs(document)
-
-    # Copy MIT copyright file
-    print("include MIT copyright")
+    buildFolder = os.path.join(constants.DRIVERROOTDIR, constants.BUILDFOLDER, packageFolderName)
+    debPath = os.path.join(constants.DRIVERROOTDIR, constants.ARTIFACTFOLDER, packageFolderName+".deb")
     scriptDir = os.path.abspath(os.path.dirname(__file__))
-    shutil.copyfile(os.path.join(scriptDir, "copyright"), os.path.join(document, "copyright"))
-
-    # Generate changelog file from template
-    with open(os.path.join(scriptDir, "changelog_template")) as f:
-        stringData = f.read() # read until EOF
-    t = Template(stringData)
-
-    # datetime example: Tue, 06 April 2018 16:32:31
-    time = datetime.datetime.utcnow().strftime("%a, %d %b %Y %X")
-    with open(os.path.join(document, "changelog.Debian"), "w") as f:
+    zipPath = helper.downloadLinuxZip(arch)
+
+    usrlibFunc = f"usr/lib/{constants.PACKAGENAME}"
+    document = f"usr/share/doc/{constants.PACKAGENAME}"
+
+    with zipfile.ZipFile(zipPath) as z, debWriter.DebWriter(debPath, COMPRESSION) as deb:
+        stripped = stripSharedObjects(z, arch, buildFolder)
+
+        # create relative symbolic link under bin directory
+        print("create symlink for func")
+        deb.addSymlink("usr/bin/func", f"../lib/{constants.PACKAGENAME}/func")
+
+        print(f"streaming {zipPath} to {usrlibFunc}")
+        for info in z.infolist():
+            name = _memberName(info)
+            if info.is_dir():
+                deb.addDirectory(f"{usrlibFunc}/{name}")
+                continue
+            # directories 755 and files 644, func is the executable
+            mode = 0o755 if name == "func" else 0o644
+            if info.filename in stripped:
+                path = stripped[info.filename]
+                with open(path, "rb") as f:
+                    deb.addFile(f"{usrlibFunc}/{name}", f, os.path.getsize(path), mode)
+            else:
+                with z.open(info) as f:
+                    deb.addFile(f"{usrlibFunc}/{name}", f, info.file_size, mode)
+
+        # Copy MIT copyright file
+        print("include MIT copyright")
+        with open(os.path.join(scriptDir, "copyright"), "rb") as f:
+            deb.addBytes(f"{document}/copyright", f.read())
+
+        # Generate changelog file from template
+        with open(os.path.join(scriptDir, "changelog_template")) as f:
+            stringData = f.read() # read until EOF
+        t = Template(stringData)
+
+        # datetime example: Tue, 06 April 2018 16:32:31
+        time = datetime.datetime.utcnow().strftime("%a, %d %b %Y %X")
         print(f"writing changelog with date utc: {time}")
-        f.write(t.safe_substitute(DEBIANVERSION=debianVersion, DATETIME=time, VERSION=constants.VERSION, PACKAGENAME=constants.PACKAGENAME))
-
-    # Compress changelog using gzip (by default gzip compress file in place)
-    helper.printReturnOutput(["gzip", "-9", "-n", os.path.join(document, "changelog.Debian")])
-    helper.chmodFolderAndFiles(os.path.join("usr", "share"))
-
-    debian = "DEBIAN"
-    os.makedirs(debian)
-
-    # Generate SHA256 hashes for all files in 'usr/'
-    print("trying to produce sha256 hashes")
-    with open('DEBIAN/sha256sums', 'w') as sha256file:
-        # iterate over all files under 'usr/' & get their sha256sum
-        for dirpath, _, filenames in os.walk('usr'):
-            for f in filenames:
-                filepath = os.path.join(dirpath, f)
-                if not os.path.islink(filepath):
-                    h = helper.produceHashForfile(filepath, 'sha256', Upper=False)
-                    sha256file.write(f"{h}  {filepath}\n")
-
-    # Generate the control file with package dependencies from template
-    deps = []
-    for key, value in constants.LINUXDEPS.items():
-        entry = f"{key} ({value})"
-        deps.append(entry)
-    deps = ','.join(deps)
-    with open(os.path.join(scriptDir, "control_template")) as f:
-        stringData = f.read()
-    t = Template(stringData)
-    with open(os.path.join(debian, "control"), "w") as f:
+        changelog = t.safe_substitute(DEBIANVERSION=debianVersion, DATETIME=time, VERSION=constants.VERSION, PACKAGENAME=constants.PACKAGENAME)
+        # Compress changelog like gzip -9 -n: no name nor timestamp in the header
+        deb.addBytes(f"{document}/changelog.Debian.gz", gzip.compress(changelog.encode(), 9, mtime=0))
+
+        # Generate the control file with package dependencies from template
+        deps = []
+        for key, value in constants.LINUXDEPS.items():
+            entry = f"{key} ({value})"
+            deps.append(entry)
+        deps = ','.join(deps)
+        with open(os.path.join(scriptDir, "control_template")) as f:
+            stringData = f.read()
+        t = Template(stringData)
         if arch == "x64":
             arch = "amd64"
         print("trying to write control file - arch:", arch)
-        f.write(t.safe_substitute(DEBIANVERSION=debianVersion, PACKAGENAME=constants.PACKAGENAME, DEPENDENCY=deps, ARCH=arch))
-    helper.chmodFolderAndFiles(debian)
-
-    # Generate post-install script
-    postinst = ''
-    with open(os.path.join(scriptDir, "postinst_template")) as f:
-        postinst = f.read()
-    with open(os.path.join(debian, "postinst"), "w") as f:
+        deb.addControlFile("control", t.safe_substitute(DEBIANVERSION=debianVersion, PACKAGENAME=constants.PACKAGENAME, DEPENDENCY=deps, ARCH=arch))
+
+        # Generate post-install script
+        # postinstall has to be 0755 in order for it to work.
+        with open(os.path.join(scriptDir, "postinst_template")) as f:
+            postinst = f.read()
         print("trying to write postinst file")
-        f.write(postinst)
+        deb.addControlFile("postinst", postinst, 0o755)
+
+        print(f"writing {debPath}, md5sums and sha256sums are added to the control archive")
 
-    # Ensure post-install script has correct permissions
-    # postinstall has to be 0755 in order for it to work.
-    os.chmod(os.path.join(debian, "postinst"), 0o755)
+    # Check the package is readable by dpkg
+    if shutil.which("dpkg-deb") is not None:
+        output = helper.printReturnOutput(["dpkg-deb", "--info", debPath])
+        assert(f"Package: {constants.PACKAGENAME}\n" in output)
 
-    # Build the Debian package using dpkg-deb
-    os.chdir(constants.DRIVERROOTDIR)
-    output = helper.printReturnOutput(["fakeroot", "dpkg-deb", "--build", "-Zxz",
-                   os.path.join(constants.BUILDFOLDER, packageFolderName), os.path.join(constants.ARTIFACTFOLDER, packageFolderName+".deb")])
-    assert(f"building package '{constants.PACKAGENAME}'" in output)
+def _memberName(info):
+    # same checks as ZipFile.extractall: no absolute paths nor parent references
+    parts = [part for part in info.filename.split("/") if part not in ("", ".")]
+    if info.filename.startswith("/") or ".." in parts:
+        raise ValueError(f"unsafe path in zip: {info.filename}")
+    return "/".join(parts)
+
+def stripSharedObjects(z, arch, buildFolder):
+    """
+    Extract the shared objects of the zip to buildFolder and strip them,
+    return {zip member name: stripped file path}.
+    """
+    stripBinary = "strip"
+    if arch == "arm64":
+        stripBinary = "aarch64-linux-gnu-strip"
+
+    # obj files inside the workers should not be removed as workers like "python"
+    # come with objects necessary for the worker to work.
+    members = [info for info in z.infolist()
+               if not info.is_dir() and info.filename.endswith(".so") and "workers" not in info.filename]
+    stripped = {info.filename: z.extract(info, buildFolder) for info in members}
+    if stripped:
+        helper.printReturnOutput([stripBinary, "--strip-unneeded"] + list(stripped.values()))
+    return stripped
@@ -0,0 +1,201 @@
+#! /usr/bin/env python3
+import io
+import os
+import lzma
+import time
+import shutil
+import tarfile
+import hashlib
+import subprocess
+
+# Writes a .deb without a staging tree, dpkg-deb or fakeroot.
+#
+# A .deb is an ar archive holding, in this order, debian-binary,
+# control.tar.* and data.tar.*. Files are streamed into data.tar through
+# the compressor as they are added, with root ownership and their final
+# mode set in the tar headers, and their md5/sha256 computed on the way.
+# data.tar goes to a temporary file since its size must be known before
+# the ar member header is written.
+
+BUFFERSIZE = 1024 * 1024
+
+# compression: (member suffix, command), the commands use all cores
+COMPRESSORS = {
+    "xz": (".xz", ["xz", "-6", "-T0", "-c"]),
+    "zstd": (".zst", ["zstd", "-3", "-T0", "-c", "-q"]),
+}
+
+class _HashingReader:
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.md5.update(data)
+        self.sha256.update(data)
+        return data
+
+class DebWriter:
+    """
+    Build a .deb at path. Add the files of the package with addDirectory,
+    addFile, addBytes and addSymlink, and the maintainer files with
+    addControlFile; md5sums and sha256sums are added to control.tar on
+    close(). Names are relative to the package root, as in usr/bin/func.
+    Missing parent directories are added with mode 0755.
+    """
+    def __init__(self, path, compression="xz", mtime=None):
+        if compression not in COMPRESSORS:
+            raise NotImplementedError(compression)
+        self.path = path
+        self.compression = compression
+        if mtime is None:
+            mtime = os.environ.get("SOURCE_DATE_EPOCH") or time.time()
+        self.mtime = int(mtime)
+        self._directories = set()
+        self._sums = []
+        self._control = []
+
+        self._dataPath = f"{path}.data.tmp"
+        self._dataFile = open(self._dataPath, "wb")
+        suffix, command = COMPRESSORS[compression]
+        self._dataName = "data.tar" + suffix
+        tool = shutil.which(command[0])
+        if tool is not None:
+            self._process = subprocess.Popen([tool] + command[1:], stdin=subprocess.PIPE,
+                                             stdout=self._dataFile)
+            self._stream = self._process.stdin
+        elif compression == "xz":
+            # single threaded, but needs nothing installed
+            print("xz not found, compressing with the lzma module")
+            self._process = None
+            self._stream = lzma.open(self._dataFile, "wb", preset=6)
+        else:
+            raise RuntimeError(f"{command[0]} is needed to build a {compression} package")
+        self._tar = tarfile.open(fileobj=self._stream, mode="w|", format=tarfile.GNU_FORMAT,
+                                 bufsize=BUFFERSIZE)
+        self._tar.copybufsize = BUFFERSIZE
+        self.addDirectory(".")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        else:
+            self._abort()
+
+    def _tarInfo(self, name, type, mode, size=0):
+        info = tarfile.TarInfo("./" + name if name != "." else ".")
+        info.type = type
+        info.mode = mode
+        info.size = size
+        info.mtime = self.mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = "root"
+        return info
+
+    def _addParents(self, name):
+        parent = os.path.dirname(name)
+        if parent and parent not in self._directories:
+            self.addDirectory(parent)
+
+    def addDirectory(self, name, mode=0o755):
+        name = name.strip("/")
+        if name in self._directories:
+            return
+        self._addParents(name)
+        self._directories.add(name)
+        self._tar.addfile(self._tarInfo(name, tarfile.DIRTYPE, mode))
+
+    def addFile(self, name, fileobj, size, mode=0o644):
+        """Stream size bytes of fileobj into the package as name."""
+        self._addParents(name)
+        reader = _HashingReader(fileobj)
+        self._tar.addfile(self._tarInfo(name, tarfile.REGTYPE, mode, size), reader)
+        self._sums.append((name, reader.md5.hexdigest(), reader.sha256.hexdigest()))
+
+    def addBytes(self, name, data, mode=0o644):
+        self.addFile(name, io.BytesIO(data), len(data), mode)
+
+    def addSymlink(self, name, target):
+        self._addParents(name)
+        info = self._tarInfo(name, tarfile.SYMTYPE, 0o777)
+        info.linkname = target
+        self._tar.addfile(info)
+
+    def addControlFile(self, name, data, mode=0o644):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._control.append((name, data, mode))
+
+    def _finishData(self):
+        self._tar.close()
+        self._stream.close()
+        if self._process is not None:
+            returnCode = self._process.wait()
+            if returnCode != 0:
+                raise RuntimeError(f"{self.compression} exited with status {returnCode}")
+        self._dataFile.close()
+
+    def _controlTar(self):
+        md5sums = "".join(f"{md5}  {name}\n" for name, md5, _ in self._sums)
+        sha256sums = "".join(f"{sha256}  {name}\n" for name, _, sha256 in self._sums)
+        members = self._control + [("md5sums", md5sums.encode(), 0o644),
+                                   ("sha256sums", sha256sums.encode(), 0o644)]
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w", format=tarfile.GNU_FORMAT) as tar:
+            tar.addfile(self._tarInfo(".", tarfile.DIRTYPE, 0o755))
+            for name, data, mode in sorted(members):
+                tar.addfile(self._tarInfo(name, tarfile.REGTYPE, mode, len(data)), io.BytesIO(data))
+        # control.tar is small, the lzma module is enough
+        return lzma.compress(buffer.getvalue(), preset=6)
+
+    def _arHeader(self, name, size):
+        header = (f"{name:<16}{self.mtime:<12}{0:<6}{0:<6}{0o100644:<8o}{size:<10}`\n").encode("ascii")
+        assert len(header) == 60
+        return header
+
+    def close(self):
+        try:
+            self._finishData()
+            control = self._controlTar()
+            dataSize = os.path.getsize(self._dataPath)
+            tmpPath = f"{self.path}.tmp"
+            with open(tmpPath, "wb") as f:
+                f.write(b"!<arch>\n")
+                for name, data in (("debian-binary", b"2.0\n"), ("control.tar.xz", control)):
+                    f.write(self._arHeader(name, len(data)))
+                    f.write(data)
+                    if len(data) % 2:
+                        f.write(b"\n")
+                f.write(self._arHeader(self._dataName, dataSize))
+                with open(self._dataPath, "rb") as data:
+                    shutil.copyfileobj(data, f, BUFFERSIZE)
+                if dataSize % 2:
+                    f.write(b"\n")
+            os.replace(tmpPath, self.path)
+        finally:
+            self._removeData()
+
+    def _abort(self):
+        try:
+            if self._process is not None:
+                self._process.kill()
+            # close the tar stream too, or it is flushed on garbage collection
+            for close in (self._tar.close, self._stream.close):
+                try:
+                    close()
+                except (OSError, ValueError):
+                    pass
+            if self._process is not None:
+                self._process.wait()
+            self._dataFile.close()
+        finally:
+            self._removeData()
+
+    def _removeData(self):
+        if os.path.exists(self._dataPath):
+            os.remove(self._dataPath)
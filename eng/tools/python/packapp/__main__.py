@@ -1,6 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import ast
+import base64
+import concurrent.futures
+import contextlib
+import copy
+import csv
+import fnmatch
+import functools
+import hashlib
+import http.client
+import io
+import itertools
+import json
+import marshal
 import os
 import os.path
 import pathlib
@@ -9,15 +23,35 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import uuid
 import zipfile
 import stat
+import tarfile
+import urllib.parse
+import urllib.request
 
 from enum import IntEnum
 
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11, pip always ships a copy of tomli.
+    from pip._vendor import tomli as tomllib
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
 class Wheel:
     def __init__(self, wheel_path):
         self.wheel_path = wheel_path
         self.filename = os.path.basename(wheel_path)
+        # Bytes extracted by install(), links into a store not included.
+        self.bytes_written = 0
         # Parse wheel filename: {distribution}-{version}(-{build tag})?-{python tag}-{abi tag}-{platform tag}.whl
         parts = self.filename[:-4].split('-')  # Remove .whl extension
         self.name = parts[0]
@@ -31,123 +65,2630 @@ class Wheel:
             self.abi_tag = parts[start_idx + 1] 
             self.platform_tag = parts[start_idx + 2]
     
-    def install(self, paths, maker):
-        """Install wheel contents to specified paths"""
-        with zipfile.ZipFile(self.wheel_path, 'r') as zf:
-            # Extract all files
-            name_ver = f'{self.name}-{self.version}'
-            data_dir = f'{name_ver}.data'
-            info_dir = f'{name_ver}.dist-info'
-            
-            for member in zf.namelist():
-                if member.endswith('/'):
-                    continue  # Skip directories
-                    
-                # Determine destination based on file location in wheel
-                if member.startswith(f'{info_dir}/'):
-                    # Preserve dist-info (entry_points.txt, METADATA, etc.)
-                    # needed by importlib.metadata for entry-point discovery
-                    dest_dir = paths['purelib']
-                    dest_path = os.path.join(dest_dir, member)
-                elif member.startswith(f'{data_dir}/'):
-                    # Handle data files
-                    rel_path = member[len(f'{data_dir}/'):]
-                    if rel_path.startswith('scripts/'):
-                        dest_dir = paths['scripts']
-                        dest_path = os.path.join(dest_dir, rel_path[8:])  # Remove 'scripts/'
-                    elif rel_path.startswith('headers/'):
-                        dest_dir = paths['headers']
-                        dest_path = os.path.join(dest_dir, rel_path[8:])  # Remove 'headers/'
-                    else:
-                        dest_dir = paths['data']
-                        dest_path = os.path.join(dest_dir, rel_path)
+    def read_record(self, zf):
+        """Return {member: (hash, size)} from the wheel's RECORD file."""
+        record = {}
+        for member in zf.namelist():
+            parts = member.split('/')
+            if len(parts) == 2 and parts[0].endswith('.dist-info') \
+                    and parts[1] == 'RECORD':
+                with zf.open(member) as f:
+                    lines = io.TextIOWrapper(f, encoding='utf-8', newline='')
+                    for row in csv.reader(lines):
+                        if row:
+                            record[row[0]] = tuple((row + ['', ''])[1:3])
+                break
+        return record
+
+    def plan(self, zf, paths):
+        """Map wheel members to destination paths.
+
+        Returns a list of (ZipInfo, destination path, is script) for every
+        file in the wheel.
+        """
+        name_ver = f'{self.name}-{self.version}'
+        data_dir = f'{name_ver}.data'
+        info_dir = f'{name_ver}.dist-info'
+
+        plan = []
+        for info in zf.infolist():
+            member = info.filename
+            if member.endswith('/'):
+                continue  # Skip directories
+
+            # Determine destination based on file location in wheel
+            if member.startswith(f'{info_dir}/'):
+                # Preserve dist-info (entry_points.txt, METADATA, etc.)
+                # needed by importlib.metadata for entry-point discovery
+                dest_path = os.path.join(paths['purelib'], member)
+            elif member.startswith(f'{data_dir}/'):
+                # Handle data files
+                rel_path = member[len(f'{data_dir}/'):]
+                if rel_path.startswith('scripts/'):
+                    dest_path = os.path.join(paths['scripts'], rel_path[8:])  # Remove 'scripts/'
+                elif rel_path.startswith('headers/'):
+                    dest_path = os.path.join(paths['headers'], rel_path[8:])  # Remove 'headers/'
                 else:
-                    # Regular package files go to purelib/platlib
-                    dest_dir = paths['purelib']
-                    dest_path = os.path.join(dest_dir, member)
-                
+                    dest_path = os.path.join(paths['data'], rel_path)
+            else:
+                # Regular package files go to purelib/platlib
+                dest_path = os.path.join(paths['purelib'], member)
+
+            is_script = member.startswith(f'{data_dir}/scripts/')
+            plan.append((info, dest_path, is_script))
+
+        return plan
+
+    def install(self, paths, maker, skip=frozenset(), store=None,
+                link_mode='auto'):
+        """Install wheel contents to specified paths
+
+        Every member is hashed while it is written and checked against
+        the wheel's RECORD.  With a store, the wheel is extracted once
+        into the shared store and the destinations are linked to it.
+        Destinations in skip are left to another wheel but still
+        reported.  Returns a list of (destination path, RECORD hash) for
+        every installed file.
+        """
+        installed = []
+        created_dirs = set()
+        with zipfile.ZipFile(self.wheel_path, 'r') as zf:
+            record = self.read_record(zf)
+            tree = self.extract_to_store(zf, record, store) if store else None
+
+            for info, dest_path, is_script in self.plan(zf, paths):
+                installed.append((dest_path, record.get(info.filename, ('', ''))[0]))
+                if dest_path in skip:
+                    continue
+
                 # Create destination directory
+                dest_dir = os.path.dirname(dest_path)
+                if dest_dir not in created_dirs:
+                    os.makedirs(dest_dir, exist_ok=True)
+                    created_dirs.add(dest_dir)
+
+                if tree is not None:
+                    _link_file(os.path.join(tree, info.filename), dest_path,
+                               link_mode)
+                else:
+                    self._extract_member(zf, info, dest_path, record, is_script)
+
+        return installed
+
+    def extract_to_store(self, zf, record, store):
+        """Extract the wheel into a content-addressed store directory.
+
+        Returns the directory holding the wheel members.  The wheel is
+        only extracted if no other run has extracted it already.
+        """
+        tree = os.path.join(store, _file_sha256(self.wheel_path))
+        if os.path.isdir(tree):
+            return tree
+
+        scripts_dir = f'{self.name}-{self.version}.data/scripts/'
+        staging = f'{tree}.{uuid.uuid4().hex}.tmp'
+        try:
+            for info in zf.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                dest_path = os.path.join(staging, info.filename)
                 os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                
-                # Extract file
-                with zf.open(member) as src:
-                    with open(dest_path, 'wb') as dst:
-                        shutil.copyfileobj(src, dst)
-                
-                # Make scripts executable on Unix-like systems
-                if member.startswith(f'{data_dir}/scripts/') and os.name != 'nt':
-                    os.chmod(dest_path, os.stat(dest_path).st_mode | stat.S_IEXEC)
+                self._extract_member(zf, info, dest_path, record,
+                                     info.filename.startswith(scripts_dir))
+            try:
+                os.rename(staging, tree)
+            except OSError:
+                # Another run extracted the same wheel first.
+                if not os.path.isdir(tree):
+                    raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return tree
+
+    def _extract_member(self, zf, info, dest_path, record, is_script):
+        expected_hash, expected_size = record.get(info.filename, ('', ''))
+        algorithm, _, digest = expected_hash.partition('=')
+        hasher = hashlib.new(algorithm) if digest else None
+
+        # Extract file, hashing it in the same pass.  An existing file
+        # may be a hard link into a --link-store, never write through it.
+        _unlink(dest_path)
+        size = 0
+        with zf.open(info) as src, open(dest_path, 'wb') as dst:
+            for chunk in iter(lambda: src.read(1024 * 1024), b''):
+                if hasher is not None:
+                    hasher.update(chunk)
+                dst.write(chunk)
+                size += len(chunk)
+
+            # Make scripts executable on Unix-like systems
+            if os.name != 'nt' and (is_script or
+                                    info.external_attr >> 16 & stat.S_IXUSR):
+                os.fchmod(dst.fileno(), 0o755)
+        self.bytes_written += size
+
+        if hasher is not None and digest != base64.urlsafe_b64encode(
+                hasher.digest()).rstrip(b'=').decode('ascii'):
+            die(f'{self.filename}: hash of {info.filename} does not '
+                f'match its RECORD entry')
+        if expected_size and int(expected_size) != size:
+            die(f'{self.filename}: size of {info.filename} does not '
+                f'match its RECORD entry')
+
+
+class ScriptMaker:    
+    def __init__(self, source_dir, target_dir):
+        self.source_dir = source_dir
+        self.target_dir = target_dir
+
+
+class WheelCache:
+    """Persistent wheel cache shared between packapp runs.
+
+    Wheels are stored under their own filename, which encodes the
+    (name, version, python tag, abi tag, platform tag) key, in one
+    directory per project.  A hit bumps the wheel's mtime, and evict()
+    drops the least recently used wheels once the cache grows beyond
+    max_size bytes.  New entries are written to a temporary file and
+    renamed into place, so several processes can share one cache.
+    """
+
+    def __init__(self, root, max_size):
+        self.root = pathlib.Path(root)
+        self.wheels = self.root / 'wheels'
+        self.stripped = self.root / 'stripped'
+        self.built = self.root / 'built'
+        self.max_size = max_size
+
+    def _project_dir(self, name):
+        return self.wheels / _escape_name(name)
+
+    def find(self, name, version, args):
+        """Return the path of a cached wheel usable for the target, or None."""
+        project_dir = self._project_dir(name)
+        try:
+            filenames = os.listdir(project_dir)
+        except FileNotFoundError:
+            return None
+
+        candidates = [filename for filename in filenames
+                      if filename.endswith('.whl')
+                      and Wheel(filename).version == version]
+        best = select_wheel(candidates, args)
+        if best is None:
+            return None
+
+        path = project_dir / best
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by a concurrent run.
+            return None
+        return str(path)
+
+    def find_file(self, name, filename):
+        """Return the path of the cached wheel filename, or None."""
+        path = self._project_dir(name) / filename
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return str(path)
+
+    def add(self, wheel_path):
+        project_dir = self._project_dir(Wheel(wheel_path).name)
+        os.makedirs(project_dir, exist_ok=True)
+        tmp_path = project_dir / f'.{uuid.uuid4().hex}.tmp'
+        shutil.copyfile(wheel_path, tmp_path)
+        os.replace(tmp_path, project_dir / os.path.basename(wheel_path))
+
+    def find_stripped(self, digest):
+        """Return the stripped copy of a native library, or None."""
+        path = self.stripped / digest
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add_stripped(self, digest, path):
+        os.makedirs(self.stripped, exist_ok=True)
+        tmp_path = self.stripped / f'.{uuid.uuid4().hex}.tmp'
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, self.stripped / digest)
+
+    def find_built(self, digest):
+        """Return the universal wheel built from an sdist, or None."""
+        try:
+            filenames = os.listdir(self.built / digest)
+        except FileNotFoundError:
+            return None
+        for filename in filenames:
+            if filename.endswith('.whl'):
+                path = self.built / digest / filename
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    return None
+                return path
+        return None
+
+    def add_built(self, digest, wheel_path):
+        built_dir = self.built / digest
+        os.makedirs(built_dir, exist_ok=True)
+        tmp_path = built_dir / f'.{uuid.uuid4().hex}.tmp'
+        shutil.copyfile(wheel_path, tmp_path)
+        os.replace(tmp_path, built_dir / os.path.basename(wheel_path))
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, _, files in itertools.chain(os.walk(self.wheels),
+                                              os.walk(self.stripped),
+                                              os.walk(self.built)):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if file.endswith('.tmp') and st.st_mtime > time.time() - 3600:
+                    # Probably still being written by another run.
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_wheel_file_pattern = r"""
+    ^{namever}
+    ((-(?P<build>\d[^-]*?))?-(?P<pyver>.+?)-(?P<abi>.+?)-(?P<plat>.+?)
+    \.whl)$
+"""
+
+class WheelhouseIndex:
+    """Name/version/tag index of a local wheelhouse directory.
+
+    The index is persisted next to the wheels.  It is only brought up to
+    date when the directory's mtime changed, i.e. when files were added
+    or removed, and then only the new file names are parsed, so lookups
+    never rescan the wheelhouse.
+    """
+
+    index_name = '.packapp-index.json'
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.projects = {}
+        self._load()
+
+    def _load(self):
+        index_path = self.root / self.index_name
+        try:
+            with open(index_path, encoding='utf-8') as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {'version': 1, 'mtime_ns': None, 'files': {}}
+
+        mtime_ns = os.stat(self.root).st_mtime_ns
+        if index.get('version') != 1 or index['mtime_ns'] != mtime_ns:
+            files = {}
+            for filename in os.listdir(self.root):
+                if filename.endswith('.whl'):
+                    entry = index['files'].get(filename)
+                    if entry is None:
+                        wheel = Wheel(filename)
+                        entry = {'name': _canonical_name(wheel.name),
+                                 'version': wheel.version}
+                    files[filename] = entry
+            index = {'version': 1, 'mtime_ns': mtime_ns, 'files': files}
+            self._save(index)
+
+        for filename, entry in index['files'].items():
+            key = (entry['name'], entry['version'])
+            self.projects.setdefault(key, []).append(filename)
+
+    def _save(self, index):
+        index_path = self.root / self.index_name
+        tmp_path = index_path.with_name(f'.{uuid.uuid4().hex}.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, index_path)
+            # Creating the index changed the directory mtime.  Record the
+            # new one, rewriting the file in place so that the directory
+            # itself is not modified again.
+            index['mtime_ns'] = os.stat(self.root).st_mtime_ns
+            with open(index_path, 'w', encoding='utf-8') as f:
+                json.dump(index, f, indent=1, sort_keys=True)
+        except OSError:
+            # A read-only wheelhouse still works, it is just indexed on
+            # every run.
+            pass
+
+    def find(self, name, version, args):
+        """Return the path of the best wheel for the target, or None."""
+        filenames = self.projects.get((_canonical_name(name), version), [])
+        best = select_wheel(filenames, args)
+        return str(self.root / best) if best is not None else None
+
+
+class BuildEnvPool:
+    """Warm environments to build sdists in, keyed by build requirements.
+
+    Each environment is a venv with the build-system requirements of a
+    pyproject.toml installed.  Sdists with the same requirements are
+    built in the same environment without build isolation, so the build
+    backend is installed once instead of once per package.  New
+    environments are created in a temporary directory and renamed into
+    place, so several processes can share the pool.
+    """
+
+    ready_name = '.packapp-ready'
+
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    @staticmethod
+    def _python(env):
+        if os.name == 'nt':
+            return env / 'Scripts' / 'python.exe'
+        return env / 'bin' / 'python'
+
+    def get(self, requires, args):
+        """Return the Python of an environment with requires installed,
+        or None if it cannot be created."""
+        key = hashlib.sha256('\n'.join(requires).encode()).hexdigest()[:16]
+        env = self.root / key
+        with self._lock(key):
+            if (env / self.ready_name).exists():
+                os.utime(env / self.ready_name)
+                return str(self._python(env))
+
+            log(f'Creating build environment for {", ".join(requires)}')
+            os.makedirs(self.root, exist_ok=True)
+            staging = self.root / f'{key}.{uuid.uuid4().hex}.tmp'
+            try:
+                # Only ever run with "python -m", so the environment can
+                # be renamed after its creation.
+                venv = run([sys.executable, '-m', 'venv', str(staging)])
+                if venv.returncode != 0:
+                    return None
+                python = str(self._python(staging))
+                pip = run([python, '-m', 'pip', 'install', '--quiet',
+                           *_pip_index_args(args), *requires])
+                if pip.returncode != 0:
+                    return None
+                with open(staging / self.ready_name, 'w') as f:
+                    json.dump({'requires': requires}, f)
+                try:
+                    os.rename(staging, env)
+                except OSError:
+                    # Another run created the same environment first.
+                    if not (env / self.ready_name).exists():
+                        raise
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            return str(self._python(env))
+
+
+class PackageIndex:
+    """In-process client for a PEP 503/691 simple package index.
+
+    One instance is shared by all fetch workers.  HTTP connections are
+    kept alive and pooled per host, so fetching many packages costs
+    neither a pip process nor a TLS handshake per package.  A file:// URL
+    points at a local directory laid out like a simple index, either
+    with an index.html per project or with the files themselves.
+    """
+
+    json_type = 'application/vnd.pypi.simple.v1+json'
+
+    def __init__(self, url=None):
+        # Without an explicit URL, the index is the one pip is configured
+        # with, looked up on first use.
+        self.url = url
+        self._usable = None
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def usable(self):
+        """Return whether every package can be looked up here.
+
+        When pip is configured with other sources, such as extra index
+        URLs, it may take a package from any of them.  The index alone
+        then does not see what pip would install, and a same-named
+        project on it must not be used instead: packapp falls back to
+        pip.
+        """
+        with self._lock:
+            if self._usable is None:
+                index_url, others = _pip_index_config()
+                if others:
+                    log(f'pip is configured with {", ".join(others)}, '
+                        f'downloading through pip')
+                    self._usable = False
+                else:
+                    url = self.url or index_url or 'https://pypi.org/simple/'
+                    self.url = url if url.endswith('/') else url + '/'
+                    self._usable = True
+            return self._usable
+
+    def files(self, name):
+        """Return [(filename, url, sha256 or None)] for a project."""
+        key = _canonical_name(name)
+        with self._lock:
+            if key in self._pages:
+                return self._pages[key]
+
+        url = urllib.parse.urljoin(self.url, f'{key}/')
+        if url.startswith('file:'):
+            files = self._local_files(url)
+        else:
+            url, content_type, page = self._get(url, {
+                'Accept': f'{self.json_type}, text/html;q=0.1'})
+            files = self._parse_page(url, content_type, page.decode('utf-8'))
+
+        with self._lock:
+            self._pages[key] = files
+        return files
+
+    def download(self, url, sha256, dest):
+        """Download url into the dest directory, checking its sha256.
+        Returns the path of the downloaded file."""
+        filename = urllib.parse.unquote(
+            urllib.parse.urlsplit(url).path.rsplit('/', 1)[-1])
+        path = os.path.join(dest, filename)
+        log(f'Downloading {url}')
+        if url.startswith('file:'):
+            shutil.copyfile(urllib.request.url2pathname(
+                urllib.parse.urlsplit(url).path), path)
+        else:
+            with open(path, 'wb') as f:
+                self._get(url, {}, f)
+        if sha256 is not None and _file_sha256(path) != sha256:
+            die(f'{filename}: hash does not match the index')
+        return path
+
+    def _local_files(self, url):
+        project_dir = pathlib.Path(urllib.request.url2pathname(
+            urllib.parse.urlsplit(url).path))
+        index_html = project_dir / 'index.html'
+        if index_html.exists():
+            return self._parse_page(index_html.as_uri(), 'text/html',
+                                    index_html.read_text(encoding='utf-8'))
+        return [(path.name, path.as_uri(), None)
+                for path in sorted(project_dir.iterdir()) if path.is_file()]
+
+    def _parse_page(self, url, content_type, page):
+        if content_type == self.json_type:
+            return [(f['filename'], urllib.parse.urljoin(url, f['url']),
+                     f.get('hashes', {}).get('sha256'))
+                    for f in json.loads(page)['files']]
+
+        files = []
+        for href, filename in re.findall(
+                r'<a\s[^>]*href="([^"]+)"[^>]*>([^<]+)</a>', page):
+            href, _, fragment = href.replace('&amp;', '&').partition('#')
+            algorithm, _, digest = fragment.partition('=')
+            files.append((filename.strip(), urllib.parse.urljoin(url, href),
+                          digest if algorithm == 'sha256' else None))
+        return files
+
+    def _get(self, url, headers, stream=None):
+        # GET url, following redirects.  The body is written to stream if
+        # given, else returned.  Returns (final url, content type, body).
+        for _ in range(10):
+            parts = urllib.parse.urlsplit(url)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+
+            conn, response = self._send(parts.scheme, parts.netloc, target,
+                                        headers)
+            try:
+                if response.status in (301, 302, 303, 307, 308):
+                    response.read()
+                    url = urllib.parse.urljoin(url,
+                                               response.getheader('Location'))
+                    continue
+                if response.status != 200:
+                    response.read()
+                    raise OSError(f'GET {url} failed with HTTP status '
+                                  f'{response.status}')
+                if stream is None:
+                    body = response.read()
+                else:
+                    body = None
+                    shutil.copyfileobj(response, stream, 1024 * 1024)
+            except BaseException:
+                conn.close()
+                raise
+            self._release(parts.scheme, parts.netloc, conn, response)
+            return url, response.headers.get_content_type(), body
+        raise OSError(f'GET {url}: too many redirects')
+
+    def _send(self, scheme, netloc, target, headers):
+        # Anything beyond plain HTTP(S) is left to pip.
+        if scheme not in ('http', 'https'):
+            raise OSError(f'unsupported URL scheme {scheme}')
+        if '@' in netloc:
+            raise OSError('index credentials are only supported by pip')
+        if scheme in urllib.request.getproxies():
+            raise OSError('proxies are only supported by pip')
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            conn = idle.pop() if idle else None
+
+        if conn is not None:
+            # The server may have closed an idle connection, in which
+            # case the request is sent again on a new one.
+            try:
+                conn.request('GET', target, headers=headers)
+                return conn, conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(netloc, timeout=60)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=60)
+        try:
+            conn.request('GET', target, headers=headers)
+            return conn, conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+
+    def _release(self, scheme, netloc, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+
+# ioctl request to clone a file on Linux filesystems with reflink
+# support (btrfs, xfs, ...), see ioctl_ficlone(2).
+_FICLONE = 0x40049409
+
+
+def _reflink(src, dst):
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fail = True
+        else:
+            fail = False
+    if fail:
+        os.remove(dst)
+        return False
+    shutil.copymode(src, dst)
+    return True
+
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _link_file(src, dst, mode):
+    """Populate dst from src with a hard link, a reflink or a copy.
+
+    The 'clone' mode, used with the temporary store of a multi-app run,
+    never shares the inode: a reflink if possible, else a copy.
+    """
+    _unlink(dst)
+
+    if mode in ('auto', 'hardlink'):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            if mode == 'hardlink':
+                raise
+
+    if mode in ('auto', 'reflink', 'clone'):
+        if _reflink(src, dst):
+            return
+        if mode == 'reflink':
+            die(f'cannot reflink {src}: not supported by the filesystem')
+
+    shutil.copy(src, dst)
+
+
+def _escape_name(name):
+    # Project name as it appears in wheel filenames (PEP 427 / PEP 503).
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def _canonical_name(name):
+    # PEP 503 normalized project name.
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _parse_python_version(pyver):
+    # Accept both the '311' form passed by func and the dotted '3.11' form.
+    if '.' in pyver:
+        major, minor = pyver.split('.')[:2]
+    else:
+        major, minor = pyver[0], pyver[1:]
+    return int(major), int(minor)
+
+
+# Legacy aliases of manylinux_2_X platform tags (PEP 600).
+_legacy_manylinux = {
+    (2, 17): 'manylinux2014',
+    (2, 12): 'manylinux2010',
+    (2, 5): 'manylinux1',
+}
+
+
+def platform_tags(args):
+    """Return the platform tags of the target, most preferred first."""
+    if args.platform == 'windows':
+        return ['win_amd64']
+    if args.platform != 'linux':
+        die(f'unsupported platform: {args.platform}')
+
+    arch = 'x86_64'
+    glibc_major, glibc_minor = _parse_python_version(args.manylinux_glibc)
+    tags = []
+    for minor in range(glibc_minor, 4, -1):
+        tags.append(f'manylinux_{glibc_major}_{minor}_{arch}')
+        legacy = _legacy_manylinux.get((glibc_major, minor))
+        if legacy:
+            tags.append(f'{legacy}_{arch}')
+    return tags
+
+
+@functools.lru_cache(maxsize=None)
+def _supported_tags(platform, python_version, manylinux_glibc):
+    """Return the (python, abi, platform) tags the target supports.
+
+    The order follows the one pip uses for CPython: the exact ABI, then
+    the stable ABI of this and older versions, then ABI independent
+    platform wheels and finally pure Python wheels.
+    """
+    args = argparse.Namespace(platform=platform,
+                              python_version=python_version,
+                              manylinux_glibc=manylinux_glibc)
+    major, minor = _parse_python_version(python_version)
+    cp = f'cp{major}{minor}'
+    platforms = platform_tags(args)
+
+    tags = []
+    tags += [(cp, cp, plat) for plat in platforms]
+    tags += [(cp, 'abi3', plat) for plat in platforms]
+    tags += [(cp, 'none', plat) for plat in platforms]
+    for older in range(minor - 1, 1, -1):
+        tags += [(f'cp{major}{older}', 'abi3', plat) for plat in platforms]
+
+    pythons = [f'py{major}{minor}', f'py{major}'] + \
+        [f'py{major}{older}' for older in range(minor - 1, -1, -1)]
+    for py in pythons:
+        tags += [(py, 'none', plat) for plat in platforms]
+    tags.append((cp, 'none', 'any'))
+    tags += [(py, 'none', 'any') for py in pythons]
+    return tuple(tags)
+
+
+@functools.lru_cache(maxsize=None)
+def _tag_ranks(platform, python_version, manylinux_glibc):
+    tags = _supported_tags(platform, python_version, manylinux_glibc)
+    return {tag: rank for rank, tag in enumerate(tags)}
+
+
+def wheel_rank(wheel, args):
+    """Return the rank of the wheel's best supported tag, lower is
+    better, or None if the wheel cannot be installed on the target."""
+    if not hasattr(wheel, 'platform_tag'):
+        return None  # Not a valid wheel filename.
+    ranks = _tag_ranks(args.platform, args.python_version, args.manylinux_glibc)
+    # A wheel filename can carry compressed tag sets, e.g. py2.py3.
+    candidates = [ranks.get((py, abi, plat))
+                  for py in wheel.python_tag.split('.')
+                  for abi in wheel.abi_tag.split('.')
+                  for plat in wheel.platform_tag.split('.')]
+    candidates = [rank for rank in candidates if rank is not None]
+    return min(candidates) if candidates else None
+
+
+def select_wheel(filenames, args):
+    """Return the best wheel filename for the target, or None."""
+    return _select_wheel(tuple(sorted(filenames)), args.platform,
+                         args.python_version, args.manylinux_glibc)
+
+
+@functools.lru_cache(maxsize=4096)
+def _select_wheel(filenames, platform, python_version, manylinux_glibc):
+    args = argparse.Namespace(platform=platform,
+                              python_version=python_version,
+                              manylinux_glibc=manylinux_glibc)
+    ranked = []
+    for filename in filenames:
+        rank = wheel_rank(Wheel(filename), args)
+        if rank is not None:
+            ranked.append((rank, filename))
+    return min(ranked)[1] if ranked else None
+
+
+def _parse_size(value):
+    units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    m = re.match(r'^\s*(\d+)\s*([kmg]?)i?b?\s*$', value, re.IGNORECASE)
+    if not m:
+        raise argparse.ArgumentTypeError(f'invalid size: {value}')
+    return int(m.group(1)) * units[m.group(2).lower()]
+
+
+def _parse_levels(value):
+    try:
+        levels = sorted({int(level) for level in value.split(',')})
+    except ValueError:
+        levels = None
+    if not levels or not set(levels) <= {0, 1, 2}:
+        raise argparse.ArgumentTypeError(f'invalid optimization levels: {value}')
+    return levels
+
+
+def _default_cache_dir():
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'azure-functions-core-tools', 'packapp')
+
+
+class ExitCode(IntEnum):
+    success = 0
+    general_error = 1
+    native_deps_error = 4
+
+
+def die(msg, exitcode=ExitCode.general_error):
+    print(f'ERROR: {msg}', file=sys.stderr)
+    sys.exit(int(exitcode))
+
+
+# Per-thread output buffer used by run_parallel() to keep the log of
+# concurrently processed packages in a deterministic order.
+_output = threading.local()
+
+
+def log(*args, **kwargs):
+    buffer = getattr(_output, 'buffer', None)
+    if buffer is not None:
+        kwargs['file'] = buffer
+    print(*args, **kwargs)
+
+
+class Tracer:
+    """Collect timed spans as Chrome trace events.
+
+    Spans are recorded from any thread; nothing is recorded unless the
+    tracer is enabled with --trace.  export() writes the trace and a
+    summary of it, see summarize().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category='phase', **span_args):
+        """Time the enclosed block.  Yields a dict of span arguments
+        that the block can add to."""
+        if not self.enabled:
+            yield span_args
+            return
+
+        started = time.perf_counter()
+        try:
+            yield span_args
+        finally:
+            self.add(name, category, started, time.perf_counter(), span_args)
+
+    def add(self, name, category, started, finished, span_args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': round((started - self._origin) * 1e6),
+            'dur': round((finished - started) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': span_args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def summarize(self):
+        wall = time.perf_counter() - self._origin
+        phases = {}
+        packages = {}
+        processes = {'count': 0, 'wall': 0.0, 'user': 0.0, 'system': 0.0}
+        for event in self.events:
+            seconds = event['dur'] / 1e6
+            category = event['cat']
+            if category == 'phase':
+                phases[event['name']] = phases.get(event['name'], 0.0) + seconds
+            elif category in ('fetch', 'install'):
+                key = _canonical_name(event['name'])
+                if 'target' in event['args']:
+                    key = f'{key} ({event["args"]["target"]})'
+                entry = packages.setdefault(key, {})
+                entry[category] = seconds
+                entry.update(event['args'])
+            elif category == 'process':
+                processes['count'] += 1
+                processes['wall'] += seconds
+                processes['user'] += event['args'].get('user', 0.0)
+                processes['system'] += event['args'].get('system', 0.0)
+
+        summary = {
+            'wall': wall,
+            'phases': phases,
+            'packages': packages,
+            'processes': processes,
+        }
+        if resource is not None:
+            own = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            summary['cpu'] = {'user': own.ru_utime, 'system': own.ru_stime}
+            summary['peak_rss'] = {'self': _maxrss_bytes(own),
+                                   'children': _maxrss_bytes(children)}
+        return summary
+
+    def export(self, path):
+        """Write the trace to path and its summary next to it."""
+        path = pathlib.Path(path)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, f)
+        summary_path = path.with_name(f'{path.stem}.summary.json')
+        with open(summary_path, 'w', encoding='utf-8') as f:
+            json.dump(self.summarize(), f, indent=1, sort_keys=True)
+        print(f'Wrote trace to {path} and its summary to {summary_path}')
+
+
+_tracer = Tracer()
+
+
+def _maxrss_bytes(usage):
+    # ru_maxrss is in kilobytes, except on macOS.
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss
+    return usage.ru_maxrss * 1024
+
+
+def _run_child(cmd, stdin, stdout, stderr, input=None, **kwargs):
+    # subprocess.run(), plus the resource usage of the child as reported
+    # by wait4().
+    output = {}
+
+    def drain(key, stream):
+        output[key] = stream.read()
+
+    with subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr,
+                          **kwargs) as proc:
+        readers = [threading.Thread(target=drain, args=(key, stream))
+                   for key, stream in (('stdout', proc.stdout),
+                                       ('stderr', proc.stderr))
+                   if stream is not None]
+        for reader in readers:
+            reader.start()
+        if proc.stdin is not None:
+            try:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        for reader in readers:
+            reader.join()
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+    completed = subprocess.CompletedProcess(
+        cmd, proc.returncode, output.get('stdout'), output.get('stderr'))
+    return completed, usage
+
+
+def run(cmd, *, verbose=False, **kwargs):
+    buffered = getattr(_output, 'buffer', None) is not None
+    if verbose and not buffered:
+        stdout = stderr = None
+    else:
+        stdout = stderr = subprocess.PIPE
+
+    log(' '.join(cmd))
+    if not _tracer.enabled or not hasattr(os, 'wait4'):
+        proc = subprocess.run(cmd, stdout=stdout, stderr=stderr, **kwargs)
+    else:
+        check = kwargs.pop('check', False)
+        stdin = subprocess.PIPE if 'input' in kwargs else None
+        with _tracer.span(os.path.basename(cmd[0]), 'process',
+                          cmd=' '.join(cmd)) as span:
+            proc, usage = _run_child(cmd, stdin, stdout, stderr, **kwargs)
+            span.update(returncode=proc.returncode, user=usage.ru_utime,
+                        system=usage.ru_stime, peak_rss=_maxrss_bytes(usage))
+        if check:
+            proc.check_returncode()
+    if verbose and buffered:
+        # Child output cannot go straight to the console without
+        # interleaving with other workers, replay it from the buffer.
+        for stream in (proc.stdout, proc.stderr):
+            if stream:
+                log(stream.decode(errors='replace'), end='')
+    return proc
+
+
+def run_or_die(cmd, *, verbose=False, **kwargs):
+    try:
+        run(cmd, verbose=verbose, check=True, **kwargs)
+    except subprocess.CalledProcessError as e:
+        die(f'{cmd} failed with exit code {e.returncode}')
+
+
+def run_parallel(func, items, jobs):
+    """Call func on every item using up to jobs worker threads.
+
+    Output logged by each call is buffered and replayed in item order,
+    so the log reads the same as a serial run.  The first failure,
+    including die(), cancels the work that has not started yet and is
+    re-raised once the output preceding it has been replayed.
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    buffers = [io.StringIO() for _ in items]
+
+    def task(index):
+        _output.buffer = buffers[index]
+        try:
+            return func(items[index])
+        finally:
+            _output.buffer = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(task, i) for i in range(len(items))]
+
+        def cancel_pending(future):
+            if not future.cancelled() and future.exception() is not None:
+                for f in futures:
+                    f.cancel()
+
+        for future in futures:
+            future.add_done_callback(cancel_pending)
+
+        results = []
+        for buffer, future in zip(buffers, futures):
+            if future.cancelled():
+                break
+            exc = future.exception()
+            log(buffer.getvalue(), end='')
+            if exc is not None:
+                raise exc
+            results.append(future.result())
+        else:
+            return results
+
+        # A later item failed and cancelled this one.
+        for buffer, future in zip(buffers, futures):
+            if future.done() and not future.cancelled() \
+                    and future.exception() is not None:
+                log(buffer.getvalue(), end='')
+                raise future.exception()
+
+
+def main(argv=sys.argv[1:]):
+    if argv and argv[0] == 'profile-imports':
+        profile_imports(parse_profile_args(argv[1:]))
+        return
+
+    args = parse_args(argv)
+    if args.trace:
+        _tracer.enabled = True
+    try:
+        if not args.no_deps:
+            with _tracer.span('packapp'):
+                find_and_build_deps(args)
+    finally:
+        if args.trace:
+            _tracer.export(args.trace)
+
+
+class TargetPlan:
+    """What has to be done for one (platform, Python version) target of
+    an app."""
+
+    def __init__(self, args, app_path, name, manifest, locked, up_to_date):
+        self.args = args
+        self.app_path = app_path
+        self.packages_dir = app_path / args.packages_dir_name
+        # How the packages directory is referred to in the log.
+        self.name = name
+        self.manifest = manifest
+        # Lock file entries of this target, by canonical project name.
+        self.locked = locked
+        # The sorted (name, version) pins of the target.
+        self.resolved = None
+        # Installed and current, only planned to complete the lock file.
+        self.up_to_date = up_to_date
+        self.packages = []
+        self.removed = []
+        # Packages only fetched to record them in the lock file.
+        self.lock_only = []
+        self.wheel_dir = None
+        self.lock_dir = None
+
+    def diff(self, lock):
+        # With a manifest from a previous run, only packages whose pins
+        # changed need to be fetched and (re)installed.
+        packages = self.resolved
+        installed = {}
+        if self.manifest is not None:
+            installed = self.manifest['packages']
+        pins = {_canonical_name(name): ver for name, ver in packages}
+        if not self.up_to_date:
+            self.removed = sorted(key for key, entry in installed.items()
+                                  if pins.get(key) != entry['version'])
+            self.packages = [
+                (name, ver) for name, ver in packages
+                if installed.get(_canonical_name(name), {}).get('version') != ver]
+            if self.manifest is not None:
+                log(f'{self.name}: {len(self.packages)} '
+                    f'package(s) to install, {len(self.removed)} to remove, '
+                    f'{len(pins) - len(self.packages)} unchanged')
+
+        if lock:
+            # Installed packages the lock file has no wheel for are
+            # fetched again to record theirs.
+            self.lock_only = [
+                (name, ver) for name, ver in packages
+                if (name, ver) not in self.packages
+                and self.locked.get(_canonical_name(name), {}).get('version') != ver]
+
+    def install(self, req_hash):
+        target = self.args
+        if target.install_mode == 'copy':
+            install_via_venv(self.wheel_dir, self.app_path, target)
+        elif self.manifest is not None:
+            update_in_place(self.wheel_dir, self.packages_dir, self.manifest,
+                            self.removed, req_hash, target)
+        else:
+            install_direct(self.wheel_dir, self.packages_dir, req_hash,
+                           target)
+
+
+class AppPlan:
+    """The targets of one function app that need packing."""
+
+    def __init__(self, path, args):
+        self.path = pathlib.Path(path)
+        self.req_txt = self.path / 'requirements.txt'
+        if not self.req_txt.exists():
+            die(f'missing requirements.txt file in {path}.  '
+                'If you do not have any requirements, please pass --no-deps.')
+        self.req_hash = _file_sha256(self.req_txt)
+
+        self.lock = None
+        self.lock_path = self.path / args.lock_file if args.lock else None
+        if self.lock_path is not None:
+            self.lock = load_lock(self.lock_path)
+        # A lock file written for other requirements only provides the
+        # wheels of the pins that did not change.
+        self.fresh = self.lock is not None and \
+            self.lock['requirements_sha256'] == self.req_hash
+
+        self.targets = []
+        for target in args.targets:
+            target = copy.copy(target)
+            target.path = str(self.path)
+            name = target.packages_dir_name
+            if len(args.path) > 1:
+                name = str(self.path / name)
+
+            locked = {}
+            if self.lock is not None:
+                locked = self.lock['targets'].get(_lock_target(target), {})
+            manifest = None
+            up_to_date = False
+            if target.install_mode == 'direct' and target.incremental:
+                manifest = load_manifest(self.path / target.packages_dir_name,
+                                         target)
+                if manifest is not None and \
+                        manifest['requirements_sha256'] == self.req_hash:
+                    log(f'{name} is up to date with requirements.txt')
+                    if self.lock_path is None or (self.fresh and locked):
+                        continue
+                    up_to_date = True
+                elif target.layout == 'archive':
+                    # The archive cannot be patched in place, rebuild it.
+                    manifest = None
+            self.targets.append(TargetPlan(target, self.path, name, manifest,
+                                           locked, up_to_date))
+
+    def resolution_key(self):
+        # Apps with the same requirements share their resolution, unless
+        # the requirements refer to files relative to the app.
+        with open(self.req_txt, encoding='utf-8') as f:
+            local = any(re.match(r'\s*(-[rce]|--(requirement|constraint|'
+                                 r'editable)|\.|/|file:)', line)
+                        for line in f)
+        return (self.req_hash, str(self.path.resolve()) if local else None)
+
+
+def find_and_build_deps(args):
+    apps = [app for app in (AppPlan(path, args) for path in args.path)
+            if app.targets]
+    if not apps:
+        return
+
+    # First, we need to figure out the complete list of dependencies
+    # without actually installing them.  Environment markers depend on
+    # the platform and Python version, so each target is resolved on
+    # its own, once for all apps with the same requirements.
+    unresolved = {}
+    for app in apps:
+        for plan in app.targets:
+            target = _lock_target(plan.args)
+            if app.fresh and target in app.lock['packages']:
+                # requirements.txt did not change since the lock file
+                # was written, so its pins are the resolution.
+                plan.resolved = sorted(app.lock['packages'][target].items())
+                log(f'{plan.name}: using the pins of {app.lock_path}')
+            else:
+                key = (app.resolution_key(), target)
+                unresolved.setdefault(key, []).append((app, plan))
+
+    def resolve(group):
+        app, plan = group[0]
+        with _tracer.span('resolve', target=_lock_target(plan.args)) as span:
+            packages = resolve_packages(app.req_txt, plan.args)
+            span['packages'] = len(packages)
+        for _, plan in group:
+            plan.resolved = packages
+
+    run_parallel(resolve, unresolved.values(), args.jobs)
+
+    plans = []
+    for app in apps:
+        for plan in app.targets:
+            plan.diff(app.lock_path is not None)
+            plans.append(plan)
+
+    # Now that we know all dependencies, download or build wheels
+    # for them for the correct platform and Python version.
+    with tempfile.TemporaryDirectory(prefix='azureworker') as td:
+        for index, plan in enumerate(plans):
+            plan.wheel_dir = os.path.join(td, str(index))
+            plan.lock_dir = os.path.join(td, f'{index}.lock')
+            os.mkdir(plan.wheel_dir)
+            os.mkdir(plan.lock_dir)
+
+        with _tracer.span('fetch'):
+            fetch_wheels(plans, args)
+
+        if args.wheel_cache is not None:
+            with _tracer.span('evict'):
+                args.wheel_cache.evict()
+
+        def install(app):
+            # The targets of an app are installed one after the other.
+            for plan in app.targets:
+                if not plan.up_to_date:
+                    if len(plans) > 1:
+                        log(f'Installing packages into {plan.name}')
+                    plan.install(app.req_hash)
+
+        # Each app gets its own copy of its files unless a --link-store
+        # is given: linked apps share inodes, so a change to one app's
+        # files is seen by every other app linked to the same store.
+        # Without one, several apps are still populated from a single
+        # extraction of every wheel, with reflinks or copies.
+        store = None
+        if len(apps) > 1 and args.link_store is None:
+            store = tempfile.mkdtemp(prefix='.packapp-store-',
+                                     dir=apps[0].path.parent)
+            for plan in plans:
+                plan.args.link_store = store
+                plan.args.link_mode = 'clone'
+        try:
+            run_parallel(install, apps, args.jobs)
+        finally:
+            if store is not None:
+                shutil.rmtree(store, ignore_errors=True)
+
+        for app in apps:
+            if app.lock_path is not None:
+                write_lock(app.lock_path, app.lock if app.fresh else None,
+                           app.req_hash, app.targets)
+
+
+def fetch_wheels(plans, args):
+    """Fetch the wheels of every target into its wheel_dir.
+
+    Each package is fetched once, for the first target that needs it.
+    The wheel is then shared with the other targets it can be installed
+    on, e.g. when it is pure Python, and only the remaining targets fetch
+    their own wheel.  Packages in the lock file are fetched as locked.
+    """
+    multiple = len(args.targets) > 1
+
+    def fetch(item):
+        plan, (name, version), dest = item
+        span_args = {'version': version}
+        if multiple:
+            span_args['target'] = (f'{plan.args.platform}-'
+                                   f'{plan.args.python_version}')
+        entry = plan.locked.get(_canonical_name(name))
+        with _tracer.span(name, 'fetch', **span_args) as span:
+            if entry is not None and entry['version'] == version:
+                span['source'] = ensure_locked_wheel(
+                    name, version, entry['wheel'], entry['sha256'],
+                    plan.args, dest)
+            else:
+                span['source'] = ensure_wheel(name, version, args=plan.args,
+                                              dest=dest)
+
+    items = [(plan, package, plan.wheel_dir)
+             for plan in plans for package in plan.packages]
+    items += [(plan, package, plan.lock_dir)
+              for plan in plans for package in plan.lock_only]
+
+    first = {}
+    for item in items:
+        first.setdefault(item[1], item)
+    run_parallel(fetch, first.values(), args.jobs)
+
+    fetched = {}
+    for _, package, dest in first.values():
+        wheel = _find_fetched(dest, *package)
+        if wheel is not None:
+            fetched[package] = wheel
+
+    remaining = []
+    for item in items:
+        plan, package, dest = item
+        if first[package] is item:
+            continue
+        wheel = fetched.get(package)
+        entry = plan.locked.get(_canonical_name(package[0]))
+        if wheel is not None and wheel_rank(wheel, plan.args) is not None \
+                and (entry is None or entry['version'] != package[1]
+                     or entry['wheel'] == wheel.filename):
+            shutil.copy(wheel.wheel_path, dest)
+        else:
+            remaining.append(item)
+    run_parallel(fetch, remaining, args.jobs)
+
+
+def _find_fetched(wheel_dir, name, version):
+    # The wheel of name==version among the wheels fetched into wheel_dir.
+    for filename in os.listdir(wheel_dir):
+        if filename.endswith('.whl'):
+            wheel = Wheel(os.path.join(wheel_dir, filename))
+            if _canonical_name(wheel.name) == _canonical_name(name) \
+                    and wheel.version == version:
+                return wheel
+    return None
+
+
+def scheme_dirs(prefix, args):
+    """Return the (site-packages, headers, scripts, data) directories."""
+    python = 'python%d.%d' % _parse_python_version(args.python_version)
+
+    if args.platform == 'windows':
+        sp = prefix / 'Lib' / 'site-packages'
+        headers = prefix / 'Include'
+        scripts = prefix / 'Scripts'
+        data = prefix
+    elif args.platform == 'linux' and python == "python3.6":
+        sp = prefix / 'lib' / python / 'site-packages'
+        headers = prefix / 'include' / 'site' / python
+        scripts = prefix / 'bin'
+        data = prefix
+    elif args.platform == 'linux':
+        sp = prefix / 'lib' / 'site-packages'
+        headers = prefix / 'include' / 'site' / python
+        scripts = prefix / 'bin'
+        data = prefix
+    else:
+        die(f'unsupported platform: {args.platform}')
+
+    return sp, headers, scripts, data
+
+
+def install_wheels(wheel_dir, prefix, args):
+    """Install every wheel in wheel_dir into the scheme rooted at prefix."""
+    sp, headers, scripts, data = scheme_dirs(prefix, args)
+
+    maker = ScriptMaker(None, None)
+
+    wheels = [Wheel(os.path.join(wheel_dir, filename))
+              for filename in sorted(os.listdir(wheel_dir))
+              if filename.endswith('.whl')]
+    schemes = []
+    for wheel in wheels:
+        paths = {
+            'prefix': prefix,
+            'purelib': sp,
+            'platlib': sp,
+            'headers': headers / wheel.name,
+            'scripts': scripts,
+            'data': data
+        }
+
+        for dn in paths.values():
+            os.makedirs(dn, exist_ok=True)
+
+        schemes.append(paths)
+
+    # Wheels are extracted concurrently.  When several of them ship the
+    # same file (e.g. the __init__.py of a namespace package), only the
+    # last one in sorted order writes it, as it would in a serial install.
+    owners = {}
+    planned = []
+    for index, (wheel, paths) in enumerate(zip(wheels, schemes)):
+        with zipfile.ZipFile(wheel.wheel_path) as zf:
+            dest_paths = [dest for _, dest, _ in wheel.plan(zf, paths)]
+        planned.append(dest_paths)
+        for dest_path in dest_paths:
+            owners[dest_path] = index
+
+    def install_one(index):
+        wheel = wheels[index]
+        skip = {path for path in planned[index] if owners[path] != index}
+        with _tracer.span(wheel.name, 'install', version=wheel.version) as span:
+            files = wheel.install(schemes[index], maker, skip,
+                                  args.link_store, args.link_mode)
+            span.update(files=len(files), bytes=wheel.bytes_written)
+        return files
+
+    with _tracer.span('install', wheels=len(wheels)):
+        results = run_parallel(install_one, range(len(wheels)), args.jobs)
+
+    installed = {}
+    for wheel, files in zip(wheels, results):
+        installed[_canonical_name(wheel.name)] = {
+            'name': wheel.name,
+            'version': wheel.version,
+            'wheel': wheel.filename,
+            'tag': f'{wheel.python_tag}-{wheel.abi_tag}-{wheel.platform_tag}',
+            'files': {
+                pathlib.Path(os.path.relpath(path, prefix)).as_posix(): file_hash
+                for path, file_hash in files
+            },
+        }
+
+    return installed
+
+
+def post_install(prefix, installed, args):
+    """Run the optional stages that follow the installation of wheels.
+
+    installed maps the freshly installed distributions to their manifest
+    entries, with file paths relative to prefix.
+    """
+    if args.prune:
+        with _tracer.span('prune'):
+            prune_packages(prefix, installed, args)
+    if args.strip:
+        with _tracer.span('strip'):
+            strip_native_extensions(prefix, installed, args)
+    if args.compile:
+        with _tracer.span('compile'):
+            compile_packages(prefix, installed, args)
+    if args.layout == 'archive':
+        with _tracer.span('archive'):
+            build_archive(prefix, installed, args)
+    if args.import_index:
+        with _tracer.span('import-index'):
+            write_import_index(prefix, args)
+    else:
+        # A previous run may have written one for other packages.
+        sp, _, _, _ = scheme_dirs(prefix, args)
+        try:
+            os.remove(sp / _import_index_name)
+        except FileNotFoundError:
+            pass
+
+
+# Installed files the runtime never imports.  Patterns are matched with
+# fnmatch against paths relative to site-packages, so '*' also matches
+# '/'.  A per-app rules file can add patterns, or keep files with '!';
+# as in .gitignore, the last matching rule wins.
+_default_prune_patterns = [
+    '*__pycache__/*',
+    'tests/*', '*/tests/*',
+    'test/*', '*/test/*',
+    '*/docs/*',
+    '*/examples/*',
+    '*.pyi',
+    '*.pyx', '*.pxd', '*.c', '*.cpp', '*.h', '*.hpp',
+]
+
+_prune_rules_name = '.packapp-prune'
+
+
+def load_prune_rules(args):
+    """Return the app's prune rules as a list of (pattern, prune)."""
+    rules = [(pattern, True) for pattern in _default_prune_patterns]
+
+    path = args.prune_rules or os.path.join(args.path, _prune_rules_name)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('!'):
+                    rules.append((line[1:], False))
+                else:
+                    rules.append((line, True))
+    elif args.prune_rules:
+        die(f'prune rules file {path} does not exist')
+
+    return rules
+
+
+def prune_packages(prefix, installed, args):
+    sp, _, _, _ = scheme_dirs(prefix, args)
+    sp_rel = sp.relative_to(prefix).as_posix() + '/'
+    rules = load_prune_rules(args)
+
+    def should_prune(rel_path):
+        if rel_path.split('/')[0].endswith('.dist-info'):
+            # importlib.metadata needs METADATA, entry_points.txt & co.
+            return False
+        result = False
+        for pattern, prune in rules:
+            if fnmatch.fnmatchcase(rel_path, pattern):
+                result = prune
+        return result
+
+    report = []
+    for entry in installed.values():
+        pruned = [rel_path for rel_path in entry['files']
+                  if rel_path.startswith(sp_rel)
+                  and should_prune(rel_path[len(sp_rel):])]
+        if not pruned:
+            continue
+
+        size = 0
+        for rel_path in pruned:
+            try:
+                size += os.path.getsize(prefix / rel_path)
+            except OSError:
+                pass
+            del entry['files'][rel_path]
+        _remove_files(prefix, pruned)
+        for rel_path in entry['files']:
+            if rel_path.startswith(sp_rel) and \
+                    rel_path.endswith('.dist-info/RECORD'):
+                _drop_from_record(prefix / rel_path,
+                                  {p[len(sp_rel):] for p in pruned})
+        report.append((size, len(pruned), entry['name']))
+
+    if report:
+        log(f'{"pruned":<32} {"files":>8} {"KiB":>10}')
+        for size, count, name in sorted(report, reverse=True):
+            log(f'{name:<32} {count:>8} {size / 1024:>10.1f}')
+    log(f'Pruned {sum(r[1] for r in report)} files '
+        f'({sum(r[0] for r in report) / 1024 / 1024:.1f} MiB) '
+        f'from {len(report)} packages')
+
+
+def _drop_from_record(record_path, removed):
+    # RECORD paths are relative to site-packages.  The file is replaced
+    # rather than rewritten, it can be linked to a --link-store.
+    with open(record_path, encoding='utf-8', newline='') as f:
+        rows = [row for row in csv.reader(f) if row and row[0] not in removed]
+    tmp_path = record_path.with_name(f'{record_path.name}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        csv.writer(f, lineterminator='\n').writerows(rows)
+    os.replace(tmp_path, record_path)
+
+
+def strip_native_extensions(prefix, installed, args):
+    # Drop the debug sections of native libraries, like publish-tools
+    # does for the shared objects of the Core Tools themselves.
+    if args.platform != 'linux':
+        log(f'WARNING: skipping --strip, not supported for {args.platform}')
+        return
+
+    libraries = [(entry['name'], prefix / rel_path)
+                 for entry in installed.values()
+                 for rel_path in sorted(entry['files'])
+                 if rel_path.endswith('.so') or '.so.' in rel_path]
+    if not libraries:
+        return
+
+    cache = args.wheel_cache
+
+    def strip_one(library):
+        name, path = library
+        size = os.path.getsize(path)
+        digest = _file_sha256(path)
+        backup = path.with_name(f'{path.name}.packapp-orig')
+        tmp_path = path.with_name(f'{path.name}.packapp-strip')
+
+        cached = cache.find_stripped(digest) if cache is not None else None
+        if cached is not None:
+            shutil.copyfile(cached, tmp_path)
+        else:
+            # Strip a copy: the library may be hard linked from a
+            # --link-store, which must not change.
+            shutil.copyfile(path, tmp_path)
+            proc = run([args.strip_binary, '--strip-unneeded', str(tmp_path)])
+            if proc.returncode != 0:
+                log(f'WARNING: cannot strip {path.name}: '
+                    f'{proc.stderr.decode(errors="replace").strip()}')
+                os.remove(tmp_path)
+                return name, path, None, size, size
+            if cache is not None:
+                cache.add_stripped(digest, tmp_path)
+
+        shutil.copymode(path, tmp_path)
+        os.replace(path, backup)
+        os.replace(tmp_path, path)
+        return name, path, backup, size, os.path.getsize(path)
+
+    results = run_parallel(strip_one, libraries, args.jobs)
+    stripped = [r for r in results if r[2] is not None]
+
+    # Check that the stripped extension modules still import, and put
+    # the originals of any distribution that fails back in place.
+    failed = _verify_extension_imports(prefix, [r[:2] for r in stripped], args)
+    for name, path, backup, _, _ in stripped:
+        if name in failed:
+            os.replace(backup, path)
+        else:
+            os.remove(backup)
+    for name in sorted(failed):
+        log(f'WARNING: {name} does not import after stripping, '
+            f'keeping it unstripped')
+
+    saved = {}
+    for name, _, _, before, after in stripped:
+        if name not in failed:
+            saved[name] = saved.get(name, 0) + before - after
+    for name, size in sorted(saved.items(), key=lambda item: -item[1]):
+        log(f'{name:<32} {size / 1024:>10.1f} KiB saved')
+    log(f'Stripped {len(stripped)} native libraries, '
+        f'saved {sum(saved.values()) / 1024 / 1024:.1f} MiB')
+
+
+_verify_imports_script = '''
+import importlib, json, sys
+sys.path.insert(0, sys.argv[1])
+failed = []
+for name in sys.argv[2:]:
+    try:
+        importlib.import_module(name)
+    except Exception:
+        failed.append(name)
+print(json.dumps(failed))
+'''
+
+
+def _verify_extension_imports(prefix, libraries, args):
+    """Import the extension modules among the (distribution, path) pairs
+    and return the distributions that fail to import."""
+    sp, _, _, _ = scheme_dirs(prefix, args)
+    python = find_target_python(args)
+    if python is None or not sys.platform.startswith('linux'):
+        log('WARNING: cannot verify stripped extension modules on this host')
+        return set()
+
+    modules = {}
+    for name, path in libraries:
+        if sp not in path.parents:
+            # Installed through <name>.data/data, not a module.
+            continue
+        rel_parts = path.relative_to(sp).parts
+        # Libraries vendored in e.g. numpy.libs/ are not importable
+        # themselves, they are exercised through the modules using them.
+        if any('.' in part for part in rel_parts[:-1]):
+            continue
+        module = '.'.join(rel_parts[:-1] + (rel_parts[-1].split('.')[0],))
+        modules[module] = name
+
+    if not modules:
+        return set()
+
+    with tempfile.TemporaryDirectory(prefix='azureworker') as td:
+        script = os.path.join(td, 'verify.py')
+        with open(script, 'w', encoding='utf-8') as f:
+            f.write(_verify_imports_script)
+        proc = run(python + ['-I', '-S', script, str(sp), *sorted(modules)])
+    if proc.returncode != 0:
+        log('WARNING: cannot verify stripped extension modules: '
+            f'{proc.stderr.decode(errors="replace").strip()}')
+        return set()
+    return {modules[module] for module in json.loads(proc.stdout)}
+
+
+def find_target_python(args):
+    """Return a command running the target Python version, or None."""
+    return _find_python(*_parse_python_version(args.python_version))
+
+
+@functools.lru_cache(maxsize=None)
+def _find_python(major, minor):
+    if sys.version_info[:2] == (major, minor):
+        return [sys.executable]
+
+    candidates = [[f'python{major}.{minor}']]
+    if os.name == 'nt':
+        candidates.append(['py', f'-{major}.{minor}'])
+
+    for cmd in candidates:
+        if not shutil.which(cmd[0]):
+            continue
+        # Version managers install shims that exist on PATH but fail when
+        # the version is not activated, so check the interpreter runs.
+        probe = subprocess.run(
+            cmd + ['-c', 'import sys; print("%d.%d" % sys.version_info[:2])'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if probe.returncode == 0 and \
+                probe.stdout.decode().strip() == f'{major}.{minor}':
+            return cmd
+
+    return None
+
+
+def compile_packages(prefix, installed, args):
+    # Bytecode is specific to the interpreter version, so it has to be
+    # produced by the target Python rather than the one running packapp.
+    python = find_target_python(args)
+    if python is None:
+        log('WARNING: skipping bytecode compilation, no Python %d.%d '
+            'interpreter found' % _parse_python_version(args.python_version))
+        return
+
+    sources = sorted(str(prefix / rel_path)
+                     for entry in installed.values()
+                     for rel_path in entry['files']
+                     if rel_path.endswith('.py'))
+    if not sources:
+        return
+
+    cmd = python + ['-m', 'compileall', '-q', '-j', str(args.jobs),
+                    '--invalidation-mode', args.compile_invalidation_mode,
+                    # Do not embed the staging directory in the bytecode.
+                    '-s', str(prefix), '-i', '-']
+    for level in args.compile_optimize:
+        cmd += ['-o', str(level)]
+
+    started = time.monotonic()
+    proc = run(cmd, verbose=args.verbose,
+               input='\n'.join(sources).encode())
+    elapsed = time.monotonic() - started
+    if proc.returncode != 0:
+        # Like pip, do not fail packing because some files, e.g. test
+        # fixtures or Python 2 only modules, are not valid Python.
+        log('WARNING: some modules could not be compiled')
+
+    major, minor = _parse_python_version(args.python_version)
+    suffixes = [f'.cpython-{major}{minor}{"" if level == 0 else f".opt-{level}"}.pyc'
+                for level in args.compile_optimize]
+    count = size = 0
+    for source in sources:
+        source = pathlib.Path(source)
+        for suffix in suffixes:
+            try:
+                size += os.path.getsize(
+                    source.parent / '__pycache__' / f'{source.stem}{suffix}')
+                count += 1
+            except OSError:
+                pass
+
+    log(f'Compiled {len(sources)} modules into {count} bytecode files '
+        f'({size / 1024 / 1024:.1f} MiB) in {elapsed:.1f}s')
+
+
+_archive_name = 'packapp-archive.zip'
+
+# Files that a package can only use from a real path on disk.
+_native_suffixes = ('.so', '.pyd', '.dll', '.dylib')
+
+_archive_sitecustomize = '''\
+# Puts the packages archived with --layout archive on sys.path, right
+# after the site-packages directory holding them.
+import os
+import sys
+
+_site_packages = os.path.dirname(os.path.abspath(__file__))
+_archive = os.path.join(_site_packages, %r)
+if _archive not in sys.path:
+    try:
+        _index = sys.path.index(_site_packages) + 1
+    except ValueError:
+        _index = len(sys.path)
+    sys.path.insert(_index, _archive)
+''' % _archive_name
+
+
+_sitecustomize_header = '# Generated by packapp, do not edit.\n'
+
+# Being first on sys.path, the generated sitecustomize shadows any other
+# one, e.g. of the host image or of an APM agent: run it after ours, as
+# site would have without packapp.
+_sitecustomize_footer = '''
+
+def _packapp_chain():
+    import importlib.machinery
+    here = os.path.dirname(os.path.abspath(__file__))
+    path = [entry for entry in sys.path
+            if os.path.abspath(entry or os.curdir) != here]
+    spec = importlib.machinery.PathFinder.find_spec('sitecustomize', path)
+    if spec is None or spec.loader is None:
+        return
+    import importlib.util
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['sitecustomize'] = module
+    spec.loader.exec_module(module)
+
+
+_packapp_chain()
+'''
+
+
+def _add_to_sitecustomize(sp, code):
+    # site imports sitecustomize from sys.path at startup, including
+    # when site-packages is only on PYTHONPATH, where .pth files are not
+    # processed.  Returns False if a package ships its own.
+    path = sp / 'sitecustomize.py'
+    try:
+        with open(path, encoding='utf-8') as f:
+            content = f.read()
+    except FileNotFoundError:
+        content = _sitecustomize_header + 'import os\nimport sys\n'
+    if not content.startswith(_sitecustomize_header):
+        return False
+    if content.endswith(_sitecustomize_footer):
+        content = content[:-len(_sitecustomize_footer)]
+    if code not in content:
+        content = f'{content}\n{code}'
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content + _sitecustomize_footer)
+    return True
+
+
+def build_archive(prefix, installed, args):
+    # Move the pure-Python packages into one uncompressed zip file that
+    # zipimport loads directly.  Native extensions, data files and
+    # dist-info directories stay on disk.
+    sp, _, _, _ = scheme_dirs(prefix, args)
+    sp_rel = sp.relative_to(prefix).as_posix() + '/'
+
+    # Several distributions can share a top-level name (namespace
+    # packages), so a top-level name is archived only if every
+    # distribution contributing to it is zip-safe.
+    top_levels = {}
+    for key, entry in installed.items():
+        for rel_path in entry['files']:
+            if rel_path.startswith(sp_rel):
+                top = rel_path[len(sp_rel):].split('/')[0]
+                if not top.endswith(('.dist-info', '.pth')):
+                    top_levels.setdefault(top, set()).add(key)
+
+    unsafe = {}
+    for key, entry in installed.items():
+        reason = _zip_unsafe_reason(prefix, sp_rel, entry, args)
+        if reason:
+            unsafe[key] = reason
+
+    archived = {top for top, keys in top_levels.items()
+                if not keys & unsafe.keys()}
+    for key, reason in sorted(unsafe.items()):
+        log(f'Keeping {installed[key]["name"]} on disk: {reason}')
+    if not archived:
+        return
 
+    archive_path = sp / _archive_name
+    # zipimport only finds a directory through its own entry in the
+    # archive, and namespace packages such as azure/ have nothing else:
+    # every archived directory gets one, before the files it holds.
+    members = []
+    for top in sorted(archived):
+        path = sp / top
+        if path.is_dir():
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                root = pathlib.Path(root)
+                if root.name != '__pycache__':
+                    members.append(root)
+                members.extend(root / f for f in sorted(files))
+        else:
+            members.append(path)
 
-class ScriptMaker:    
-    def __init__(self, source_dir, target_dir):
-        self.source_dir = source_dir
-        self.target_dir = target_dir
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_STORED) as zf:
+        for path in members:
+            rel_path = path.relative_to(sp)
+            if path.is_dir():
+                zf.write(path, rel_path.as_posix() + '/')
+                continue
+            if rel_path.parent.name == '__pycache__':
+                # zipimport only looks for bytecode next to the source.
+                if not path.name.endswith(f'.cpython-%d%d.pyc'
+                                          % _parse_python_version(args.python_version)):
+                    continue
+                arcname = rel_path.parent.parent / \
+                    (path.name.split('.', 1)[0] + '.pyc')
+            else:
+                arcname = rel_path
+            zf.write(path, arcname.as_posix())
 
-_platform_map = {
-    'linux': 'manylinux1_x86_64',
-    'windows': 'win_amd64',
-}
+    for top in archived:
+        path = sp / top
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
-_wheel_file_pattern = r"""
-    ^{namever}
-    ((-(?P<build>\d[^-]*?))?-(?P<pyver>.+?)-(?P<abi>.+?)-(?P<plat>.+?)
-    \.whl)$
-"""
+    with open(sp / 'packapp-archive.pth', 'w', encoding='utf-8') as f:
+        f.write(f'{_archive_name}\n')
+    if not _add_to_sitecustomize(sp, _archive_sitecustomize):
+        log('WARNING: a package ships sitecustomize.py, the archive is only '
+            'added to sys.path through packapp-archive.pth')
 
-class ExitCode(IntEnum):
-    success = 0
-    general_error = 1
-    native_deps_error = 4
+    files = sum(1 for info in zf.infolist() if not info.is_dir())
+    log(f'Archived {len(archived)} top-level packages ({files} files, '
+        f'{archive_path.stat().st_size / 1024 / 1024:.1f} MiB) '
+        f'into {_archive_name}')
 
 
-def die(msg, exitcode=ExitCode.general_error):
-    print(f'ERROR: {msg}', file=sys.stderr)
-    sys.exit(int(exitcode))
+_import_index_name = '_packapp_index.marshal'
+
+_import_index_bootstrap = '''\
+# Generated by packapp: imports from this site-packages directory are
+# answered from the index packapp wrote next to it, instead of listing
+# and stat-ing directories.  The index is trusted while site-packages
+# holds the entries it held at packing time, as installing, upgrading or
+# removing a distribution changes its .dist-info directory; zip deploys
+# rewrite the mtimes, so these cannot be relied on.  Names missing from
+# the index are left to the regular path finder.
+# PACKAPP_IMPORT_INDEX=0 disables the index.
+import os
+import sys
+# Not importlib.util, which would import contextlib and functools at
+# every start.
+from importlib.machinery import (ExtensionFileLoader, ModuleSpec,
+                                 SourceFileLoader, SourcelessFileLoader)
 
+_site_packages = os.path.dirname(os.path.abspath(__file__))
 
-def run(cmd, *, verbose=False, **kwargs):
-    if verbose:
-        stdout = stderr = None
+
+def _load_index():
+    # marshal rather than json: json imports re and enum, which would
+    # cost more at startup than the index saves.
+    import marshal
+    try:
+        with open(os.path.join(_site_packages, %r), 'rb') as f:
+            index = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(index, dict) or index.get('version') != 3:
+        return None
+    return index
+
+
+def _is_current(index):
+    # One listing of site-packages, at startup.  __pycache__ appears
+    # once this module is imported.
+    try:
+        listing = set(os.listdir(_site_packages))
+    except OSError:
+        return False
+    listing.discard('__pycache__')
+    return listing == set(index['listing'])
+
+
+# The indexed modules, and site-packages and the directories of its
+# packages.
+_modules = {}
+_directories = set()
+
+
+def _file_spec(fullname, location, package_dir=None):
+    # What the FileFinder of the regular path finder would return.
+    if location.endswith('.py'):
+        loader = SourceFileLoader(fullname, location)
+    elif location.endswith('.pyc'):
+        loader = SourcelessFileLoader(fullname, location)
     else:
-        stdout = stderr = subprocess.PIPE
+        loader = ExtensionFileLoader(fullname, location)
+    spec = ModuleSpec(fullname, loader, origin=location,
+                      is_package=package_dir is not None)
+    spec.has_location = True
+    if package_dir is not None:
+        spec.submodule_search_locations = [package_dir]
+    return spec
 
-    print(' '.join(cmd))
-    return subprocess.run(cmd, stdout=stdout, stderr=stderr, **kwargs)
 
+def _fallback_hook(path):
+    # The hooks that would have been asked without the index, most
+    # likely the FileFinder of the regular path finder.
+    for hook in sys.path_hooks:
+        if hook is _path_hook:
+            continue
+        try:
+            return hook(path)
+        except ImportError:
+            continue
+    return None
 
-def run_or_die(cmd, *, verbose=False, **kwargs):
+
+class _IndexFinder:
+    def __init__(self, path, modules):
+        self.path = path
+        self._modules = modules
+        self._fallback = None
+
+    def _fallback_finder(self):
+        if self._fallback is None:
+            self._fallback = _fallback_hook(self.path)
+        return self._fallback
+
+    def _fallback_spec(self, fullname, target):
+        finder = self._fallback_finder()
+        if finder is None:
+            return None
+        return finder.find_spec(fullname, target)
+
+    def find_spec(self, fullname, target=None):
+        entry = self._modules.get(fullname)
+        if entry is None:
+            return self._fallback_spec(fullname, target)
+        kind, rel_path = entry
+        location = os.path.join(_site_packages, *rel_path.split('/'))
+        if kind == 'n':
+            # Namespace package portion.
+            if os.path.dirname(location) != self.path:
+                return self._fallback_spec(fullname, target)
+            spec = ModuleSpec(fullname, None)
+            spec.submodule_search_locations = [location]
+            return spec
+        if kind == 'p':
+            package_dir = os.path.dirname(location)
+            if os.path.dirname(package_dir) != self.path:
+                return self._fallback_spec(fullname, target)
+        elif os.path.dirname(location) != self.path:
+            return self._fallback_spec(fullname, target)
+        else:
+            package_dir = None
+        if not os.path.isfile(location):
+            # Removed since packing, without changing the listing of
+            # site-packages.
+            return self._fallback_spec(fullname, target)
+        return _file_spec(fullname, location, package_dir)
+
+    def iter_modules(self, prefix=''):
+        # Only pkgutil calls this, it is imported by then.
+        import pkgutil
+        finder = self._fallback_finder()
+        if finder is None:
+            return iter(())
+        return pkgutil.iter_importer_modules(finder, prefix)
+
+    def invalidate_caches(self):
+        if self._fallback is not None:
+            self._fallback.invalidate_caches()
+
+
+def _path_hook(path):
+    path = os.path.abspath(path)
+    if path not in _directories:
+        raise ImportError('not an indexed directory')
+    return _IndexFinder(path, _modules)
+
+
+def _install():
+    if os.environ.get('PACKAPP_IMPORT_INDEX') == '0':
+        return
+    index = _load_index()
+    if index is None or not _is_current(index):
+        return
+    _modules.update(index['modules'])
+    for rel_dir in index['directories']:
+        directory = os.path.join(_site_packages, *rel_dir.split('/'))
+        _directories.add(os.path.normpath(directory))
+
+    sys.path_hooks.insert(0, _path_hook)
+    for path in list(sys.path_importer_cache):
+        if path in _directories:
+            del sys.path_importer_cache[path]
+
+
+_install()
+''' % _import_index_name
+
+_import_index_module = '_packapp_import_index'
+
+
+def _extension_suffixes(args):
+    major, minor = _parse_python_version(args.python_version)
+    if args.platform == 'windows':
+        return [f'.cp{major}{minor}-win_amd64.pyd', '.pyd']
+    return [f'.cpython-{major}{minor}-x86_64-linux-gnu.so', '.abi3.so', '.so']
+
+
+def write_import_index(prefix, args):
+    """Write the index of every module in site-packages and the path
+    hook that imports them from it, see _import_index_bootstrap."""
+    sp, _, _, _ = scheme_dirs(prefix, args)
+
+    # Module files in the order the regular path finder prefers them.
+    suffixes = [*_extension_suffixes(args), '.py', '.pyc']
+
+    def module_file(name, files):
+        for suffix in suffixes:
+            if name + suffix in files:
+                return name + suffix
+        return None
+
+    modules = {}
+    directories = []
+
+    def scan(directory, package):
+        with os.scandir(directory) as it:
+            entries = list(it)
+        files = {e.name for e in entries if not e.is_dir()}
+        dirs = {e.name for e in entries if e.is_dir()
+                and e.name.isidentifier()}
+        rel_dir = pathlib.Path(directory).relative_to(sp).as_posix()
+        directories.append(rel_dir)
+        rel_dir = '' if rel_dir == '.' else rel_dir + '/'
+
+        names = set(dirs)
+        for filename in files:
+            for suffix in suffixes:
+                if filename.endswith(suffix):
+                    name = filename[:-len(suffix)]
+                    if name.isidentifier() and name != '__init__':
+                        names.add(name)
+                    break
+
+        # A package directory comes first, then a module file, then a
+        # namespace package portion, as for the regular path finder.
+        for name in sorted(names):
+            fullname = package + name
+            init = None
+            if name in dirs:
+                sub_files = os.listdir(os.path.join(directory, name))
+                init = module_file('__init__', sub_files)
+            if init is not None:
+                modules[fullname] = ['p', f'{rel_dir}{name}/{init}']
+            elif module_file(name, files) is not None:
+                modules[fullname] = [
+                    'm', rel_dir + module_file(name, files)]
+            else:
+                modules[fullname] = ['n', f'{rel_dir}{name}']
+            if name in dirs:
+                scan(os.path.join(directory, name), fullname + '.')
+
+    scan(sp, '')
+    modules.pop(_import_index_module, None)
+
+    with open(sp / f'{_import_index_module}.py', 'w', encoding='utf-8') as f:
+        f.write(_import_index_bootstrap)
+    with open(sp / 'packapp-import-index.pth', 'w', encoding='utf-8') as f:
+        f.write(f'import {_import_index_module}\n')
+    if not _add_to_sitecustomize(
+            sp, f'try:\n    import {_import_index_module}\n'
+                f'except ImportError:\n    pass\n'):
+        log('WARNING: a package ships sitecustomize.py, the import index is '
+            'only used through packapp-import-index.pth')
+
+    # site-packages was scanned before the files above were written.
+    listing = set(os.listdir(sp)) | {_import_index_name}
+    listing.discard('__pycache__')
+    index = {'version': 3, 'listing': sorted(listing),
+             'directories': directories, 'modules': modules}
+    index_path = sp / _import_index_name
+    tmp_path = sp / f'{_import_index_name}.tmp'
+    # Version 4 of the format is read by every supported Python.
+    with open(tmp_path, 'wb') as f:
+        marshal.dump(index, f, 4)
+    os.replace(tmp_path, index_path)
+
+    log(f'Indexed {len(modules)} modules into {_import_index_name}')
+
+
+def _zip_unsafe_reason(prefix, sp_rel, entry, args):
+    """Return why a distribution cannot be imported from a zip, or None."""
+    name = _canonical_name(entry['name'])
+    if name in args.zip_safe:
+        return None
+    if name in args.not_zip_safe:
+        return 'marked as not zip-safe'
+
+    for rel_path in entry['files']:
+        if not rel_path.startswith(sp_rel):
+            continue
+        rel_path = rel_path[len(sp_rel):]
+        top = rel_path.split('/')[0]
+        if top.endswith('.dist-info'):
+            continue
+        if rel_path.endswith(_native_suffixes) or '.so.' in rel_path:
+            return 'native extension modules'
+        if not rel_path.endswith(('.py', '.pyi')) \
+                and os.path.basename(rel_path) != 'py.typed':
+            return f'data file {rel_path}'
+        if rel_path.endswith('.py'):
+            with open(prefix / sp_rel / rel_path, 'rb') as f:
+                use = _zip_unsafe_use(f.read())
+            if use:
+                return f'{rel_path} uses {use}'
+    return None
+
+
+# Calls that hand out package data as paths on disk, or whose results
+# are commonly turned into such paths.
+_zip_unsafe_calls = {
+    'importlib.resources.files',
+    'importlib_resources.files',
+    'pkgutil.get_data',
+    'pkg_resources.resource_filename',
+}
+
+
+def _zip_unsafe_use(source):
+    """Return a use of __file__ or of a package data API in the
+    source, or None.
+
+    Only direct uses are found: a path derived from __file__ in another
+    module, or an API reached through getattr(), are not.  Sources the
+    running Python cannot parse, e.g. written for a newer version, are
+    checked for the __file__ name anywhere, including comments.
+    """
     try:
-        run(cmd, verbose=verbose, check=True, **kwargs)
-    except subprocess.CalledProcessError as e:
-        die(f'{cmd} failed with exit code {e.returncode}')
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return '__file__' if b'__file__' in source else None
 
+    # Local names bound by imports, to their full dotted names.
+    imported = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    imported[alias.asname] = alias.name
+                else:
+                    top = alias.name.split('.')[0]
+                    imported[top] = top
+        elif isinstance(node, ast.ImportFrom) and node.module \
+                and not node.level:
+            for alias in node.names:
+                imported[alias.asname or alias.name] = \
+                    f'{node.module}.{alias.name}'
 
-def main(argv=sys.argv[1:]):
-    args = parse_args(argv)
-    if not args.no_deps:
-        find_and_build_deps(args)
+    def dotted(node):
+        if isinstance(node, ast.Name):
+            return imported.get(node.id, node.id)
+        if isinstance(node, ast.Attribute):
+            value = dotted(node.value)
+            return value and f'{value}.{node.attr}'
+        return None
 
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == '__file__' or \
+                isinstance(node, ast.Attribute) and node.attr == '__file__':
+            return '__file__'
+        if isinstance(node, ast.Call):
+            name = dotted(node.func)
+            if name in _zip_unsafe_calls:
+                return f'{name}()'
+    return None
 
-def find_and_build_deps(args):
-    app_path = pathlib.Path(args.path)
-    req_txt = app_path / 'requirements.txt'
 
-    if not req_txt.exists():
-        die('missing requirements.txt file.  '
-            'If you do not have any requirements, please pass --no-deps.')
+def install_direct(wheel_dir, packages_dir, req_hash, args):
+    # Install straight into the final packages layout.  Wheels are
+    # extracted into a staging directory next to it, which is then
+    # renamed into place, so every file is written exactly once and a
+    # failed run never leaves a half-populated packages directory.
+    staging = packages_dir.with_name(f'{packages_dir.name}.{uuid.uuid4().hex}.tmp')
+    os.makedirs(staging)
+    try:
+        installed = install_wheels(wheel_dir, staging, args)
+        post_install(staging, installed, args)
+        with _tracer.span('finalize'):
+            write_manifest(staging, args, req_hash, installed)
+            _replace_dir(staging, packages_dir)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
 
-    packages = []
 
-    # First, we need to figure out the complete list of dependencies
-    # without actually installing them.  Use straight `pip download`
-    # for that.
+def update_in_place(wheel_dir, packages_dir, manifest, removed, req_hash, args):
+    # Drop the manifest first: if this run is interrupted, the next one
+    # rebuilds the packages directory from scratch.
+    os.remove(packages_dir / _manifest_name)
+
+    packages = dict(manifest['packages'])
+    kept_files = set()
+    for key, entry in packages.items():
+        if key not in removed:
+            kept_files.update(entry['files'])
+
+    with _tracer.span('remove', packages=len(removed)):
+        for key in removed:
+            entry = packages.pop(key)
+            log(f'Removing {entry["name"]}-{entry["version"]}')
+            # Files can be shared between distributions, e.g. the
+            # __init__.py of a namespace package.
+            _remove_files(packages_dir,
+                          [f for f in entry['files'] if f not in kept_files])
+
+    installed = install_wheels(wheel_dir, packages_dir, args)
+    post_install(packages_dir, installed, args)
+    packages.update(installed)
+    with _tracer.span('finalize'):
+        write_manifest(packages_dir, args, req_hash, packages)
+
+
+def _remove_files(root, files):
+    dirs = set()
+    for rel_path in files:
+        path = root / rel_path
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        dirs.add(path.parent)
+
+        if path.suffix == '.py':
+            # Bytecode written by the compile stage.
+            pycache = path.parent / '__pycache__'
+            for pyc in pycache.glob(f'{path.stem}.*.pyc'):
+                os.remove(pyc)
+            dirs.add(pycache)
+
+    # Remove directories left empty, deepest first, but never root.
+    for path in sorted(dirs, key=lambda p: len(p.parts), reverse=True):
+        while path != root and root in path.parents:
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
+            path = path.parent
+
+
+_manifest_name = '.packapp-manifest.json'
+
+
+def load_manifest(packages_dir, args):
+    """Return the manifest of a previous run for the same target, or None."""
+    try:
+        with open(packages_dir / _manifest_name, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != 1 or \
+            manifest.get('target') != _manifest_target(args):
+        return None
+    return manifest
+
+
+def write_manifest(packages_dir, args, req_hash, packages):
+    manifest = {
+        'version': 1,
+        'target': _manifest_target(args),
+        'requirements_sha256': req_hash,
+        'packages': packages,
+    }
+    path = packages_dir / _manifest_name
+    tmp_path = path.with_name(f'{path.name}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _manifest_target(args):
+    # Everything the packages directory was built with: changing any of
+    # it rebuilds the directory instead of reporting it up to date.
+    target = {'platform': args.platform, 'python_version': args.python_version,
+              'layout': args.layout, 'prune': args.prune,
+              'strip': args.strip, 'compile': args.compile,
+              'import_index': args.import_index}
+    if args.platform == 'linux':
+        target['manylinux_glibc'] = args.manylinux_glibc
+    if args.prune:
+        rules = json.dumps(load_prune_rules(args)).encode('utf-8')
+        target['prune_rules_sha256'] = hashlib.sha256(rules).hexdigest()
+    if args.compile:
+        target['compile_optimize'] = list(args.compile_optimize)
+        target['compile_invalidation_mode'] = args.compile_invalidation_mode
+    if args.layout == 'archive':
+        target['zip_safe'] = sorted(args.zip_safe)
+        target['not_zip_safe'] = sorted(args.not_zip_safe)
+    return target
+
+
+def load_lock(lock_path):
+    """Return the content of a lock file, or None if there is none."""
+    try:
+        with open(lock_path, encoding='utf-8') as f:
+            lock = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        die(f'cannot read the lock file {lock_path}: {e}')
+
+    if lock.get('version') == 1:
+        # Version 1 pinned the packages resolved for the host for every
+        # target.  Keep the wheels, but resolve the targets again.
+        lock['packages'] = {}
+    elif lock.get('version') != 2:
+        die(f'unsupported lock file version in {lock_path}')
+    return lock
+
+
+def write_lock(lock_path, lock, req_hash, plans):
+    # Record, per target, the pins and the wheel and sha256 of every
+    # pin.  Entries of targets this run did not pack are kept as long
+    # as requirements.txt is unchanged.
+    packages = dict(lock['packages']) if lock is not None else {}
+    targets = dict(lock['targets']) if lock is not None else {}
+    for plan in plans:
+        pins = {_canonical_name(name): version
+                for name, version in plan.resolved}
+        entries = {key: entry for key, entry in plan.locked.items()
+                   if pins.get(key) == entry['version']}
+        for wheel_dir in (plan.wheel_dir, plan.lock_dir):
+            for filename in os.listdir(wheel_dir):
+                if filename.endswith('.whl'):
+                    path = os.path.join(wheel_dir, filename)
+                    wheel = Wheel(path)
+                    entries[_canonical_name(wheel.name)] = {
+                        'version': wheel.version,
+                        'wheel': filename,
+                        'sha256': _file_sha256(path),
+                    }
+        packages[_lock_target(plan.args)] = dict(plan.resolved)
+        targets[_lock_target(plan.args)] = dict(sorted(entries.items()))
+
+    lock = {
+        'version': 2,
+        'requirements_sha256': req_hash,
+        'packages': packages,
+        'targets': targets,
+    }
+    tmp_path = lock_path.with_name(f'{lock_path.name}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(lock, f, indent=1, sort_keys=True)
+        f.write('\n')
+    os.replace(tmp_path, lock_path)
+
+
+def _lock_target(args):
+    key = f'{args.platform}-{args.python_version}'
+    if args.platform == 'linux':
+        key += f'-glibc{args.manylinux_glibc}'
+    return key
+
+
+def install_via_venv(wheel_dir, app_path, args):
+    # Install into a throwaway venv-like tree and copy the result over
+    # the packages directory.
+    with tempfile.TemporaryDirectory(prefix='azureworkervenv') as venv:
+        venv = pathlib.Path(venv)
+        installed = install_wheels(wheel_dir, venv, args)
+        post_install(venv, installed, args)
+
+        with _tracer.span('finalize') as span:
+            copied = 0
+            for root, dirs, files in os.walk(venv):
+                for file in files:
+                    src = os.path.join(root, file)
+                    rpath = app_path / args.packages_dir_name / \
+                        os.path.relpath(src, venv)
+                    dir_name, _ = os.path.split(rpath)
+                    os.makedirs(dir_name, exist_ok=True)
+                    # rpath may be linked to a store or to other apps.
+                    _unlink(rpath)
+                    shutil.copyfile(src, rpath)
+                    copied += os.path.getsize(rpath)
+            span['bytes'] = copied
+
+
+def _replace_dir(src, dst):
+    # Move src to dst, replacing whatever was at dst before.
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+
+    old = dst.with_name(f'{dst.name}.{uuid.uuid4().hex}.old')
+    os.rename(dst, old)
+    os.rename(src, dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def resolve_packages(req_txt, args):
+    """Return the sorted list of (name, version) pins for requirements.txt
+    on the target."""
+    resolver = args.resolver
+    if resolver == 'auto':
+        resolver = 'report' if _pip_supports_report() else 'download'
+
+    if resolver == 'report':
+        return _resolve_from_report(req_txt, args)
+    return _resolve_from_download(req_txt, args)
+
+
+def _pip_supports_report():
+    # `pip install --dry-run --report` is available since pip 22.2.
+    try:
+        from importlib.metadata import version
+        pip_version = version('pip')
+    except Exception:
+        return False
+    m = re.match(r'^(\d+)\.(\d+)', pip_version)
+    return bool(m) and (int(m.group(1)), int(m.group(2))) >= (22, 2)
+
+
+def marker_environment(args):
+    """Return the PEP 508 environment markers of the target."""
+    major, minor = _parse_python_version(args.python_version)
+    if (major, minor) == sys.version_info[:2]:
+        full_version = '%d.%d.%d' % sys.version_info[:3]
+    else:
+        # The patch release the app will run on is not known.
+        full_version = f'{major}.{minor}.0'
+    if args.platform == 'windows':
+        os_name, sys_platform, system, machine = \
+            'nt', 'win32', 'Windows', 'AMD64'
+    else:
+        os_name, sys_platform, system, machine = \
+            'posix', 'linux', 'Linux', 'x86_64'
+    return {
+        'implementation_name': 'cpython',
+        'implementation_version': full_version,
+        'os_name': os_name,
+        'platform_machine': machine,
+        'platform_python_implementation': 'CPython',
+        'platform_release': '',
+        'platform_system': system,
+        'platform_version': '',
+        'python_full_version': full_version,
+        'python_version': f'{major}.{minor}',
+        'sys_platform': sys_platform,
+    }
+
+
+# pip evaluates environment markers for the interpreter running it, even
+# with --platform and --python-version.  This runs pip with the markers
+# of the target instead.
+_pip_for_target = '''\
+import json
+import os
+import runpy
+
+from pip._vendor.packaging import markers
+
+_environment = json.loads(os.environ['PACKAPP_MARKER_ENVIRONMENT'])
+markers.default_environment = lambda: dict(_environment)
+runpy.run_module('pip', run_name='__main__', alter_sys=True)
+'''
+
+
+def _pip_target_args(args):
+    # Only wheels built for the target, pip does not take the options
+    # below with sdists allowed.
+    major, minor = _parse_python_version(args.python_version)
+    cmd = ['--only-binary', ':all:', '--implementation', 'cp',
+           '--python-version', f'{major}.{minor}']
+    for abi in (f'cp{major}{minor}', 'abi3', 'none'):
+        cmd += ['--abi', abi]
+    for tag in platform_tags(args):
+        cmd += ['--platform', tag]
+    return cmd
+
+
+def _run_pip_for_target(pip_args, args, td):
+    """Run pip with the markers of the target and the arguments
+    pip_args(binary_only) returns.
+
+    pip first resolves from the wheels built for the target.  When a
+    requirement has no such wheel, e.g. an sdist-only package, it
+    resolves again with sdists allowed, with wheels picked for the
+    host.  Returns whether the first resolution succeeded.
+    """
+    script = os.path.join(td, 'pip_for_target.py')
+    with open(script, 'w', encoding='utf-8') as f:
+        f.write(_pip_for_target)
+    env = dict(os.environ, PACKAPP_MARKER_ENVIRONMENT=json.dumps(
+        marker_environment(args)))
+
+    cmd = [sys.executable, script]
+    proc = run(cmd + pip_args(True), verbose=args.verbose, env=env)
+    if proc.returncode == 0:
+        return True
+    log(f'{_lock_target(args)}: not every requirement has a wheel for the '
+        f'target, resolving again with sdists')
+    run_or_die(cmd + pip_args(False), verbose=args.verbose, env=env)
+    return False
+
+
+def _resolve_from_report(req_txt, args):
+    # Let pip resolve the requirements without installing anything.
+    # Wheels served with PEP 658 metadata are resolved from their
+    # METADATA file alone, so large distributions are not downloaded.
+    with tempfile.TemporaryDirectory(prefix='azureworker') as td:
+        report_path = os.path.join(td, 'report.json')
+
+        def pip_args(binary_only):
+            cmd = ['install', '--dry-run', '--ignore-installed', '--quiet',
+                   '--report', report_path, *_pip_index_args(args)]
+            if binary_only:
+                # pip only takes the target options with --target.
+                cmd += ['--target', os.path.join(td, 'target'),
+                        *_pip_target_args(args)]
+            return cmd + ['-r', str(req_txt)]
+
+        _run_pip_for_target(pip_args, args, td)
+        with open(report_path, encoding='utf-8') as f:
+            report = json.load(f)
+
+    packages = {(item['metadata']['name'], item['metadata']['version'])
+                for item in report.get('install', [])}
+    return sorted(packages)
+
+
+def _resolve_from_download(req_txt, args):
+    # Older pip versions cannot produce an install report, so download
+    # every distribution and read the pins from the file names.
+    packages = []
     with tempfile.TemporaryDirectory(prefix='azureworker') as td:
-        run_or_die([
-           sys.executable, '-m', 'pip', 'download', '-r', str(req_txt), '--dest', td
-        ], verbose=args.verbose)
+        def dest(binary_only):
+            return os.path.join(td, 'wheels' if binary_only else 'all')
+
+        def pip_args(binary_only):
+            cmd = ['download', '-r', str(req_txt),
+                   '--dest', dest(binary_only), *_pip_index_args(args)]
+            if binary_only:
+                cmd += _pip_target_args(args)
+            return cmd
 
-        files = os.listdir(td)
+        files = sorted(os.listdir(
+            dest(_run_pip_for_target(pip_args, args, td))))
 
         for filename in files:
             m = re.match(r'^(?P<name>.+?)-(?P<ver>.*?)-.*\.whl$', filename)
@@ -163,91 +2704,303 @@ def find_and_build_deps(args):
                     if name and ver:
                         packages.append((name, ver))
 
-    # Now that we know all dependencies, download or build wheels
-    # for them for the correct platform and Python version.
+    return packages
+
+
+# pip options that add package sources next to the index.
+_pip_other_sources = ('extra-index-url', 'find-links', 'no-index')
+
+
+def _pip_index_config():
+    """Return the index URL pip downloads from, or None for its default,
+    and the other sources it is configured with, from the environment
+    and pip's configuration files."""
+    values = {}
+    proc = run([sys.executable, '-m', 'pip', 'config', 'list'])
+    if proc.returncode == 0:
+        for line in proc.stdout.decode(errors='replace').splitlines():
+            key, sep, value = line.partition('=')
+            section, _, option = key.rpartition('.')
+            if sep and section in ('global', 'download', 'install', 'wheel'):
+                values[option] = value.strip().strip('\'"')
+    for option in ('index-url',) + _pip_other_sources:
+        env = 'PIP_' + option.upper().replace('-', '_')
+        if os.environ.get(env):
+            values[option] = os.environ[env]
+
+    if values.get('no-index', '').lower() not in ('1', 'true', 'yes', 'on'):
+        values.pop('no-index', None)
+    others = [option for option in _pip_other_sources if values.get(option)]
+    return values.get('index-url'), others
+
+
+def _pip_index_args(args):
+    # With a wheelhouse, pip must neither query nor download from an index.
+    if args.wheelhouse:
+        return ['--no-index', '--find-links', args.wheelhouse]
+    if args.index_url:
+        return ['--index-url', args.index_url]
+    return []
+
+
+_sdist_suffixes = ('.tar.gz', '.zip')
+
+
+def _is_sdist_of(filename, name, version):
+    for suffix in _sdist_suffixes:
+        if filename.endswith(suffix):
+            stem = filename[:-len(suffix)]
+            project, _, sdist_version = stem.rpartition('-')
+            return (_canonical_name(project) == _canonical_name(name)
+                    and sdist_version == version)
+    return False
+
+
+def download_sdist(name, version, args, dest):
+    """Fetch the sdist of name==version into dest without building
+    anything.  Returns its path, or None if there is none."""
+    if args.wheelhouse:
+        for filename in sorted(os.listdir(args.wheelhouse)):
+            if _is_sdist_of(filename, name, version):
+                return shutil.copy(os.path.join(args.wheelhouse, filename),
+                                   dest)
+        return None
+    if not args.package_index.usable():
+        return None
+
+    try:
+        files = args.package_index.files(name)
+        for filename, url, sha256 in files:
+            if _is_sdist_of(filename, name, version):
+                return args.package_index.download(url, sha256, dest)
+    except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+        log(f'Cannot download the sdist of {name} from the index: {e}')
+    return None
+
+
+def fetch_wheel(name, version, args, dest):
+    # Download the best wheel of name==version for the target through
+    # the in-process index client.  Returns True if a wheel was put into
+    # dest, False if the index has none for the target and None if the
+    # index could not be used.
+    if args.wheelhouse:
+        # Not found in the wheelhouse, and packapp stays offline.
+        return False
+    if not args.package_index.usable():
+        return None
+
+    try:
+        candidates = {}
+        for filename, url, sha256 in args.package_index.files(name):
+            if filename.endswith('.whl'):
+                wheel = Wheel(filename)
+                if _canonical_name(wheel.name) == _canonical_name(name) \
+                        and wheel.version == version:
+                    candidates[filename] = (url, sha256)
+        best = select_wheel(candidates, args)
+        if best is None:
+            log(f'No wheel of {name}=={version} for the target in the index')
+            return False
+        url, sha256 = candidates[best]
+        args.package_index.download(url, sha256, dest)
+        return True
+    except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+        log(f'Cannot download {name}=={version} from the index: {e}')
+        return None
+
+
+# Build requirements of sdists without a pyproject.toml, see PEP 518.
+_legacy_build_requires = ['setuptools>=40.8.0', 'wheel']
+
+
+def _sdist_build_requires(sdist):
+    """Return the sorted build-system requirements of an sdist, or None
+    if they cannot be determined."""
+    def is_pyproject(member):
+        parts = member.split('/')
+        return len(parts) == 2 and parts[1] == 'pyproject.toml'
+
+    try:
+        if sdist.endswith('.zip'):
+            with zipfile.ZipFile(sdist) as zf:
+                members = [m for m in zf.namelist() if is_pyproject(m)]
+                data = zf.read(members[0]) if members else None
+        else:
+            with tarfile.open(sdist) as tf:
+                member = next((m for m in tf if is_pyproject(m.name)), None)
+                data = tf.extractfile(member).read() if member else None
+    except (OSError, tarfile.TarError, zipfile.BadZipFile):
+        return None
+
+    if data is None:
+        return _legacy_build_requires
+    try:
+        build_system = tomllib.loads(data.decode('utf-8')).get('build-system')
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if build_system is None:
+        return _legacy_build_requires
+    requires = build_system.get('requires')
+    if not isinstance(requires, list) or \
+            not all(isinstance(r, str) for r in requires):
+        return None
+    # The wheel package is needed by older setuptools backends even
+    # when it is not declared.
+    return sorted(set(requires) | {'wheel'})
+
+
+def build_in_pool(name, version, args, dest):
+    # Build name==version from its sdist in a warm build environment.
+    # Returns True if a universal wheel was put into dest, False if the
+    # sdist builds a platform-specific wheel and None if the pool could
+    # not be used.
     with tempfile.TemporaryDirectory(prefix='azureworker') as td:
-        for name, ver in packages:
-            ensure_wheel(name, ver, args=args, dest=td)
-
-        with tempfile.TemporaryDirectory(prefix='azureworkervenv') as venv:
-            venv = pathlib.Path(venv)
-            pyver = args.python_version
-            python = f'python{pyver[0]}.{pyver[1]}'
-
-            if args.platform == 'windows':
-                sp = venv / 'Lib' / 'site-packages'
-                headers = venv / 'Include'
-                scripts = venv / 'Scripts'
-                data = venv
-            elif args.platform == 'linux' and python == "python3.6":
-                sp = venv / 'lib' / python / 'site-packages'
-                headers = venv / 'include' / 'site' / python
-                scripts = venv / 'bin'
-                data = venv
-            elif args.platform == 'linux':
-                sp = venv / 'lib' / 'site-packages'
-                headers = venv / 'include' / 'site' / python
-                scripts = venv / 'bin'
-                data = venv
-            else:
-                die(f'unsupported platform: {args.platform}')
+        sdist = download_sdist(name, version, args, td)
+        if sdist is None:
+            return None
 
-            maker = ScriptMaker(None, None)
+        cache = args.wheel_cache
+        digest = _file_sha256(sdist)
+        built = cache.find_built(digest)
+        if built is not None:
+            log(f'Using {built.name} built from {os.path.basename(sdist)}')
+            shutil.copy(built, dest)
+            return True
 
-            for filename in os.listdir(td):
-                if not filename.endswith('.whl'):
-                    continue
+        requires = _sdist_build_requires(sdist)
+        if requires is None:
+            return None
+        python = args.build_env_pool.get(requires, args)
+        if python is None:
+            return None
 
-                wheel = Wheel(os.path.join(td, filename))
+        wheel_dir = os.path.join(td, 'wheels')
+        pip = run([python, '-m', 'pip', 'wheel', '--no-deps',
+                   '--no-build-isolation', '--wheel-dir', wheel_dir, sdist])
+        if pip.returncode != 0:
+            return None
 
-                paths = {
-                    'prefix': venv,
-                    'purelib': sp,
-                    'platlib': sp,
-                    'headers': headers / wheel.name,
-                    'scripts': scripts,
-                    'data': data
-                }
+        for filename in os.listdir(wheel_dir):
+            wheel = Wheel(filename)
+            if wheel.abi_tag == 'none' and wheel.platform_tag == 'any':
+                cache.add_built(digest, os.path.join(wheel_dir, filename))
+                shutil.move(os.path.join(wheel_dir, filename), dest)
+                return True
+        return False
 
-                for dn in paths.values():
-                    os.makedirs(dn, exist_ok=True)
 
-                # print(paths, maker)
-                wheel.install(paths, maker)
+def ensure_locked_wheel(name, version, filename, sha256, args, dest):
+    """Put the wheel recorded in the lock file into dest.
 
-            for root, dirs, files in os.walk(venv):
-                for file in files:
-                    src = os.path.join(root, file)
-                    rpath = app_path / args.packages_dir_name / \
-                        os.path.relpath(src, venv)
-                    dir_name, _ = os.path.split(rpath)
-                    os.makedirs(dir_name, exist_ok=True)
-                    shutil.copyfile(src, rpath)
+    A copy in the wheelhouse or the cache is only hashed, without any
+    network access.  Otherwise the wheel is fetched as usual and must be
+    the locked one.
+    """
+    local = []
+    if args.wheelhouse:
+        local.append(('wheelhouse', os.path.join(args.wheelhouse, filename)))
+    if args.wheel_cache is not None:
+        cached = args.wheel_cache.find_file(name, filename)
+        if cached is not None:
+            local.append(('cache', cached))
+
+    for source, path in local:
+        if not os.path.exists(path):
+            continue
+        if _file_sha256(path) == sha256:
+            log(f'Using locked {filename} from the {source}')
+            shutil.copy(path, dest)
+            return source
+        if source == 'cache':
+            log(f'WARNING: cached {filename} does not match the lock file, '
+                f'fetching it again')
+            os.remove(path)
+
+    with tempfile.TemporaryDirectory(prefix='azureworker') as td:
+        source = ensure_wheel(name, version, args, td)
+        path = os.path.join(td, filename)
+        if not os.path.exists(path):
+            die(f'{filename} from the lock file is not available, '
+                f'delete the lock file to resolve the requirements again')
+        if _file_sha256(path) != sha256:
+            die(f'{filename} does not match its sha256 in the lock file')
+        shutil.move(path, dest)
+    return source
 
 
 def ensure_wheel(name, version, args, dest):
-    # Determine the correct ABI tag based on Python version
-    cmd = [
-        sys.executable, '-m', 'pip', 'download', '--no-deps', '--only-binary', ':all:',
-        '--python-version', args.python_version,
-        '--implementation', 'cp',
-        '--abi', f'cp{args.python_version}',
-        '--dest', dest,
-        f'{name}=={version}'
-    ]
-
-    pip = run(cmd)
-    if pip.returncode != 0:
-        # No wheel for this package for this platform or Python version.
-        if not build_independent_wheel(name, version, args, dest):
-            build_binary_wheel(name, version, args, dest)
+    if args.wheelhouse_index is not None:
+        local = args.wheelhouse_index.find(name, version, args)
+        if local is not None:
+            log(f'Using {os.path.basename(local)} from the wheelhouse')
+            shutil.copy(local, dest)
+            return 'wheelhouse'
+
+    cache = args.wheel_cache
+    if cache is not None:
+        # Both downloaded and locally built wheels end up in the cache,
+        # so this also saves build_independent_wheel() a source build.
+        cached = cache.find(name, version, args)
+        if cached is not None:
+            log(f'Using cached {os.path.basename(cached)}')
+            shutil.copy(cached, dest)
+            return 'cache'
+
+    with tempfile.TemporaryDirectory(prefix='azureworker') as td:
+        fetched = None
+        if args.fetcher == 'native':
+            fetched = fetch_wheel(name, version, args, td)
+
+        if fetched is None:
+            # Let pip pick among the wheels supported by the target: the
+            # exact CPython ABI, the stable ABI or no ABI at all, on any of
+            # the target's platform tags.
+            major, minor = _parse_python_version(args.python_version)
+            cmd = [
+                sys.executable, '-m', 'pip', 'download', '--no-deps', '--only-binary', ':all:',
+                '--python-version', args.python_version,
+                '--implementation', 'cp',
+                '--abi', f'cp{major}{minor}', '--abi', 'abi3', '--abi', 'none',
+            ]
+            for plat in platform_tags(args):
+                cmd += ['--platform', plat]
+            cmd += _pip_index_args(args)
+            cmd += [
+                '--dest', td,
+                f'{name}=={version}'
+            ]
+
+            pip = run(cmd)
+            fetched = pip.returncode == 0
+
+        source = 'download'
+        if not fetched:
+            # No wheel for this package for this platform or Python version.
+            source = 'build'
+            with _tracer.span('build', 'build', package=name):
+                if not build_independent_wheel(name, version, args, td):
+                    reject_wheelhouse_wheels(name, version, args)
+                    build_binary_wheel(name, version, args, td)
+
+        for filename in os.listdir(td):
+            if cache is not None and filename.endswith('.whl'):
+                cache.add(os.path.join(td, filename))
+            shutil.move(os.path.join(td, filename), dest)
+
+    return source
 
 
 def build_independent_wheel(name, version, args, dest):
+    if args.build_env_pool is not None:
+        built = build_in_pool(name, version, args, dest)
+        if built is not None:
+            return built
+
     with tempfile.TemporaryDirectory(prefix='azureworker') as td:
         cmd = [
             sys.executable, '-m', 'pip', 'wheel', '--no-deps', '--no-binary', ':all:',
             '--wheel-dir', td,
+            *_pip_index_args(args),
             f'{name}=={version}'
         ]
 
@@ -274,6 +3027,18 @@ def build_independent_wheel(name, version, args, dest):
         return False
 
 
+def reject_wheelhouse_wheels(name, version, args):
+    # The wheelhouse has wheels of the package, only none for the
+    # target: name them rather than suggest a remote build.
+    if args.wheelhouse_index is None:
+        return
+    filenames = args.wheelhouse_index.projects.get(
+        (_canonical_name(name), version))
+    if filenames:
+        die(f'no wheel of {name}=={version} in the wheelhouse fits the '
+            f'target {_lock_target(args)}: {", ".join(sorted(filenames))}')
+
+
 def build_binary_wheel(name, version, args, dest):
     die(f'cannot install {name}-{version} dependency: binary dependencies without wheels are not supported when building locally. '
         f'Use the "--build remote" option to build dependencies on the Azure Functions build server, '
@@ -281,18 +3046,361 @@ def build_binary_wheel(name, version, args, dest):
         f'More information at https://aka.ms/func-python-publish', ExitCode.native_deps_error)
 
 
+# Runs in the profiled interpreter: imports the function app and writes
+# where every module came from, or the memory allocated per top-level
+# package when tracemalloc is enabled.
+_profile_bootstrap = '''
+import importlib.util, os, sys
+app_path, site_packages, out_path, trace_memory = sys.argv[1:5]
+sys.path[:0] = [site_packages, app_path]
+# Process the .pth files of --layout archive and --import-index, which
+# are not run otherwise under -S.
+import site
+site.addsitedir(site_packages)
+if trace_memory == '1':
+    import tracemalloc
+    tracemalloc.start()
+spec = importlib.util.spec_from_file_location(
+    'function_app', os.path.join(app_path, 'function_app.py'))
+module = importlib.util.module_from_spec(spec)
+sys.modules['function_app'] = module
+spec.loader.exec_module(module)
+
+roots = sorted((os.path.abspath(p) for p in sys.path if p),
+               key=len, reverse=True)
+
+def top_level(filename):
+    for root in roots:
+        if filename.startswith(root + os.sep):
+            name = filename[len(root) + 1:].split(os.sep)[0]
+            return root, name.split('.')[0]
+    return None, None
+
+result = {'modules': {}, 'memory': {}}
+if trace_memory == '1':
+    snapshot = tracemalloc.take_snapshot()
+    for stat in snapshot.statistics('filename'):
+        root, name = top_level(os.path.abspath(stat.traceback[0].filename))
+        if name:
+            result['memory'][name] = result['memory'].get(name, 0) + stat.size
+    result['peak'] = tracemalloc.get_traced_memory()[1]
+for name, mod in list(sys.modules.items()):
+    # Namespace packages have no __file__, only a search path.
+    filename = getattr(mod, '__file__', None) or \\
+        next(iter(getattr(mod, '__path__', None) or []), None)
+    if filename:
+        result['modules'][name] = os.path.abspath(filename)
+import json
+with open(out_path, 'w') as f:
+    json.dump(result, f)
+'''
+
+
+def profile_imports(args):
+    """Profile the cold-start imports of a packed function app."""
+    app_path = pathlib.Path(args.path).resolve()
+    if not (app_path / 'function_app.py').exists():
+        die(f'{app_path} has no function_app.py')
+
+    site_packages, _, _, _ = scheme_dirs(app_path / args.packages_dir_name, args)
+    if not site_packages.is_dir():
+        die(f'{site_packages} does not exist, pack the app first')
+
+    python = find_target_python(args)
+    if python is None:
+        die('no Python %d.%d interpreter found to profile the app with'
+            % _parse_python_version(args.python_version))
+
+    def run_child(*flags, trace_memory=False):
+        with tempfile.TemporaryDirectory(prefix='azureworker') as td:
+            out_path = os.path.join(td, 'result.json')
+            bootstrap = os.path.join(td, 'bootstrap.py')
+            with open(bootstrap, 'w', encoding='utf-8') as f:
+                f.write(_profile_bootstrap)
+            # -I -S: neither the environment nor the host site-packages
+            # can leak into the profiled imports.  The bootstrap sets up
+            # the packed site-packages as site would.
+            proc = run(python + ['-I', '-S', *flags, bootstrap,
+                                 str(app_path), str(site_packages), out_path,
+                                 '1' if trace_memory else '0'],
+                       cwd=str(app_path))
+            if proc.returncode != 0:
+                sys.stderr.write(proc.stderr.decode(errors='replace'))
+                die('importing the function app failed')
+            with open(out_path, encoding='utf-8') as f:
+                return json.load(f), proc.stderr.decode(errors='replace')
+
+    # Time and memory are measured in separate runs: tracemalloc slows
+    # imports down considerably and would skew the timings.
+    timing, importtime = run_child('-X', 'importtime')
+    memory, _ = run_child(trace_memory=True)
+
+    tree = _parse_importtime(importtime)
+    packages = _summarize_imports(tree, timing['modules'], memory['memory'],
+                                  app_path, site_packages)
+
+    ranked = sorted(packages.values(),
+                    key=lambda p: p['cumulative_us'], reverse=True)
+    log(f'{"package":<32} {"origin":<10} {"cumulative ms":>14} '
+        f'{"self ms":>10} {"modules":>8} {"memory KiB":>11}')
+    for package in ranked[:args.top]:
+        log(f'{package["name"]:<32} {package["origin"]:<10} '
+            f'{package["cumulative_us"] / 1000:>14.1f} '
+            f'{package["self_us"] / 1000:>10.1f} {package["modules"]:>8} '
+            f'{package["memory"] / 1024:>11.1f}')
+    total_us = sum(node['cumulative_us'] for node in tree)
+    log(f'Total import time {total_us / 1000:.1f} ms, '
+        f'peak traced memory {memory["peak"] / 1024 / 1024:.1f} MiB')
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'app': str(app_path),
+                'python_version': args.python_version,
+                'total_us': total_us,
+                'peak_memory': memory['peak'],
+                'packages': ranked,
+                'imports': tree,
+            }, f, indent=1)
+
+
+def _parse_importtime(output):
+    """Build the import tree from `python -X importtime` output."""
+    pending = []
+    for line in output.splitlines():
+        m = re.match(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$', line)
+        if not m:
+            continue
+        depth = len(m.group(3))
+        node = {'name': m.group(4), 'self_us': int(m.group(1)),
+                'cumulative_us': int(m.group(2)), 'children': []}
+        # Modules are reported once they finish importing, so the
+        # children of a node are the deeper nodes printed just before it.
+        while pending and pending[-1][0] > depth:
+            node['children'].insert(0, pending.pop()[1])
+        pending.append((depth, node))
+    return [node for _, node in pending]
+
+
+def _summarize_imports(tree, modules, memory, app_path, site_packages):
+    packages = {}
+
+    def origin(name):
+        filename = modules.get(name)
+        if filename is None:
+            return 'builtin'
+        if filename.startswith(str(site_packages) + os.sep):
+            return 'package'
+        if filename.startswith(str(app_path) + os.sep):
+            return 'app'
+        return 'stdlib'
+
+    def visit(node, ancestors):
+        top = node['name'].split('.')[0]
+        package = packages.setdefault(top, {
+            'name': top, 'origin': origin(top), 'cumulative_us': 0,
+            'self_us': 0, 'modules': 0, 'memory': memory.get(top, 0)})
+        package['self_us'] += node['self_us']
+        package['modules'] += 1
+        # Count the cumulative time of the outermost import of the
+        # package only, nested re-entries are already part of it.
+        if top not in ancestors:
+            package['cumulative_us'] += node['cumulative_us']
+        for child in node['children']:
+            visit(child, ancestors | {top})
+
+    for node in tree:
+        visit(node, frozenset())
+    return packages
+
+
+def parse_profile_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='packapp profile-imports',
+        description='Import function_app.py against the packed packages in '
+                    'a clean interpreter and rank the top-level packages '
+                    'by import time and memory.')
+    parser.add_argument('--platform', type=str, default='linux')
+    parser.add_argument('--python-version', type=str,
+                        default='%d%d' % sys.version_info[:2])
+    parser.add_argument('--packages-dir-name', type=str,
+                        default='.python_packages')
+    parser.add_argument('--top', type=int, default=20,
+                        help='number of packages to show. Default: 20')
+    parser.add_argument('--json', type=str, default=None,
+                        help='write the full report and import trace to '
+                             'this file')
+    parser.add_argument('path', type=str,
+                        help='Path to a packed function app.')
+    return parser.parse_args(argv)
+
+
+def _split_targets(args):
+    # One copy of args per (platform, Python version) target.
+    platforms = args.platform.split(',')
+    versions = args.python_version.split(',')
+    if len(platforms) == 1 and len(versions) == 1:
+        return [args]
+
+    targets = []
+    for platform, version in itertools.product(platforms, versions):
+        if platform not in ('linux', 'windows'):
+            die(f'unsupported platform: {platform}')
+        target = copy.copy(args)
+        target.platform = platform
+        target.python_version = version
+        target.packages_dir_name = \
+            f'{args.packages_dir_name}-{platform}-{version}'
+        targets.append(target)
+    return targets
+
+
 def parse_args(argv):
     parser = argparse.ArgumentParser()
     parser.add_argument('--verbose', default=False, action='store_true')
-    parser.add_argument('--platform', type=str)
-    parser.add_argument('--python-version', type=str)
+    parser.add_argument('--trace', type=str, default=None, metavar='FILE',
+                        help='write a Chrome trace of the packing phases to '
+                             'FILE and a summary to FILE.summary.json')
+    parser.add_argument('--platform', type=str,
+                        help='target platform, or a comma-separated list '
+                             'of them')
+    parser.add_argument('--python-version', type=str,
+                        help='target Python version, or a comma-separated '
+                             'list of them')
     parser.add_argument('--no-deps', default=False, action='store_true')
+    parser.add_argument('--manylinux-glibc', type=str, default='2.28',
+                        help='newest glibc version available on the Linux '
+                             'target; manylinux wheels up to this version '
+                             'are accepted. Default: 2.28')
+    parser.add_argument('--jobs', '-j', type=int,
+                        default=min(8, os.cpu_count() or 1),
+                        help='number of packages to download or build '
+                             'concurrently. Default: number of CPUs, '
+                             'up to 8')
+    parser.add_argument('--install-mode', choices=('direct', 'copy'),
+                        default='direct',
+                        help='"direct" installs wheels straight into the '
+                             'packages directory, replacing it atomically. '
+                             '"copy" installs into a temporary venv first '
+                             'and copies the files over. Default: direct')
+    parser.add_argument('--no-incremental', dest='incremental',
+                        default=True, action='store_false',
+                        help='rebuild the packages directory from scratch '
+                             'instead of only installing and removing the '
+                             'packages whose pins changed')
+    parser.add_argument('--prune', default=False, action='store_true',
+                        help='remove test suites, docs, examples, type '
+                             'stubs, C sources and stale bytecode from the '
+                             'installed packages')
+    parser.add_argument('--prune-rules', type=str, default=None,
+                        help='file with extra fnmatch patterns to prune, '
+                             'or to keep when prefixed with "!". '
+                             f'Default: {_prune_rules_name} in the app '
+                             'directory, if present')
+    parser.add_argument('--strip', default=False, action='store_true',
+                        help='strip debug symbols from native extension '
+                             'modules (Linux only)')
+    parser.add_argument('--strip-binary', type=str, default='strip',
+                        help='strip executable for the target '
+                             'architecture. Default: strip')
+    parser.add_argument('--compile', default=False, action='store_true',
+                        help='precompile the packaged modules to bytecode '
+                             'with the target Python version')
+    parser.add_argument('--compile-optimize', type=_parse_levels,
+                        default=[0],
+                        help='comma separated optimization levels to '
+                             'compile for, e.g. 0,1,2. Default: 0')
+    parser.add_argument('--compile-invalidation-mode',
+                        choices=('timestamp', 'checked-hash', 'unchecked-hash'),
+                        default='unchecked-hash',
+                        help='how the runtime decides whether bytecode is '
+                             'stale. Default: unchecked-hash, as the '
+                             'packaged sources never change')
+    parser.add_argument('--layout', choices=('tree', 'archive'),
+                        default='tree',
+                        help='"archive" moves zip-safe pure-Python packages '
+                             'into one uncompressed zip imported with '
+                             'zipimport, and implies --compile. '
+                             'Default: tree')
+    parser.add_argument('--zip-safe', type=_canonical_name, action='append',
+                        default=[], metavar='NAME',
+                        help='archive this distribution even if it does not '
+                             'look zip-safe. May be repeated')
+    parser.add_argument('--not-zip-safe', type=_canonical_name,
+                        action='append', default=[], metavar='NAME',
+                        help='never archive this distribution. '
+                             'May be repeated')
+    parser.add_argument('--import-index', default=False,
+                        action='store_true',
+                        help='write an index of the installed modules and a '
+                             'path hook that imports them without scanning '
+                             'site-packages')
+    parser.add_argument('--link-store', type=str, default=None,
+                        help='extract every wheel once into this shared, '
+                             'content-addressed directory and populate the '
+                             'packages directory with links to it. Hard '
+                             'linked apps share their files with the store '
+                             'and with each other')
+    parser.add_argument('--link-mode',
+                        choices=('auto', 'hardlink', 'reflink', 'copy'),
+                        default='auto',
+                        help='how to populate the packages directory from '
+                             '--link-store. "auto" tries a hard link, then a '
+                             'reflink, then falls back to a copy. '
+                             'Default: auto')
+    parser.add_argument('--resolver', choices=('auto', 'report', 'download'),
+                        default='auto',
+                        help='how to find the pinned dependency set: "report" '
+                             'resolves from package metadata with '
+                             '`pip install --dry-run --report`, "download" '
+                             'downloads every distribution. Default: report '
+                             'when the installed pip supports it')
+    parser.add_argument('--fetcher', choices=('pip', 'native'),
+                        default='pip',
+                        help='download wheels with one pip process per '
+                             'package, or in-process over pooled '
+                             'connections, falling back to pip when the '
+                             'index cannot be used or pip is configured '
+                             'with other package sources. Default: pip')
+    parser.add_argument('--index-url', type=str, default=None,
+                        help='simple index to download packages from. '
+                             'Default: the index-url of the pip '
+                             'configuration or PyPI')
+    parser.add_argument('--lock', default=False, action='store_true',
+                        help='install the pins and wheels recorded in the '
+                             'lock file without resolving the requirements '
+                             'while requirements.txt is unchanged, and '
+                             'write the lock file otherwise')
+    parser.add_argument('--lock-file', type=str, default='packapp.lock.json',
+                        help='lock file, relative to the app. '
+                             'Default: packapp.lock.json')
+    parser.add_argument('--wheelhouse', type=str, default=None,
+                        help='resolve and install only from the wheels and '
+                             'sdists in this directory, without network '
+                             'access')
+    parser.add_argument('--cache-dir', type=str, default=_default_cache_dir(),
+                        help='directory to cache downloaded and built '
+                             'wheels in. Default: %(default)s')
+    parser.add_argument('--cache-max-size', type=_parse_size, default='2G',
+                        help='evict least recently used wheels once the '
+                             'cache grows beyond this size. Default: 2G')
+    parser.add_argument('--no-cache', default=False, action='store_true',
+                        help='do not read or write the wheel cache')
+    parser.add_argument('--build-env-pool', default=False,
+                        action='store_true',
+                        help='build sdists of pure-Python packages in warm '
+                             'build environments kept in the cache, and '
+                             'cache the wheels by sdist hash')
     parser.add_argument('--packages-dir-name', type=str,
                         default='.python_packages',
-                        help='folder to save packages in. '
+                        help='folder to save packages in. With several '
+                             'targets, each one is saved in '
+                             'NAME-PLATFORM-VERSION. '
                              'Default: .python_packages')
-    parser.add_argument('path', type=str,
-                        help='Path to a function app to pack.')
+    parser.add_argument('path', type=str, nargs='+',
+                        help='Path to a function app to pack.  Several apps '
+                             'are packed together, sharing the resolution, '
+                             'download and extraction of their packages.')
 
     args = parser.parse_args(argv)
     if not args.platform:
@@ -300,7 +3408,53 @@ def parse_args(argv):
 
     if not args.python_version:
         die('missing required argument: --python-version')
+    # Use the '311' form everywhere, e.g. in lock file and manifest keys.
+    versions = []
+    for version in args.python_version.split(','):
+        try:
+            versions.append('%d%d' % _parse_python_version(version))
+        except ValueError:
+            die(f'invalid Python version: {version}')
+    args.python_version = ','.join(versions)
+
+    if args.jobs < 1:
+        die('--jobs must be at least 1')
+
+    if args.layout == 'archive':
+        # zipimport cannot write bytecode into the archive, so modules
+        # archived without their .pyc are compiled again at every cold
+        # start.  It only reads the unoptimized <module>.pyc.
+        if not args.compile:
+            log('--layout archive precompiles the archived modules, as if '
+                '--compile was given')
+            args.compile = True
+        if 0 not in args.compile_optimize:
+            args.compile_optimize = [0, *args.compile_optimize]
+
+    if args.wheelhouse:
+        if not os.path.isdir(args.wheelhouse):
+            die(f'wheelhouse {args.wheelhouse} does not exist')
+        args.wheelhouse_index = WheelhouseIndex(args.wheelhouse)
+    else:
+        args.wheelhouse_index = None
+
+    args.package_index = PackageIndex(args.index_url)
+
+    if args.no_cache:
+        args.wheel_cache = None
+    else:
+        args.wheel_cache = WheelCache(args.cache_dir, args.cache_max_size)
+
+    if args.build_env_pool and args.wheel_cache is None:
+        die('--build-env-pool needs the cache, it cannot be used with '
+            '--no-cache')
+    elif args.build_env_pool:
+        args.build_env_pool = BuildEnvPool(
+            pathlib.Path(args.cache_dir) / 'build-envs')
+    else:
+        args.build_env_pool = None
 
+    args.targets = _split_targets(args)
     return args
 
 
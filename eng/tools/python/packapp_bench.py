@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+"""Benchmark packapp against synthetic wheels.
+
+Wheels are generated locally, so no network access is needed.  Each
+scenario varies the number and size of files, the compression of the
+wheel and whether it ships scripts and data files.  Three stages are
+measured:
+
+  install   Wheel.install() of every wheel of the scenario
+  copy      the venv-to-app copy of --install-mode copy
+  flow      find_and_build_deps() against a local wheelhouse
+
+With --benchmark import-index, test/TestFunctionApps/TestPythonProject
+is packed with --import-index (this downloads its packages unless they
+are cached) and importing its function_app module in a new interpreter
+is timed with and without the index.
+
+Results are written as JSON; pass a previous result file to --compare
+to print the change for every benchmark.
+
+Usage: python packapp_bench.py [--output results.json] [--compare old.json]
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from packapp_testing import make_wheel, packapp, packapp_args
+
+
+# name: (wheels, files per wheel, file size, compression, scripts, data)
+SCENARIOS = {
+    'many-small': (4, 500, 2 * 1024, zipfile.ZIP_DEFLATED, False, False),
+    'few-large': (2, 8, 4 * 1024 * 1024, zipfile.ZIP_DEFLATED, False, False),
+    'stored': (4, 200, 32 * 1024, zipfile.ZIP_STORED, False, False),
+    'scripts-data': (4, 100, 8 * 1024, zipfile.ZIP_DEFLATED, True, True),
+}
+
+
+def make_scenario(dest, scenario):
+    """Generate the wheels of a scenario, return [(name, version)]."""
+    wheels, files, size, compression, scripts, data = SCENARIOS[scenario]
+    packages = []
+    for i in range(wheels):
+        name = f'bench_{scenario.replace("-", "_")}_{i}'
+        make_wheel(dest, name, '1.0', files, size, compression, scripts, data,
+                   seed=i)
+        packages.append((name, '1.0'))
+    return packages
+
+
+def _tree_size(root):
+    files = total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return files, total
+
+
+def bench_install(wheelhouse, work, args, repeat):
+    wheels = sorted(os.path.join(wheelhouse, f)
+                    for f in os.listdir(wheelhouse) if f.endswith('.whl'))
+    timings = []
+    for _ in range(repeat):
+        prefix = pathlib.Path(tempfile.mkdtemp(dir=work))
+        sp, headers, scripts, data = packapp.scheme_dirs(prefix, args)
+        maker = packapp.ScriptMaker(None, None)
+        started = time.perf_counter()
+        for path in wheels:
+            wheel = packapp.Wheel(path)
+            wheel.install({'prefix': prefix, 'purelib': sp, 'platlib': sp,
+                           'headers': headers / wheel.name,
+                           'scripts': scripts, 'data': data}, maker)
+        timings.append(time.perf_counter() - started)
+        files, size = _tree_size(prefix)
+        shutil.rmtree(prefix)
+    return timings, files, size
+
+
+def bench_copy(wheelhouse, work, args, repeat):
+    # install_via_venv() also installs the wheels; only its copy is
+    # timed, using the 'finalize' span of the tracer.
+    tracer = packapp._tracer
+    tracer.enabled = True
+    timings = []
+    try:
+        for _ in range(repeat):
+            app = pathlib.Path(tempfile.mkdtemp(dir=work))
+            tracer.events = []
+            packapp.install_via_venv(wheelhouse, app, args)
+            timings.extend(event['dur'] / 1e6 for event in tracer.events
+                           if event['name'] == 'finalize')
+            files, size = _tree_size(app)
+            shutil.rmtree(app)
+    finally:
+        tracer.enabled = False
+        tracer.events = []
+    return timings, files, size
+
+
+def bench_flow(wheelhouse, work, packages, repeat):
+    timings = []
+    for _ in range(repeat):
+        app = pathlib.Path(tempfile.mkdtemp(dir=work))
+        (app / 'requirements.txt').write_text(
+            ''.join(f'{name}=={version}\n' for name, version in packages))
+        args = packapp_args(app, wheelhouse)
+        started = time.perf_counter()
+        packapp.find_and_build_deps(args)
+        timings.append(time.perf_counter() - started)
+        files, size = _tree_size(app / args.packages_dir_name)
+        shutil.rmtree(app)
+    return timings, files, size
+
+
+_test_app = (pathlib.Path(__file__).resolve().parents[3] / 'test'
+             / 'TestFunctionApps' / 'TestPythonProject')
+
+# Run in the packed app: times the interpreter from its start, so the
+# index is loaded within the measured time, up to the app being imported.
+_import_timer = '''\
+import sys
+import time
+import function_app
+print(time.perf_counter() - float(sys.argv[1]),
+      sum(1 for m in list(sys.modules.values())
+          if '.python_packages' in (getattr(m, '__file__', None) or '')))
+'''
+
+
+def bench_import_index(work, repeat):
+    app = pathlib.Path(work) / 'import-index'
+    shutil.copytree(_test_app, app)
+    args = packapp_args(app, None, ['--import-index'])
+    packapp.find_and_build_deps(args)
+    sp, _, _, _ = packapp.scheme_dirs(app / args.packages_dir_name, args)
+
+    timings = {}
+    for enabled in ('0', '1'):
+        env = dict(os.environ, PYTHONPATH=str(sp),
+                   PACKAPP_IMPORT_INDEX=enabled)
+        timings[enabled] = []
+        for _ in range(repeat):
+            proc = subprocess.run(
+                [sys.executable, '-c', _import_timer, repr(time.perf_counter())],
+                cwd=app, env=env, capture_output=True, text=True, check=True)
+            elapsed, modules = proc.stdout.split()
+            timings[enabled].append(float(elapsed))
+    return timings['1'], timings['0'], int(modules)
+
+
+def _result(benchmark, scenario, timings, files, size):
+    median = statistics.median(timings)
+    return {
+        'benchmark': benchmark,
+        'scenario': scenario,
+        'runs': len(timings),
+        'min': min(timings),
+        'median': median,
+        'files': files,
+        'bytes': size,
+        'files_per_s': files / median,
+        'mb_per_s': size / median / 1e6,
+    }
+
+
+def _import_result(scenario, timings, timings_without, modules):
+    # The median is the import time with the index, so that --compare
+    # follows the index from run to run.
+    median = statistics.median(timings)
+    without = statistics.median(timings_without)
+    return {
+        'benchmark': 'import-index',
+        'scenario': scenario,
+        'runs': len(timings),
+        'min': min(timings),
+        'median': median,
+        'modules': modules,
+        'min_without_index': min(timings_without),
+        'median_without_index': without,
+        'speedup': without / median,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    baseline = {(r['benchmark'], r['scenario']): r for r in old['results']}
+    print(f'{"benchmark":<12} {"scenario":<18} {"old":>9} {"new":>9} {"change":>8}')
+    for result in new['results']:
+        previous = baseline.get((result['benchmark'], result['scenario']))
+        if previous is None:
+            continue
+        change = result['median'] / previous['median'] - 1
+        print(f'{result["benchmark"]:<12} {result["scenario"]:<18} '
+              f'{previous["median"]:>8.3f}s {result["median"]:>8.3f}s '
+              f'{change:>+8.1%}')
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run, can be repeated. '
+                             'Default: all of them')
+    parser.add_argument('--benchmark', action='append',
+                        choices=('install', 'copy', 'flow', 'import-index'),
+                        help='stage to measure, can be repeated. '
+                             'Default: install, copy and flow')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per benchmark. Default: 5')
+    parser.add_argument('--output', type=str,
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare', type=str,
+                        help='results of a previous run to compare against')
+    args = parser.parse_args(argv)
+
+    benchmarks = args.benchmark or ['install', 'copy', 'flow']
+    scenarios = args.scenario or list(SCENARIOS)
+    if args.benchmark and not set(benchmarks) - {'import-index'}:
+        scenarios = []
+
+    results = []
+
+    def add_result(result, columns):
+        results.append(result)
+        print(f'{result["benchmark"]:<12} {result["scenario"]:<18} '
+              f'{result["median"]:8.3f}s {columns}')
+
+    with tempfile.TemporaryDirectory(prefix='packapp-bench') as work:
+        for scenario in scenarios:
+            wheelhouse = pathlib.Path(work) / scenario
+            wheelhouse.mkdir()
+            packages = make_scenario(wheelhouse, scenario)
+            target_args = packapp_args(work, wheelhouse)
+
+            for benchmark in benchmarks:
+                if benchmark == 'import-index':
+                    continue
+                # packapp logs every command, keep the report readable.
+                with open(os.devnull, 'w') as devnull:
+                    stdout, sys.stdout = sys.stdout, devnull
+                    try:
+                        if benchmark == 'install':
+                            measured = bench_install(wheelhouse, work,
+                                                     target_args, args.repeat)
+                        elif benchmark == 'copy':
+                            measured = bench_copy(wheelhouse, work,
+                                                  target_args, args.repeat)
+                        else:
+                            measured = bench_flow(wheelhouse, work, packages,
+                                                  args.repeat)
+                    finally:
+                        sys.stdout = stdout
+
+                result = _result(benchmark, scenario, *measured)
+                add_result(result, f'{result["files_per_s"]:10.0f} files/s '
+                                   f'{result["mb_per_s"]:8.1f} MB/s')
+
+        if 'import-index' in benchmarks:
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    measured = bench_import_index(work, args.repeat)
+                finally:
+                    sys.stdout = stdout
+            result = _import_result(_test_app.name, *measured)
+            add_result(result, f'{result["median_without_index"]:8.3f}s '
+                               f'without the index, '
+                               f'{result["modules"]} modules')
+
+    report = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Synthetic wheels and packapp arguments for the tests and the benchmark.
+
+Nothing here needs network access: wheels are written from in-memory
+file contents, with a valid RECORD.
+"""
+
+import base64
+import hashlib
+import importlib.util
+import os
+import pathlib
+import random
+import sys
+import zipfile
+
+
+def load_packapp():
+    path = pathlib.Path(__file__).parent / 'packapp' / '__main__.py'
+    spec = importlib.util.spec_from_file_location('packapp', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+packapp = load_packapp()
+
+
+def record_hash(data):
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+    return 'sha256=' + digest.rstrip(b'=').decode('ascii')
+
+
+def _content(rng, size):
+    # Half random bytes, half repeated text: compresses roughly like a
+    # mix of native libraries and Python sources.
+    half = size // 2
+    text = b'def function(argument):\n    return argument\n\n'
+    return rng.randbytes(half) + (text * (size // len(text) + 1))[:size - half]
+
+
+def write_wheel(dest, name, version, members, tag='py3-none-any',
+                compression=zipfile.ZIP_DEFLATED):
+    """Write a wheel of the given {member: content} files, return its path.
+
+    The METADATA, WHEEL and RECORD files are added.
+    """
+    escaped = packapp._escape_name(name)
+    info_dir = f'{escaped}-{version}.dist-info'
+    members = dict(members)
+    members[f'{info_dir}/METADATA'] = (
+        f'Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n').encode()
+    purelib = 'true' if tag.endswith('-none-any') else 'false'
+    members[f'{info_dir}/WHEEL'] = (
+        f'Wheel-Version: 1.0\nGenerator: packapp_testing\n'
+        f'Root-Is-Purelib: {purelib}\nTag: {tag}\n').encode()
+
+    record = [f'{member},{record_hash(content)},{len(content)}'
+              for member, content in members.items()]
+    record.append(f'{info_dir}/RECORD,,')
+
+    path = os.path.join(dest, f'{escaped}-{version}-{tag}.whl')
+    with zipfile.ZipFile(path, 'w', compression) as zf:
+        for member, content in members.items():
+            info = zipfile.ZipInfo(member, date_time=(2020, 1, 1, 0, 0, 0))
+            info.compress_type = compression
+            info.external_attr = (0o755 if '/scripts/' in member else 0o644) << 16
+            zf.writestr(info, content)
+        zf.writestr(f'{info_dir}/RECORD', '\n'.join(record) + '\n')
+    return path
+
+
+def make_wheel(dest, name, version, files, size, compression, scripts, data,
+               seed=0):
+    """Write a py3-none-any wheel of generated modules, return its path."""
+    rng = random.Random(f'{name}-{seed}')
+    data_dir = f'{name}-{version}.data'
+
+    members = {}
+    for i in range(files):
+        members[f'{name}/module_{i // 50}/file_{i}.py'] = _content(rng, size)
+    members[f'{name}/__init__.py'] = b''
+    if scripts:
+        for i in range(5):
+            members[f'{data_dir}/scripts/{name}-tool{i}'] = \
+                b'#!python\nimport sys\nsys.exit(0)\n'
+    if data:
+        for i in range(20):
+            members[f'{data_dir}/data/share/{name}/data_{i}.bin'] = \
+                _content(rng, size)
+    return write_wheel(dest, name, version, members, compression=compression)
+
+
+def packapp_args(app, wheelhouse, extra=()):
+    """Parse packapp arguments for app, or a list of apps, targeting the
+    running Python."""
+    version = f'{sys.version_info.major}{sys.version_info.minor}'
+    if wheelhouse is not None:
+        extra = ['--wheelhouse', str(wheelhouse), '--no-cache', *extra]
+    apps = app if isinstance(app, list) else [app]
+    return packapp.parse_args([
+        '--platform', 'windows' if os.name == 'nt' else 'linux',
+        '--python-version', version, *extra, *map(str, apps)])
@@ -0,0 +1,1027 @@
+"""Tests of packapp against synthetic wheels, without network access.
+
+Only test_profile_test_python_project packs from PyPI, it is skipped
+when PyPI cannot be reached.
+
+Run with: python -m pytest eng/tools/python
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import os
+import pathlib
+import shutil
+import socket
+import subprocess
+import sys
+import sysconfig
+import tarfile
+import threading
+import time
+import zipfile
+
+import pytest
+
+from packapp_testing import make_wheel, packapp, packapp_args, write_wheel
+
+
+class Packer:
+    """Synthetic wheels in a wheelhouse, and apps packed from it."""
+
+    def __init__(self, root):
+        self.root = root
+        self.wheelhouse = root / 'wheelhouse'
+        self.wheelhouse.mkdir()
+
+    def wheels(self, *packages, seed=0):
+        # (name, version, number of generated modules) per wheel.
+        for name, version, files in packages:
+            make_wheel(self.wheelhouse, name, version, files, 256,
+                       zipfile.ZIP_DEFLATED, False, False, seed=seed)
+
+    def wheel(self, name, version, members, tag='py3-none-any'):
+        return write_wheel(self.wheelhouse, name, version, members, tag)
+
+    def app(self, requirements, name='app'):
+        path = self.root / name
+        path.mkdir(exist_ok=True)
+        (path / 'requirements.txt').write_text(requirements)
+        return path
+
+    def args(self, app, *extra, wheelhouse=True):
+        return packapp_args(app, self.wheelhouse if wheelhouse else None,
+                            extra)
+
+    def pack(self, app, *extra):
+        args = self.args(app, *extra)
+        packapp.find_and_build_deps(args)
+        return args
+
+    def site_packages(self, app, args):
+        sp, _, _, _ = packapp.scheme_dirs(app / args.packages_dir_name, args)
+        return sp
+
+    def installed(self, app, args):
+        with open(app / args.packages_dir_name / packapp._manifest_name) as f:
+            manifest = json.load(f)
+        return {name: entry['version']
+                for name, entry in manifest['packages'].items()}
+
+
+@pytest.fixture
+def packer(tmp_path):
+    return Packer(tmp_path)
+
+
+def test_wheelhouse_install(packer):
+    packer.wheels(('alpha', '1.0', 3), ('beta', '2.0', 2))
+    app = packer.app('alpha\nbeta\n')
+
+    args = packer.pack(app)
+
+    sp = packer.site_packages(app, args)
+    assert packer.installed(app, args) == {'alpha': '1.0', 'beta': '2.0'}
+    assert sorted(os.listdir(sp / 'alpha' / 'module_0')) == \
+        ['file_0.py', 'file_1.py', 'file_2.py']
+    assert (sp / 'beta-2.0.dist-info' / 'RECORD').exists()
+
+
+def test_wheelhouse_missing_package(packer):
+    packer.wheels(('alpha', '1.0', 1))
+    app = packer.app('alpha\ngamma\n')
+
+    with pytest.raises(SystemExit):
+        packer.pack(app)
+
+
+def test_record_hash_mismatch(packer, tmp_path):
+    packer.wheels(('alpha', '1.0', 1))
+    path = packer.wheelhouse / 'alpha-1.0-py3-none-any.whl'
+    with zipfile.ZipFile(path) as zf:
+        members = {name: zf.read(name) for name in zf.namelist()}
+    members['alpha/module_0/file_0.py'] += b'# tampered\n'
+    with zipfile.ZipFile(path, 'w') as zf:
+        for name, content in members.items():
+            zf.writestr(name, content)
+
+    args = packer.args(tmp_path / 'app')
+    prefix = tmp_path / 'prefix'
+    sp, headers, scripts, data = packapp.scheme_dirs(prefix, args)
+    wheel = packapp.Wheel(str(path))
+    with pytest.raises(SystemExit):
+        wheel.install({'prefix': prefix, 'purelib': sp, 'platlib': sp,
+                       'headers': headers / wheel.name, 'scripts': scripts,
+                       'data': data}, packapp.ScriptMaker(None, None))
+
+
+def test_incremental_add_remove_upgrade(packer):
+    packer.wheels(('alpha', '1.0', 3), ('beta', '1.0', 1),
+                  ('gamma', '1.0', 1), ('alpha', '2.0', 2))
+    app = packer.app('alpha==1.0\nbeta\n')
+    args = packer.pack(app)
+    sp = packer.site_packages(app, args)
+    assert (sp / 'alpha' / 'module_0' / 'file_2.py').exists()
+
+    # Upgrade alpha, drop beta and add gamma.
+    (app / 'requirements.txt').write_text('alpha==2.0\ngamma\n')
+    args = packer.pack(app)
+
+    assert packer.installed(app, args) == {'alpha': '2.0', 'gamma': '1.0'}
+    assert not (sp / 'alpha' / 'module_0' / 'file_2.py').exists()
+    assert not (sp / 'alpha-1.0.dist-info').exists()
+    assert not (sp / 'beta').exists()
+    assert not (sp / 'beta-1.0.dist-info').exists()
+    assert (sp / 'gamma' / '__init__.py').exists()
+
+
+def test_lock_round_trip(packer, monkeypatch):
+    packer.wheels(('alpha', '1.0', 1), ('beta', '1.0', 1))
+    app = packer.app('alpha\nbeta\n')
+    args = packer.pack(app, '--lock')
+
+    with open(app / args.lock_file) as f:
+        lock = json.load(f)
+    target = packapp._lock_target(args)
+    assert lock['version'] == 2
+    assert lock['packages'] == {target: {'alpha': '1.0', 'beta': '1.0'}}
+    entry = lock['targets'][target]['alpha']
+    assert entry['wheel'] == 'alpha-1.0-py3-none-any.whl'
+    assert entry['sha256'] == packapp._file_sha256(
+        packer.wheelhouse / entry['wheel'])
+
+    # While requirements.txt is unchanged, the pins are not resolved again.
+    def resolve_packages(req_txt, args):
+        raise AssertionError('resolved with a current lock file')
+
+    monkeypatch.setattr(packapp, 'resolve_packages', resolve_packages)
+    packages_dir = app / args.packages_dir_name
+    shutil.rmtree(packages_dir)
+    args = packer.pack(app, '--lock')
+    assert packer.installed(app, args) == {'alpha': '1.0', 'beta': '1.0'}
+
+    # A wheel that changed since it was locked is refused.
+    shutil.rmtree(packages_dir)
+    packer.wheels(('alpha', '1.0', 1), seed=1)
+    with pytest.raises(SystemExit):
+        packer.pack(app, '--lock')
+
+
+def test_run_parallel_failure(capsys):
+    failed = threading.Event()
+    started = []
+
+    def task(item):
+        started.append(item)
+        if item == 0:
+            # Logged after item 1 failed, replayed before it.
+            failed.wait(10)
+            time.sleep(0.5)
+            packapp.log('item 0')
+        elif item == 1:
+            packapp.log('item 1')
+            failed.set()
+            packapp.die('item 1 failed', packapp.ExitCode.native_deps_error)
+        else:
+            packapp.log(f'item {item}')
+
+    with pytest.raises(SystemExit) as excinfo:
+        packapp.run_parallel(task, range(6), 2)
+
+    assert excinfo.value.code == packapp.ExitCode.native_deps_error
+    # The failure cancelled the items that were still queued.
+    assert sorted(started) == [0, 1]
+    out, err = capsys.readouterr()
+    assert out == 'item 0\nitem 1\n'
+    assert err == 'ERROR: item 1 failed\n'
+
+
+def test_trace(packer, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(packapp, '_tracer', packapp.Tracer())
+    packer.wheel('alpha', '1.0', {'alpha/__init__.py': b'NAME = "alpha"\n'})
+    packer.wheels(('beta', '1.0', 1))
+    app = packer.app('alpha\nbeta\n')
+    trace = tmp_path / 'trace.json'
+
+    packapp.main([
+        '--platform', 'windows' if os.name == 'nt' else 'linux',
+        '--python-version', '%d.%d' % sys.version_info[:2],
+        '--wheelhouse', str(packer.wheelhouse), '--no-cache', '--compile',
+        '--trace', str(trace), str(app)])
+
+    with open(trace) as f:
+        events = json.load(f)['traceEvents']
+    for event in events:
+        assert event['ph'] == 'X'
+        assert {'name', 'cat', 'ts', 'dur', 'pid', 'tid', 'args'} <= \
+            event.keys()
+        assert event['dur'] >= 0
+    spans = {(event['cat'], event['name']) for event in events}
+    assert {('phase', 'packapp'), ('phase', 'resolve'), ('phase', 'fetch'),
+            ('phase', 'install'), ('phase', 'compile'),
+            ('phase', 'finalize'), ('fetch', 'alpha'), ('fetch', 'beta'),
+            ('install', 'alpha'), ('install', 'beta')} <= spans
+
+    summary_path = tmp_path / 'trace.summary.json'
+    assert f'Wrote trace to {trace} and its summary to {summary_path}' in \
+        capsys.readouterr().out
+    with open(summary_path) as f:
+        summary = json.load(f)
+    assert {'packapp', 'install', 'compile'} <= summary['phases'].keys()
+    assert {'fetch', 'install'} <= summary['packages']['alpha'].keys()
+
+
+def test_wheel_cache_find_after_add(packer, tmp_path):
+    cache = packapp.WheelCache(tmp_path / 'cache', 1 << 30)
+    args = packer.args(tmp_path / 'app')
+    assert cache.find('alpha', '1.0', args) is None
+
+    packer.wheels(('alpha', '1.0', 1), ('alpha', '2.0', 1))
+    for wheel in sorted(packer.wheelhouse.glob('*.whl')):
+        cache.add(wheel)
+
+    path = cache.find('alpha', '1.0', args)
+    assert os.path.basename(path) == 'alpha-1.0-py3-none-any.whl'
+    assert packapp._file_sha256(path) == packapp._file_sha256(
+        packer.wheelhouse / 'alpha-1.0-py3-none-any.whl')
+    assert cache.find('alpha', '3.0', args) is None
+    assert cache.find_file('alpha', 'alpha-2.0-py3-none-any.whl') == \
+        str(cache.wheels / 'alpha' / 'alpha-2.0-py3-none-any.whl')
+    assert not list(cache.wheels.rglob('*.tmp'))
+
+
+def test_wheel_cache_evict(packer, tmp_path):
+    cache = packapp.WheelCache(tmp_path / 'cache', 0)
+    args = packer.args(tmp_path / 'app')
+    packer.wheels(('alpha', '1.0', 1), ('beta', '1.0', 1),
+                  ('gamma', '1.0', 1))
+    for wheel in sorted(packer.wheelhouse.glob('*.whl')):
+        cache.add(wheel)
+    library = tmp_path / 'libnat.so'
+    library.write_bytes(b'\0' * 100)
+    cache.add_stripped('0' * 64, library)
+
+    # Oldest first: the stripped library, gamma, beta, then alpha.
+    paths = [cache.stripped / ('0' * 64),
+             cache.wheels / 'gamma' / 'gamma-1.0-py3-none-any.whl',
+             cache.wheels / 'beta' / 'beta-1.0-py3-none-any.whl',
+             cache.wheels / 'alpha' / 'alpha-1.0-py3-none-any.whl']
+    for age, path in enumerate(reversed(paths)):
+        os.utime(path, (1000000 - age, 1000000 - age))
+    sizes = [path.stat().st_size for path in paths]
+
+    # A hit makes gamma the most recently used.
+    assert cache.find('gamma', '1.0', args) is not None
+    paths.append(paths.pop(1))
+    sizes.append(sizes.pop(1))
+
+    # Room for the two most recently used entries only.
+    cache.max_size = sum(sizes[-2:])
+    cache.evict()
+    assert [path.exists() for path in paths] == [False, False, True, True]
+
+    cache.max_size = sum(sizes[-2:]) - 1
+    cache.evict()
+    assert [path.exists() for path in paths] == [False, False, False, True]
+
+
+def _make_index(root, wheelhouse, sha256=None):
+    # A file:// simple index with an index.html per project.
+    for wheel in sorted(wheelhouse.glob('*.whl')):
+        project = root / packapp._canonical_name(wheel.name.split('-')[0])
+        project.mkdir(parents=True, exist_ok=True)
+        shutil.copy(wheel, project)
+        digest = sha256 or packapp._file_sha256(wheel)
+        with open(project / 'index.html', 'a') as f:
+            f.write(f'<a href="{wheel.name}#sha256={digest}">'
+                    f'{wheel.name}</a>\n')
+    return root
+
+
+@pytest.fixture
+def pip_env(monkeypatch):
+    # Only the index given to packapp: no pip configuration file, no
+    # other package sources from the environment.
+    monkeypatch.setenv('PIP_CONFIG_FILE', os.devnull)
+    for name in ('PIP_INDEX_URL', 'PIP_EXTRA_INDEX_URL', 'PIP_FIND_LINKS',
+                 'PIP_NO_INDEX'):
+        monkeypatch.delenv(name, raising=False)
+    return monkeypatch
+
+
+def _index_args(packer, app, index):
+    return packer.args(app, '--fetcher', 'native', '--no-cache',
+                       '--index-url', index.as_uri(), wheelhouse=False)
+
+
+def test_index_fetch(packer, tmp_path, pip_env):
+    packer.wheels(('alpha', '1.0', 2))
+    index = _make_index(tmp_path / 'index', packer.wheelhouse)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+
+    args = _index_args(packer, tmp_path / 'app', index)
+    assert packapp.fetch_wheel('alpha', '1.0', args, str(dest)) is True
+    assert packapp._file_sha256(dest / 'alpha-1.0-py3-none-any.whl') == \
+        packapp._file_sha256(packer.wheelhouse / 'alpha-1.0-py3-none-any.whl')
+    # No such version in the index.
+    assert packapp.fetch_wheel('alpha', '2.0', args, str(dest)) is False
+
+
+def test_index_pack(packer, tmp_path, pip_env):
+    packer.wheels(('alpha', '1.0', 2), ('beta', '1.0', 1))
+    index = _make_index(tmp_path / 'index', packer.wheelhouse)
+    app = packer.app('alpha\nbeta\n')
+
+    args = _index_args(packer, app, index)
+    packapp.find_and_build_deps(args)
+    assert packer.installed(app, args) == {'alpha': '1.0', 'beta': '1.0'}
+
+
+def test_index_hash_mismatch(packer, tmp_path, pip_env):
+    packer.wheels(('alpha', '1.0', 1))
+    index = _make_index(tmp_path / 'index', packer.wheelhouse,
+                        sha256='0' * 64)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+
+    args = _index_args(packer, tmp_path / 'app', index)
+    with pytest.raises(SystemExit):
+        packapp.fetch_wheel('alpha', '1.0', args, str(dest))
+
+
+def test_index_not_used_with_other_sources(packer, tmp_path, pip_env):
+    # pip could take the package from the extra index, so must packapp.
+    packer.wheels(('alpha', '1.0', 1))
+    index = _make_index(tmp_path / 'index', packer.wheelhouse)
+    pip_env.setenv('PIP_EXTRA_INDEX_URL', (tmp_path / 'extra').as_uri())
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+
+    args = _index_args(packer, tmp_path / 'app', index)
+    assert packapp.fetch_wheel('alpha', '1.0', args, str(dest)) is None
+    assert os.listdir(dest) == []
+
+
+_importtime = '''\
+import time: self [us] | cumulative | imported package
+import time:       100 |        100 |     alpha._speedups
+import time:        20 |         20 |       json.decoder
+import time:        30 |         50 |     json
+import time:       200 |        350 |   alpha.core
+import time:       400 |        750 | alpha
+import time:        10 |         10 |   beta.util
+import time:        50 |         60 | beta
+import time:        40 |         40 | function_app
+some other line
+'''
+
+
+def test_parse_importtime():
+    tree = packapp._parse_importtime(_importtime)
+
+    assert [node['name'] for node in tree] == ['alpha', 'beta', 'function_app']
+    alpha = tree[0]
+    assert (alpha['self_us'], alpha['cumulative_us']) == (400, 750)
+    assert [node['name'] for node in alpha['children']] == ['alpha.core']
+    core = alpha['children'][0]
+    assert [node['name'] for node in core['children']] == \
+        ['alpha._speedups', 'json']
+    assert core['children'][1]['children'][0]['name'] == 'json.decoder'
+
+
+def test_summarize_imports(tmp_path):
+    app = tmp_path / 'app'
+    sp = app / '.python_packages' / 'lib' / 'site-packages'
+    modules = {
+        'alpha': str(sp / 'alpha' / '__init__.py'),
+        'beta': str(sp / 'beta' / '__init__.py'),
+        'json': '/usr/lib/python3/json/__init__.py',
+        'function_app': str(app / 'function_app.py'),
+    }
+    tree = packapp._parse_importtime(_importtime)
+
+    packages = packapp._summarize_imports(tree, modules, {'alpha': 4096},
+                                          app, sp)
+
+    alpha = packages['alpha']
+    assert alpha['origin'] == 'package'
+    assert (alpha['modules'], alpha['self_us'], alpha['cumulative_us']) == \
+        (3, 700, 750)
+    assert alpha['memory'] == 4096
+    assert packages['json']['origin'] == 'stdlib'
+    assert packages['json']['modules'] == 2
+    assert packages['beta']['cumulative_us'] == 60
+
+
+@pytest.mark.parametrize('mode, flags', [
+    ([], 0b01), (['--compile-invalidation-mode', 'checked-hash'], 0b11),
+    (['--compile-invalidation-mode', 'timestamp'], 0)])
+def test_compile(packer, mode, flags):
+    packer.wheel('alpha', '1.0', {
+        'alpha/__init__.py': b'',
+        'alpha/core.py': b'assert True\nNAME = "core"\n'})
+    app = packer.app('alpha\n')
+
+    args = packer.pack(app, '--compile', '--compile-optimize', '0,1', *mode)
+
+    sp = packer.site_packages(app, args)
+    tag = sys.implementation.cache_tag
+    pycache = sp / 'alpha' / '__pycache__'
+    assert sorted(os.listdir(pycache)) == [
+        f'__init__.{tag}.opt-1.pyc', f'__init__.{tag}.pyc',
+        f'core.{tag}.opt-1.pyc', f'core.{tag}.pyc']
+    for name in os.listdir(pycache):
+        header = (pycache / name).read_bytes()[:8]
+        assert header[:4] == importlib.util.MAGIC_NUMBER
+        assert int.from_bytes(header[4:8], 'little') == flags
+    # The bytecode names the installed path, not the staging directory.
+    code = (pycache / f'core.{tag}.pyc').read_bytes()[16:]
+    assert b'.tmp' not in code
+
+
+def _run_packed(sp, code):
+    # Python as the worker runs it, with the packed site-packages on
+    # PYTHONPATH so that its sitecustomize is imported.
+    proc = subprocess.run([sys.executable, '-c', code],
+                          env=dict(os.environ, PYTHONPATH=str(sp)),
+                          capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    return proc.stdout
+
+
+def _namespace_wheels(packer):
+    # Two distributions sharing the azure namespace package.
+    packer.wheel('azure-functions', '1.0', {
+        'azure/functions/__init__.py': b'NAME = "functions"\n'})
+    packer.wheel('azure-core', '1.0', {
+        'azure/core/__init__.py': b'from .pipeline import NAME\n',
+        'azure/core/pipeline.py': b'NAME = "core"\n'})
+
+
+def test_archive_namespace_package(packer):
+    _namespace_wheels(packer)
+    app = packer.app('azure-functions\nazure-core\n')
+
+    args = packer.pack(app, '--layout', 'archive')
+
+    sp = packer.site_packages(app, args)
+    assert not (sp / 'azure').exists()
+    with zipfile.ZipFile(sp / packapp._archive_name) as zf:
+        names = zf.namelist()
+    assert {'azure/', 'azure/core/', 'azure/functions/'} <= set(names)
+    # Loaded from the archived bytecode, which zipimport reports as
+    # __file__.
+    assert _run_packed(sp, (
+        'import azure.core, azure.functions\n'
+        'print(azure.core.NAME, azure.functions.NAME, azure.core.__file__)\n'
+    )).split() == ['core', 'functions', str(
+        sp / packapp._archive_name / 'azure' / 'core' / '__init__.pyc')]
+
+
+def test_archive_includes_bytecode(packer):
+    _namespace_wheels(packer)
+    app = packer.app('azure-functions\nazure-core\n')
+
+    # Without --compile, and without the unoptimized level zipimport reads.
+    args = packer.pack(app, '--layout', 'archive', '--compile-optimize', '1')
+
+    assert args.compile and args.compile_optimize == [0, 1]
+    sp = packer.site_packages(app, args)
+    with zipfile.ZipFile(sp / packapp._archive_name) as zf:
+        names = set(zf.namelist())
+        for module in ('azure/core/__init__', 'azure/core/pipeline',
+                       'azure/functions/__init__'):
+            assert module + '.pyc' in names
+            assert zf.read(module + '.pyc')[:4] == \
+                importlib.util.MAGIC_NUMBER
+    assert not any('__pycache__' in name for name in names)
+
+
+@pytest.mark.parametrize('source, use', [
+    ('# Not os.path.dirname(__file__).\nNAME = "__file__"\n', None),
+    ('import os\nHERE = os.path.dirname(__file__)\n', '__file__'),
+    ('import json\nPATH = json.__file__\n', '__file__'),
+    ('from importlib.resources import files\nDATA = files(__name__)\n',
+     'importlib.resources.files()'),
+    ('import importlib.resources\n'
+     'DATA = importlib.resources.files(__name__)\n',
+     'importlib.resources.files()'),
+    ('import pkgutil as p\nDATA = p.get_data(__name__, "data.bin")\n',
+     'pkgutil.get_data()'),
+    ('from .pkgutil import get_data\nDATA = get_data()\n', None),
+])
+def test_zip_unsafe_use(source, use):
+    assert packapp._zip_unsafe_use(source.encode()) == use
+
+
+def test_archive_keeps_unsafe_packages(packer):
+    packer.wheel('safe', '1.0', {
+        'safe/__init__.py': b'# Works without __file__.\n'})
+    packer.wheel('unsafe', '1.0', {
+        'unsafe/__init__.py':
+            b'import os\nHERE = os.path.dirname(__file__)\n'})
+    app = packer.app('safe\nunsafe\n')
+
+    args = packer.pack(app, '--layout', 'archive')
+
+    sp = packer.site_packages(app, args)
+    assert not (sp / 'safe').exists()
+    assert (sp / 'unsafe' / '__init__.py').exists()
+    with zipfile.ZipFile(sp / packapp._archive_name) as zf:
+        assert 'safe/__init__.py' in zf.namelist()
+        assert not any(name.startswith('unsafe/') for name in zf.namelist())
+
+
+@pytest.mark.parametrize('layout', [[], ['--layout', 'archive'],
+                                    ['--import-index']])
+def test_profile_packed_app(packer, tmp_path, layout):
+    packer.wheel('alpha', '1.0', {
+        'alpha/__init__.py': b'from . import core\n',
+        'alpha/core.py': b'VALUE = 1\n'})
+    app = packer.app('alpha\n')
+    (app / 'function_app.py').write_text('import alpha\n')
+    args = packer.pack(app, *layout)
+
+    report = tmp_path / 'profile.json'
+    packapp.profile_imports(packapp.parse_profile_args([
+        '--platform', args.platform, '--python-version', args.python_version,
+        '--json', str(report), str(app)]))
+
+    with open(report) as f:
+        packages = {p['name']: p for p in json.load(f)['packages']}
+    assert packages['alpha']['origin'] == 'package'
+    assert packages['alpha']['modules'] == 2
+    if '--import-index' in layout:
+        assert packages['_packapp_import_index']['origin'] == 'package'
+
+
+# Prints the finder of every indexed directory imported from, and
+# whether it had to ask the regular path finder.
+_finders = '''
+import sys
+import sysconfig
+for path, finder in sorted(sys.path_importer_cache.items()):
+    if path.startswith(SP) and finder is not None:
+        print(path[len(SP):] or '.', type(finder).__name__,
+              getattr(finder, '_fallback', None) is not None)
+'''
+
+
+def _pack_indexed(packer):
+    _namespace_wheels(packer)
+    packer.wheel('alpha', '1.0', {
+        'alpha/__init__.py': b'from . import core\n',
+        'alpha/core.py': b'VALUE = 1\n'})
+    app = packer.app('alpha\nazure-functions\nazure-core\n')
+    args = packer.pack(app, '--import-index')
+    return packer.site_packages(app, args)
+
+
+def _imported_with(sp, imports):
+    code = f'{imports}\nSP = {str(sp)!r}\n{_finders}'
+    return [line.split() for line in _run_packed(sp, code).splitlines()]
+
+
+def test_import_index_hit(packer):
+    sp = _pack_indexed(packer)
+    # Zip deploy and extraction rewrite the mtimes of every directory.
+    for root, _, _ in os.walk(sp):
+        os.utime(root, (0, 0))
+
+    finders = _imported_with(sp, (
+        'import alpha.core, azure.core, azure.functions\n'
+        'assert (azure.core.NAME, azure.functions.NAME) == '
+        '("core", "functions")\n'))
+
+    # site-packages itself is also asked for usercustomize, which is
+    # not indexed.
+    assert {path: kind for path, kind, _ in finders} == {
+        '.': '_IndexFinder',
+        os.sep + 'alpha': '_IndexFinder',
+        os.sep + 'azure': '_IndexFinder',
+        os.sep + os.path.join('azure', 'core'): '_IndexFinder',
+    }
+    assert all(fallback == 'False' for path, _, fallback in finders
+               if path != '.')
+
+
+def test_import_index_missing_name(packer):
+    sp = _pack_indexed(packer)
+    # Added to a package after packing: not in the index.
+    (sp / 'alpha' / 'extra.py').write_text('VALUE = 2\n')
+
+    finders = _imported_with(sp, 'import alpha.extra\n')
+
+    assert [os.sep + 'alpha', '_IndexFinder', 'True'] in finders
+
+
+def test_import_index_deleted_module(packer):
+    sp = _pack_indexed(packer)
+    # Replaced by a package after packing, which only changes the
+    # listing of alpha/.
+    (sp / 'alpha' / 'core.py').unlink()
+    (sp / 'alpha' / 'core').mkdir()
+    (sp / 'alpha' / 'core' / '__init__.py').write_text('VALUE = 2\n')
+
+    finders = _imported_with(sp, (
+        'import alpha.core\nassert alpha.core.VALUE == 2\n'))
+
+    assert [os.sep + 'alpha', '_IndexFinder', 'True'] in finders
+
+    # Removed altogether.
+    shutil.rmtree(sp / 'alpha' / 'core')
+    (sp / 'alpha' / '__init__.py').write_text('')
+    assert _run_packed(sp, (
+        'try:\n'
+        '    import alpha.core\n'
+        'except ModuleNotFoundError as e:\n'
+        '    print(e.name)\n')) == 'alpha.core\n'
+
+
+def test_import_index_stale(packer):
+    sp = _pack_indexed(packer)
+    # A distribution installed after packing changes site-packages.
+    (sp / 'beta').mkdir()
+    (sp / 'beta' / '__init__.py').write_text('')
+    (sp / 'beta-1.0.dist-info').mkdir()
+
+    finders = _imported_with(sp, 'import alpha.core, beta\n')
+
+    assert ['.', 'FileFinder', 'False'] in finders
+    assert not any(finder[1] == '_IndexFinder' for finder in finders)
+
+
+def _select(filenames, glibc='2.28', platform='linux'):
+    args = argparse.Namespace(platform=platform, python_version='311',
+                              manylinux_glibc=glibc)
+    return packapp.select_wheel(filenames, args)
+
+
+def test_select_wheel_abi_order():
+    exact = 'x-1.0-cp311-cp311-manylinux_2_17_x86_64.whl'
+    stable = 'x-1.0-cp38-abi3-manylinux_2_17_x86_64.whl'
+    pure = 'x-1.0-py3-none-any.whl'
+
+    assert _select([pure, stable, exact]) == exact
+    assert _select([pure, stable]) == stable
+    assert _select([pure]) == pure
+    # Not for this Python.
+    assert _select(['x-1.0-cp312-cp312-manylinux_2_17_x86_64.whl',
+                    'x-1.0-cp312-abi3-manylinux_2_17_x86_64.whl']) is None
+
+
+def test_select_wheel_manylinux():
+    newer = 'x-1.0-cp311-cp311-manylinux_2_28_x86_64.whl'
+    middle = 'x-1.0-cp311-cp311-manylinux_2_24_x86_64.whl'
+    older = 'x-1.0-cp311-cp311-manylinux_2_17_x86_64.manylinux2014_x86_64.whl'
+
+    assert _select([newer], glibc='2.17') is None
+    assert _select([newer]) == newer
+    assert _select([older, middle, newer]) == newer
+    assert _select([older, middle, newer], glibc='2.24') == middle
+    assert _select([older, middle, newer], glibc='2.17') == older
+    assert _select(['x-1.0-cp311-cp311-manylinux1_x86_64.whl'],
+                   glibc='2.17') == 'x-1.0-cp311-cp311-manylinux1_x86_64.whl'
+
+
+@pytest.mark.parametrize('filename', [
+    'x-1.0-cp311-cp311-musllinux_1_1_x86_64.whl',
+    'x-1.0-cp311-cp311-win_amd64.whl',
+    'x-1.0-cp311-cp311-macosx_11_0_x86_64.whl',
+    'x-1.0-cp311-cp311-manylinux_2_17_aarch64.whl',
+])
+def test_select_wheel_other_platform(filename):
+    assert _select([filename]) is None
+
+
+def test_select_wheel_windows():
+    assert _select(['x-1.0-cp311-cp311-manylinux_2_17_x86_64.whl',
+                    'x-1.0-cp311-cp311-win_amd64.whl'], platform='windows') \
+        == 'x-1.0-cp311-cp311-win_amd64.whl'
+
+
+def test_no_wheel_for_target(packer, capsys):
+    packer.wheel('alpha', '1.0', {'alpha/__init__.py': b''},
+                 tag='cp311-cp311-manylinux_2_28_x86_64')
+    app = packer.app('alpha\n')
+
+    with pytest.raises(SystemExit):
+        packer.pack(app, '--platform', 'linux', '--python-version', '311',
+                    '--manylinux-glibc', '2.17')
+
+    assert 'no wheel of alpha==1.0 in the wheelhouse fits the target ' \
+        'linux-311-glibc2.17: alpha-1.0-cp311-cp311-manylinux_2_28_x86_64.whl' \
+        in capsys.readouterr().err
+
+
+def _files_on_disk(root):
+    return {path.relative_to(root).as_posix()
+            for path in root.rglob('*') if path.is_file()}
+
+
+def test_prune(packer):
+    packer.wheel('alpha', '1.0', {
+        'alpha/__init__.py': b'from .core import VALUE\n',
+        'alpha/core.py': b'VALUE = 1\n',
+        'alpha/core.pyi': b'VALUE: int\n',
+        'alpha/tests/test_core.py': b'def test():\n    pass\n',
+        'alpha/docs/index.rst': b'Alpha\n',
+    })
+    app = packer.app('alpha\n')
+
+    args = packer.pack(app, '--prune')
+
+    packages_dir = app / args.packages_dir_name
+    sp = packer.site_packages(app, args)
+    with open(packages_dir / packapp._manifest_name) as f:
+        manifest = json.load(f)
+    on_disk = _files_on_disk(packages_dir) - {packapp._manifest_name}
+    assert set(manifest['packages']['alpha']['files']) == on_disk
+    with open(sp / 'alpha-1.0.dist-info' / 'RECORD') as f:
+        record = {line.split(',')[0] for line in f}
+    assert record == _files_on_disk(sp)
+    assert record == {
+        'alpha/__init__.py', 'alpha/core.py', 'alpha-1.0.dist-info/METADATA',
+        'alpha-1.0.dist-info/WHEEL', 'alpha-1.0.dist-info/RECORD'}
+    assert _run_packed(sp, 'import alpha\nprint(alpha.VALUE)\n') == '1\n'
+
+
+def test_link_store(packer, tmp_path):
+    packer.wheel('alpha', '1.0', {
+        'alpha/__init__.py': b'VALUE = 1\n',
+        'alpha/tests/test_alpha.py': b'def test():\n    pass\n'})
+    store = tmp_path / 'store'
+    first = packer.app('alpha\n', name='first')
+    second = packer.app('alpha\n', name='second')
+
+    args = packer.pack(first, '--link-store', str(store),
+                       '--link-mode', 'hardlink')
+    # Pruning the second app must not change the files of the first.
+    packer.pack(second, '--link-store', str(store), '--link-mode', 'hardlink',
+                '--prune')
+
+    init = [packer.site_packages(app, args) / 'alpha' / '__init__.py'
+            for app in (first, second)]
+    assert os.path.samefile(*init)
+    assert os.stat(init[0]).st_nlink == 3
+    record = [packer.site_packages(app, args) / 'alpha-1.0.dist-info' / 'RECORD'
+              for app in (first, second)]
+    assert not os.path.samefile(*record)
+    with open(record[0]) as f:
+        assert 'alpha/tests/test_alpha.py' in f.read()
+    with open(record[1]) as f:
+        assert 'alpha/tests/test_alpha.py' not in f.read()
+    assert (packer.site_packages(first, args) / 'alpha' / 'tests' /
+            'test_alpha.py').exists()
+
+
+def test_multi_target(packer):
+    packer.wheels(('alpha', '1.0', 1))
+    for tag in ('cp311-cp311-manylinux_2_17_x86_64', 'cp311-cp311-win_amd64'):
+        packer.wheel('beta', '1.0', {'beta/__init__.py': b''}, tag=tag)
+    app = packer.app('alpha\nbeta\n')
+
+    args = packer.pack(app, '--platform', 'linux,windows',
+                       '--python-version', '311')
+
+    tags = {}
+    for target in args.targets:
+        with open(app / target.packages_dir_name / packapp._manifest_name) as f:
+            packages = json.load(f)['packages']
+        tags[target.packages_dir_name] = {
+            name: entry['tag'] for name, entry in packages.items()}
+    assert tags == {
+        '.python_packages-linux-311': {
+            'alpha': 'py3-none-any',
+            'beta': 'cp311-cp311-manylinux_2_17_x86_64'},
+        '.python_packages-windows-311': {
+            'alpha': 'py3-none-any', 'beta': 'cp311-cp311-win_amd64'},
+    }
+    assert not (app / args.packages_dir_name).exists()
+
+
+def test_multi_app(packer, monkeypatch):
+    packer.wheels(('alpha', '1.0', 1), ('beta', '1.0', 1))
+    apps = [packer.app('alpha\nbeta\n', name='first'),
+            packer.app('alpha\nbeta\n', name='second'),
+            packer.app('alpha\n', name='third')]
+    resolved = []
+    resolve_packages = packapp.resolve_packages
+
+    def count_resolutions(req_txt, args):
+        resolved.append(req_txt)
+        return resolve_packages(req_txt, args)
+
+    extracted = []
+    extract_member = packapp.Wheel._extract_member
+
+    def count_extractions(wheel, zf, info, *args):
+        extracted.append(info.filename)
+        return extract_member(wheel, zf, info, *args)
+
+    monkeypatch.setattr(packapp, 'resolve_packages', count_resolutions)
+    monkeypatch.setattr(packapp.Wheel, '_extract_member', count_extractions)
+    args = packer.pack(apps)
+
+    # The first two apps share their resolution.
+    assert len(resolved) == 2
+    assert [packer.installed(app, args) for app in apps] == [
+        {'alpha': '1.0', 'beta': '1.0'}, {'alpha': '1.0', 'beta': '1.0'},
+        {'alpha': '1.0'}]
+    # Every wheel is extracted once, into a temporary store the apps
+    # are copied from without sharing their files.
+    members = []
+    for wheel in packer.wheelhouse.glob('*.whl'):
+        with zipfile.ZipFile(wheel) as zf:
+            members += zf.namelist()
+    assert sorted(extracted) == sorted(members)
+    init = [packer.site_packages(app, args) / 'alpha' / '__init__.py'
+            for app in apps]
+    assert not os.path.samefile(init[0], init[1])
+    assert not list(packer.root.glob('.packapp-store-*'))
+
+
+_extension_source = b'''
+#include <Python.h>
+
+static struct PyModuleDef module = {PyModuleDef_HEAD_INIT, "_speedups"};
+
+PyMODINIT_FUNC PyInit__speedups(void)
+{
+    return PyModule_Create(&module);
+}
+'''
+
+
+def _build_extension(tmp_path):
+    # An extension module with debug information, for --strip.
+    source = tmp_path / '_speedups.c'
+    source.write_bytes(_extension_source)
+    library = tmp_path / '_speedups.so'
+    subprocess.run(['gcc', '-g', '-shared', '-fPIC',
+                    '-I', sysconfig.get_paths()['include'],
+                    '-o', str(library), str(source)], check=True)
+    return library.read_bytes()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux')
+                    or not shutil.which('gcc') or not shutil.which('strip'),
+                    reason='needs gcc and strip on linux')
+def test_strip(packer, tmp_path):
+    library = _build_extension(tmp_path)
+    version = f'cp{sys.version_info.major}{sys.version_info.minor}'
+    extension = 'nat/_speedups' + sysconfig.get_config_var('EXT_SUFFIX')
+    packer.wheel('nat', '1.0', {
+        'nat/__init__.py': b'from . import _speedups\n',
+        extension: library,
+        # Installed outside site-packages, stripped but not imported.
+        'nat-1.0.data/data/lib/libextra.so': library,
+    }, tag=f'{version}-{version}-manylinux_2_17_x86_64')
+    cache = tmp_path / 'cache'
+
+    def pack(name, *extra):
+        app = packer.app('nat\n', name=name)
+        args = packer.args(app, '--wheelhouse', str(packer.wheelhouse),
+                           '--strip', *extra, wheelhouse=False)
+        packapp.find_and_build_deps(args)
+        packages_dir = app / args.packages_dir_name
+        return packer.site_packages(app, args), packages_dir
+
+    sp, packages_dir = pack('first', '--cache-dir', str(cache))
+    stripped = (sp / extension).read_bytes()
+    assert len(stripped) < len(library)
+    extra, = packages_dir.rglob('libextra.so')
+    assert sp not in extra.parents
+    assert extra.read_bytes() == stripped
+    assert _run_packed(sp, 'import nat\n') == ''
+    digest = packapp._file_sha256(tmp_path / '_speedups.so')
+    assert (cache / 'stripped' / digest).read_bytes() == stripped
+
+    # The stripped copy comes from the cache, by content hash.
+    sp, _ = pack('second', '--cache-dir', str(cache),
+                 '--strip-binary', 'false')
+    assert (sp / extension).read_bytes() == stripped
+
+    # An extension module that no longer imports is put back unstripped.
+    breaker = tmp_path / 'break-strip'
+    breaker.write_text('#!/bin/sh\nfor f; do :; done\nprintf broken > "$f"\n')
+    breaker.chmod(0o755)
+    sp, _ = pack('third', '--no-cache', '--strip-binary', str(breaker))
+    assert (sp / extension).read_bytes() == library
+    assert _run_packed(sp, 'import nat\n') == ''
+
+
+# An in-tree PEP 517 backend, so that building the sdists needs nothing
+# beyond the build environment's own pip.
+_sdist_backend = b'''\
+import zipfile
+
+
+def build_wheel(wheel_directory, config_settings=None,
+                metadata_directory=None):
+    with open('PKG-INFO') as f:
+        metadata = dict(line.split(': ', 1) for line in f.read().splitlines())
+    name, version = metadata['Name'], metadata['Version']
+    info = f'{name}-{version}.dist-info'
+    filename = f'{name}-{version}-py3-none-any.whl'
+    with zipfile.ZipFile(f'{wheel_directory}/{filename}', 'w') as zf:
+        with open(f'{name}/__init__.py') as f:
+            zf.writestr(f'{name}/__init__.py', f.read())
+        zf.writestr(f'{info}/METADATA', f'Metadata-Version: 2.1\\n'
+                    f'Name: {name}\\nVersion: {version}\\n')
+        zf.writestr(f'{info}/WHEEL', 'Wheel-Version: 1.0\\n'
+                    'Root-Is-Purelib: true\\nTag: py3-none-any\\n')
+        zf.writestr(f'{info}/RECORD', '')
+    return filename
+'''
+
+
+def _write_sdist(dest, name, version):
+    root = f'{name}-{version}'
+    members = {
+        'PKG-INFO': f'Name: {name}\nVersion: {version}\n'.encode(),
+        'pyproject.toml': b'[build-system]\nrequires = []\n'
+                          b'build-backend = "backend"\nbackend-path = ["."]\n',
+        'backend.py': _sdist_backend,
+        f'{name}/__init__.py': f'NAME = "{name}"\n'.encode(),
+    }
+    with tarfile.open(dest / f'{root}.tar.gz', 'w:gz') as tf:
+        for member, content in members.items():
+            info = tarfile.TarInfo(f'{root}/{member}')
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content))
+    return dest / f'{root}.tar.gz'
+
+
+@pytest.mark.skipif(importlib.util.find_spec('ensurepip') is None,
+                    reason='needs venv with pip')
+def test_build_env_pool(packer, tmp_path, capsys):
+    alpha = _write_sdist(packer.wheelhouse, 'alpha', '1.0')
+    _write_sdist(packer.wheelhouse, 'beta', '1.0')
+    # The wheel package every build environment gets.
+    packer.wheel('wheel', '0.1', {'wheel/__init__.py': b''})
+    cache = tmp_path / 'cache'
+    args = packapp_args(tmp_path / 'app', None, [
+        '--wheelhouse', str(packer.wheelhouse), '--cache-dir', str(cache),
+        '--build-env-pool'])
+
+    for name in ('alpha', 'beta'):
+        dest = tmp_path / name
+        dest.mkdir()
+        assert packapp.build_in_pool(name, '1.0', args, str(dest)) is True
+        assert os.listdir(dest) == [f'{name}-1.0-py3-none-any.whl']
+
+    # Both sdists have the same build requirements: one environment.
+    out = capsys.readouterr().out
+    assert out.count('Creating build environment for wheel') == 1
+    envs = os.listdir(cache / 'build-envs')
+    assert len(envs) == 1 and not envs[0].endswith('.tmp')
+
+    # The wheels are cached by sdist hash, and not built again.
+    digest = packapp._file_sha256(alpha)
+    assert os.listdir(cache / 'built' / digest) == \
+        ['alpha-1.0-py3-none-any.whl']
+    dest = tmp_path / 'again'
+    dest.mkdir()
+    assert packapp.build_in_pool('alpha', '1.0', args, str(dest)) is True
+    assert os.listdir(dest) == ['alpha-1.0-py3-none-any.whl']
+    out = capsys.readouterr().out
+    assert 'Using alpha-1.0-py3-none-any.whl built from alpha-1.0.tar.gz' \
+        in out
+    assert 'pip wheel' not in out
+
+
+_test_python_project = pathlib.Path(__file__).resolve().parents[3] / \
+    'test' / 'TestFunctionApps' / 'TestPythonProject'
+
+
+def _pypi_reachable():
+    try:
+        socket.create_connection(('pypi.org', 443), timeout=5).close()
+    except OSError:
+        return False
+    return True
+
+
+@pytest.mark.skipif(not _pypi_reachable(), reason='needs access to PyPI')
+@pytest.mark.parametrize('layout', [[], ['--layout', 'archive'],
+                                    ['--import-index']])
+def test_profile_test_python_project(tmp_path, layout):
+    # The sample app of the func tests, packed from PyPI.
+    app = tmp_path / 'TestPythonProject'
+    shutil.copytree(_test_python_project, app)
+    args = packapp_args(app, None, ['--cache-dir', str(tmp_path / 'cache'),
+                                    *layout])
+    packapp.find_and_build_deps(args)
+
+    report = tmp_path / 'profile.json'
+    packapp.profile_imports(packapp.parse_profile_args([
+        '--platform', args.platform, '--python-version', args.python_version,
+        '--json', str(report), str(app)]))
+
+    with open(report) as f:
+        packages = {p['name']: p for p in json.load(f)['packages']}
+    assert packages['azure']['origin'] == 'package'
+    assert packages['azure']['modules'] > 1
@@ -410,11 +410,16 @@ internal static async Task<Stream> GetPythonDeploymentPackage(IEnumerable<string
                 if (buildOption != BuildOption.Remote && await ArePackagesInSync(reqTxtFile, packagesLocation))
                 {
                     ColoredConsole.WriteLine(WarningColor($"Directory {Constants.ExternalPythonPackages} already in sync with {Constants.RequirementsTxt}. Skipping restoring dependencies..."));
-                    return await ZipHelper.CreateZip(files.Union(FileSystemHelpers.GetFiles(packagesLocation)), functionAppRoot, Enumerable.Empty<string>());
+                    return await ZipHelper.CreateZip(files.Union(GetPythonPackagesFiles(packagesLocation)), functionAppRoot, Enumerable.Empty<string>());
                 }
 
-                ColoredConsole.WriteLine($"Deleting the old {Constants.ExternalPythonPackages} directory");
-                FileSystemHelpers.DeleteDirectorySafe(packagesLocation);
+                // packapp updates the directory itself: with the manifest it left there, only
+                // the packages whose pins changed are reinstalled.
+                if (buildNativeDeps || buildOption == BuildOption.Remote)
+                {
+                    ColoredConsole.WriteLine($"Deleting the old {Constants.ExternalPythonPackages} directory");
+                    FileSystemHelpers.DeleteDirectorySafe(packagesLocation);
+                }
             }
 
             FileSystemHelpers.EnsureDirectory(packagesLocation);
@@ -448,7 +453,13 @@ internal static async Task<Stream> GetPythonDeploymentPackage(IEnumerable<string
                 await FileSystemHelpers.WriteAllTextToFileAsync(md5FilePath, SecurityHelpers.CalculateMd5(reqTxtFile));
             }
 
-            return await ZipHelper.CreateZip(files.Union(FileSystemHelpers.GetFiles(packagesLocation)), functionAppRoot, Enumerable.Empty<string>());
+            return await ZipHelper.CreateZip(files.Union(GetPythonPackagesFiles(packagesLocation)), functionAppRoot, Enumerable.Empty<string>());
+        }
+
+        // The files of the packages directory to deploy, without packapp's install manifest.
+        private static IEnumerable<string> GetPythonPackagesFiles(string packagesLocation)
+        {
+            return FileSystemHelpers.GetFiles(packagesLocation, excludedFiles: new[] { Constants.PackappManifest });
         }
 
         private static async Task RestorePythonRequirementsPackapp(string functionAppRoot, string packagesLocation)
@@ -1,6 +1,7 @@
 ﻿// Copyright (c) .NET Foundation. All rights reserved.
 // Licensed under the MIT License. See LICENSE in the project root for license information.
 
+using System.IO.Compression;
 using System.Runtime.InteropServices;
 using Azure.Functions.Cli.Common;
 using Azure.Functions.Cli.Helpers;
@@ -114,6 +115,40 @@ public void DockerfileNameShouldNotContainInvalidCharacters(int major, int minor
             // Verify expected format
             Assert.Matches(@"^4-python\d+-buildenv$", dockerfileName);
         }
+
+        [Fact]
+        public async Task GetPythonDeploymentPackage_ExcludesPackappManifest()
+        {
+            var root = Path.Combine(Path.GetTempPath(), "func-python-zip-" + Guid.NewGuid().ToString("N"));
+            var packages = Path.Combine(root, Constants.ExternalPythonPackages);
+            var sitePackages = Path.Combine(packages, "lib", "site-packages");
+            Directory.CreateDirectory(sitePackages);
+            try
+            {
+                var requirements = Path.Combine(root, Constants.RequirementsTxt);
+                var functionApp = Path.Combine(root, "function_app.py");
+                File.WriteAllText(requirements, "alpha\n");
+                File.WriteAllText(functionApp, "import alpha\n");
+                File.WriteAllText(Path.Combine(sitePackages, "alpha.py"), string.Empty);
+                File.WriteAllText(Path.Combine(packages, Constants.PackappManifest), "{}");
+
+                // In sync with requirements.txt, so the packages are zipped without running packapp.
+                File.WriteAllText(Path.Combine(packages, $"{Constants.RequirementsTxt}.md5"), SecurityHelpers.CalculateMd5(requirements));
+
+                using var stream = await PythonHelpers.GetPythonDeploymentPackage(new[] { requirements, functionApp }, root, buildNativeDeps: false, BuildOption.Local, additionalPackages: string.Empty);
+                using var zip = new ZipArchive(stream, ZipArchiveMode.Read);
+                var entries = zip.Entries.Select(e => e.FullName).ToList();
+
+                Assert.Contains("function_app.py", entries);
+                Assert.Contains($"{Constants.ExternalPythonPackages}/lib/site-packages/alpha.py", entries);
+                Assert.Contains($"{Constants.ExternalPythonPackages}/{Constants.RequirementsTxt}.md5", entries);
+                Assert.DoesNotContain($"{Constants.ExternalPythonPackages}/{Constants.PackappManifest}", entries);
+            }
+            finally
+            {
+                Directory.Delete(root, recursive: true);
+            }
+        }
     }
 
     public sealed class SkipIfPythonNonExistFact : FactAttribute